@@ -2,7 +2,8 @@ from rest_framework.routers import DefaultRouter
 from django.urls import path
 from products.views import (
     FAQViewSet, BrandViewSet, BannerViewSet, ProductWeightViewSet, OrderView, CatalogList,
-    MoyskladProductAPIView, MoyskladProductStockAPIView, ProductPriceViewSet, ProductShotsViewSet
+    MoyskladProductAPIView, MoyskladProductStockAPIView, ProductPriceViewSet, ProductShotsViewSet,
+    MoyskladMetricsView
 )
 from products.views import (
     ProductDetailView, ProductColorViewset, ProductListView, CategoryListView, TeamListView, BestSellerListView
@@ -28,4 +29,5 @@ urlpatterns += [
     path('moysklad/', MoyskladProductAPIView.as_view(), name='moysklad-api'),
     path('bestseller-list/', BestSellerListView.as_view(), name='bestseller-list'),
     path('moysklad-stocks/', MoyskladProductStockAPIView.as_view(), name='moysklad-stocks-api'),
+    path('moysklad-metrics/', MoyskladMetricsView.as_view(), name='moysklad-metrics'),
 ]
@@ -199,6 +199,17 @@ CORS_ALLOW_HEADERS = [
 ]
 MOYSKLAD_LOGIN = env("MOYSKLAD_LOGIN", default="")
 MOYSKLAD_PASSWORD = env("MOYSKLAD_PASSWORD", default="")
+# Moysklad reports and filters timestamps in the account's timezone.
+MOYSKLAD_TIMEZONE = env("MOYSKLAD_TIMEZONE", default="Europe/Moscow")
+MOYSKLAD_MAX_IMAGE_BYTES = env.int("MOYSKLAD_MAX_IMAGE_BYTES", default=20 * 1024 * 1024)
+# Images are downloaded by `process_image_queue` instead of inside imports/webhooks.
+MOYSKLAD_IMAGE_QUEUE = env.bool("MOYSKLAD_IMAGE_QUEUE", default=True)
+MOYSKLAD_IMAGE_JOB_MAX_ATTEMPTS = env.int("MOYSKLAD_IMAGE_JOB_MAX_ATTEMPTS", default=5)
+# Product webhooks only store events; `process_webhook_events` applies them.
+MOYSKLAD_WEBHOOK_INBOX = env.bool("MOYSKLAD_WEBHOOK_INBOX", default=True)
+MOYSKLAD_WEBHOOK_EVENT_MAX_ATTEMPTS = env.int("MOYSKLAD_WEBHOOK_EVENT_MAX_ATTEMPTS", default=5)
+# Seconds a new event waits in the inbox, absorbing later events for the same entity.
+MOYSKLAD_WEBHOOK_COALESCE_SECONDS = env.float("MOYSKLAD_WEBHOOK_COALESCE_SECONDS", default=10.0)
 
 # Telegram Bot Configuration
 TELEGRAM_BOT_TOKEN = env("TELEGRAM_BOT_TOKEN", default="7835974424:AAHx-7k1861BnTqYGclFOHjfXClfXn4NRys")
@@ -2,7 +2,8 @@
 from django.contrib import admin
 from django.utils.html import format_html
 from .models import Product, ProductWeight, FAQ, Banner, Brand, Category, Order, ProductPrice
-from .models import ProductColor, Catalog, OrderItem, Team, BestSeller, ProductShots
+from .models import ProductColor, Catalog, OrderItem, Team, BestSeller, ProductShots, SyncState, ImageSyncJob, ImportJob
+from .models import WebhookEvent, StockDocument
 
 
 class OrderItemInline(admin.TabularInline):
@@ -25,7 +26,8 @@ class OrderAdmin(admin.ModelAdmin):
 class ProductShotsInline(admin.TabularInline):
     model = ProductShots
     extra = 0
-    readonly_fields = ('image_preview',)
+    readonly_fields = ('image_preview', 'moysklad_id')
+    exclude = ('moysklad_product_id', 'moysklad_signature')
 
     def image_preview(self, obj):
         if obj.image:
@@ -96,3 +98,59 @@ class BrandAdmin(admin.ModelAdmin):
     search_fields = ['id']
 
 admin.site.register(Team)
+
+
+@admin.register(SyncState)
+class SyncStateAdmin(admin.ModelAdmin):
+    list_display = ['key', 'watermark', 'updated_at']
+
+
+@admin.register(ImageSyncJob)
+class ImageSyncJobAdmin(admin.ModelAdmin):
+    list_display = ['product', 'source_id', 'status', 'attempts', 'available_at', 'updated_at']
+    list_filter = ['status']
+    search_fields = ['product__title', 'source_id']
+    raw_id_fields = ('product',)
+
+
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ['id', 'entity_type', 'action', 'entity_id', 'status', 'collapsed', 'attempts', 'available_at',
+                    'created_at']
+    list_filter = ['status', 'entity_type', 'action']
+    search_fields = ['entity_id']
+    readonly_fields = ['created_at', 'updated_at']
+
+
+@admin.register(StockDocument)
+class StockDocumentAdmin(admin.ModelAdmin):
+    list_display = ['moysklad_id', 'entity_type', 'deleted', 'created_at', 'updated_at']
+    list_filter = ['entity_type', 'deleted']
+    search_fields = ['moysklad_id']
+    readonly_fields = ['moysklad_id', 'entity_type', 'positions', 'deleted', 'created_at', 'updated_at']
+
+
+@admin.register(ImportJob)
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'kind', 'status', 'progress', 'ok_count', 'changed_count', 'err_count', 'failed_pages_count',
+                    'rows_per_second', 'started_at', 'updated_at', 'finished_at']
+    list_filter = ['kind', 'status']
+    readonly_fields = [field.name for field in ImportJob._meta.fields]
+
+    def progress(self, obj):
+        pages = len(obj.completed_pages)
+        limit = (obj.params or {}).get('limit')
+        if obj.total_rows and limit:
+            total_pages = -(-obj.total_rows // limit)
+            return f"{pages}/{total_pages} pages ({obj.rows_processed}/{obj.total_rows} rows)"
+        return f"{pages} pages ({obj.rows_processed} rows)"
+    progress.short_description = 'Progress'
+
+    def failed_pages_count(self, obj):
+        return len(obj.failed_pages)
+    failed_pages_count.short_description = 'Failed pages'
+
+    def rows_per_second(self, obj):
+        busy = obj.fetch_seconds + obj.write_seconds
+        return f"{obj.rows_processed / busy:.1f}" if busy else '-'
+    rows_per_second.short_description = 'Rows/s'
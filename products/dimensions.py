@@ -0,0 +1,168 @@
+"""
+In-memory index of the import "dimensions": categories, colors and weights.
+
+A catalog has a few hundred of each, while every imported row references
+them. `DimensionCache` loads each table once (one query per model) and then
+resolves rows in memory; only values it has never seen go to the database,
+in one batch per model (per depth level for category paths).
+
+Creation of missing values is serialized between processes (a PostgreSQL
+advisory lock held until the surrounding transaction ends) and the misses
+are looked up again under that lock, so concurrent importers, webhooks and
+workers don't create duplicates — ProductColor and ProductWeight have no
+unique constraint, and NULL parents aren't unique for Category either.
+
+Entries learned inside a transaction are only remembered once it commits,
+so a rolled back page can't leave ids of vanished rows behind. Rows deleted
+elsewhere (e.g. in the admin) are dropped by `invalidate()` or the TTL.
+"""
+import threading
+import time
+import zlib
+from typing import Dict, Iterable, Optional, Tuple
+
+from django.db import connection, transaction
+
+from products.models import Category, ProductColor, ProductWeight
+
+# How long the shared cache trusts its snapshot before reloading (seconds).
+SHARED_CACHE_TTL = 300.0
+
+
+def _split_category_path(category_path: str) -> tuple:
+    return tuple(name.strip() for name in category_path.split('/') if name.strip())
+
+
+def _creation_lock(name: str) -> None:
+    """Serializes creators of `name` until the current transaction ends (PostgreSQL only)."""
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [zlib.crc32(name.encode())])
+
+
+class DimensionCache:
+    def __init__(self, ttl: Optional[float] = None):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._loaded_at: Optional[float] = None
+        self._categories: Dict[Tuple[Optional[int], str], Category] = {}
+        self._colors: Dict[str, ProductColor] = {}
+        self._weights: Dict[str, ProductWeight] = {}
+        self.stats = {"hits": 0, "misses": 0, "created": 0}
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._loaded_at = None
+
+    def _ensure_loaded(self) -> None:
+        with self._lock:
+            if self._loaded_at is not None and (
+                self.ttl is None or time.monotonic() - self._loaded_at < self.ttl
+            ):
+                return
+            # setdefault по возрастанию pk: при дублях всегда берём самую раннюю запись
+            categories, colors, weights = {}, {}, {}
+            for category in Category.objects.order_by('pk'):
+                categories.setdefault((category.parent_id, category.name), category)
+            for color in ProductColor.objects.order_by('pk'):
+                colors.setdefault(color.name, color)
+            for weight in ProductWeight.objects.order_by('pk'):
+                weights.setdefault(weight.mass, weight)
+            self._categories, self._colors, self._weights = categories, colors, weights
+            self._loaded_at = time.monotonic()
+
+    def _remember(self, index: dict, found: dict) -> None:
+        def apply():
+            with self._lock:
+                for key, obj in found.items():
+                    index.setdefault(key, obj)
+
+        transaction.on_commit(apply)
+
+    def _count(self, **counts) -> None:
+        with self._lock:
+            for key, value in counts.items():
+                self.stats[key] += value
+
+    def _resolve(self, index: dict, keys: set, lock_name: str, fetch, create) -> dict:
+        """Cache hits, then (under the creation lock) DB lookups and creation of the rest."""
+        with self._lock:
+            resolved = {key: index[key] for key in keys if key in index}
+        missing = keys - resolved.keys()
+        self._count(hits=len(resolved), misses=len(missing))
+        if not missing:
+            return resolved
+
+        with transaction.atomic():
+            _creation_lock(f"dimensions:{lock_name}")
+            found = fetch(missing)
+            still_missing = missing - found.keys()
+            if still_missing:
+                create(still_missing)
+                self._count(created=len(still_missing))
+                found.update(fetch(still_missing))
+        self._remember(index, found)
+        resolved.update(found)
+        return resolved
+
+    def categories(self, paths: Iterable[str]) -> Dict[str, Optional[Category]]:
+        """Maps every 'A/B/C' path to its leaf Category, creating missing levels."""
+        self._ensure_loaded()
+        split_paths = {path: _split_category_path(path) for path in set(paths)}
+        resolved: Dict[tuple, Category] = {}  # path prefix -> Category
+
+        def fetch_categories(keys):
+            found = {}
+            for category in Category.objects.filter(name__in={name for _, name in keys}).order_by('pk'):
+                key = (category.parent_id, category.name)
+                if key in keys:
+                    found.setdefault(key, category)
+            return found
+
+        def create_categories(keys):
+            Category.objects.bulk_create(
+                [Category(name=name, parent_id=parent_id) for parent_id, name in keys],
+                ignore_conflicts=True,
+            )
+
+        max_depth = max((len(parts) for parts in split_paths.values()), default=0)
+        for depth in range(max_depth):
+            wanted = {}
+            for parts in split_paths.values():
+                if len(parts) <= depth:
+                    continue
+                prefix = parts[:depth + 1]
+                parent = resolved.get(prefix[:-1]) if depth else None
+                wanted[prefix] = (parent.pk if parent else None, prefix[-1])
+
+            by_key = self._resolve(
+                self._categories, set(wanted.values()), 'Category', fetch_categories, create_categories
+            )
+            for prefix, key in wanted.items():
+                resolved[prefix] = by_key[key]
+
+        return {path: resolved.get(parts) if parts else None for path, parts in split_paths.items()}
+
+    def _by_value(self, index, model, field_name: str, values: Iterable[str]) -> dict:
+        def fetch_values(keys):
+            found = {}
+            for obj in model.objects.filter(**{f"{field_name}__in": keys}).order_by('pk'):
+                found.setdefault(getattr(obj, field_name), obj)
+            return found
+
+        def create_values(keys):
+            model.objects.bulk_create([model(**{field_name: value}) for value in keys])
+
+        self._ensure_loaded()
+        return self._resolve(index, set(values), model.__name__, fetch_values, create_values)
+
+    def colors(self, names: Iterable[str]) -> Dict[str, ProductColor]:
+        return self._by_value(self._colors, ProductColor, 'name', names)
+
+    def weights(self, masses: Iterable[str]) -> Dict[str, ProductWeight]:
+        return self._by_value(self._weights, ProductWeight, 'mass', masses)
+
+
+# Shared by webhooks and other short imports in this process; long imports
+# create their own DimensionCache for the run.
+shared_dimensions = DimensionCache(ttl=SHARED_CACHE_TTL)
@@ -0,0 +1,132 @@
+"""
+DB-backed queue of product image downloads.
+
+Imports and webhooks only record an `ImageSyncJob` per product variant (in
+the same transaction as the product itself), so product data is visible
+immediately and no request waits on image downloads. `process_image_queue`
+drains the queue with a bounded thread pool; all downloads go through the
+shared Moysklad client and therefore its rate limits.
+
+One pending job is kept per variant: a newer update replaces the queued
+image list instead of adding a second job. Failed jobs are retried with
+exponential backoff and stay in the table as `failed` after the last attempt
+(see products.job_queue).
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.db import connection
+
+from products.job_queue import claim_due, reschedule, serialized
+from products.models import ImageSyncJob, Product
+
+QUEUE_LOCK_NAME = "products:image_queue"
+
+
+def _source_id(images) -> str:
+    """Variant guid from images meta.href (.../entity/product/{id}/images)."""
+    href = (images.get('meta') or {}).get('href', '')
+    return urlparse(href).path.rstrip('/').split('/')[-2]
+
+
+def enqueue_images(pending: List[Tuple]) -> int:
+    """
+    Queues `(product, images)` pairs; returns the number of new jobs.
+    Runs under the queue lock, so two enqueues of one variant never both
+    create a job and a claimed job never misses a newer image list.
+    """
+    wanted: Dict[Tuple[int, str], Tuple] = {}
+    for product, images in pending:
+        wanted[(product.pk, _source_id(images))] = (product, images)
+    if not wanted:
+        return 0
+
+    with serialized(QUEUE_LOCK_NAME):
+        queued = ImageSyncJob.objects.filter(
+            status=ImageSyncJob.PENDING,
+            product_id__in={product_id for product_id, _ in wanted},
+            source_id__in={source_id for _, source_id in wanted},
+        )
+        to_update = []
+        for job in queued:
+            key = (job.product_id, job.source_id)
+            if key in wanted:
+                job.images = wanted.pop(key)[1]
+                to_update.append(job)
+        ImageSyncJob.objects.bulk_update(to_update, ['images'])
+        ImageSyncJob.objects.bulk_create([
+            ImageSyncJob(product=product, source_id=source_id, images=images)
+            for (_, source_id), (product, images) in wanted.items()
+        ])
+    return len(wanted)
+
+
+def enqueue_pending_images(result) -> None:
+    """Queues the images an import left in `result.pending_images`."""
+    enqueue_images(result.pending_images)
+    result.pending_images = []
+
+
+def claim_jobs(limit: int) -> List[ImageSyncJob]:
+    """
+    Marks up to `limit` due jobs as running and returns them. Claims are
+    serialized, so several workers never claim the same job; a variant whose
+    previous job is still running waits.
+    """
+    with serialized(QUEUE_LOCK_NAME):
+        jobs = claim_due(ImageSyncJob, ('product_id', 'source_id'), limit, order_by=('available_at', 'pk'))
+
+    products = Product.objects.in_bulk({job.product_id for job in jobs})
+    # Товар могли удалить (вместе с задачей) между выборкой и загрузкой
+    jobs = [job for job in jobs if job.product_id in products]
+    for job in jobs:
+        job.product = products[job.product_id]
+    return jobs
+
+
+def process_job(job: ImageSyncJob) -> bool:
+    """Runs one claimed job; returns True when all images are in sync."""
+    from products.utils import save_images  # локальный импорт на всякий
+
+    try:
+        errors = save_images(job.product, job.images)
+    except Exception as e:
+        errors = [f"{type(e).__name__}: {e}"]
+
+    if not errors:
+        job.delete()
+        return True
+
+    reschedule(job, "\n".join(errors), getattr(settings, "MOYSKLAD_IMAGE_JOB_MAX_ATTEMPTS", 5))
+    return False
+
+
+def drain_image_queue(workers: int = 4, batch: int = 50, max_jobs=None, log=print) -> Dict[str, int]:
+    """
+    Processes due jobs until the queue has none left (or `max_jobs` are done).
+    With `workers=1` jobs run in the calling thread and its DB connection.
+    """
+    stats = {"done": 0, "failed": 0}
+
+    def run(job):
+        try:
+            return process_job(job)
+        finally:
+            connection.close()
+
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-queue") if workers > 1 else None
+    try:
+        while max_jobs is None or stats["done"] + stats["failed"] < max_jobs:
+            limit = batch if max_jobs is None else min(batch, max_jobs - stats["done"] - stats["failed"])
+            jobs = claim_jobs(limit)
+            if not jobs:
+                break
+            for ok in (pool.map(run, jobs) if pool else map(process_job, jobs)):
+                stats["done" if ok else "failed"] += 1
+            log(f"Image jobs: done={stats['done']} failed={stats['failed']}")
+    finally:
+        if pool:
+            pool.shutdown()
+    return stats
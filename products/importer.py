@@ -0,0 +1,392 @@
+"""
+Set-based import of Moysklad product rows.
+
+`import_product_rows` applies a whole page of `entity/product` rows with a
+handful of queries: dimensions (categories, colors, weights) come from an
+in-memory `DimensionCache`, Products and ProductPrices are upserted with
+`bulk_create`/`bulk_update` and the M2M links are inserted in one statement.
+The business rules are the ones the per-row import always had (row validation
+lives in `classify_row`, which the invalid products report uses too):
+
+  - the name must look like 'Name, Color, Weight' and salePrices[0] is required;
+  - the Product (by title) is upserted and made public for every such row;
+  - a ProductPrice (by guid) is written only when color, weight and guid exist.
+
+Rows whose fingerprint (`row_fingerprint`) matches the stored
+`ProductPrice.content_hash` are not written again, but every price a page
+mentions gets its `last_seen_at` bumped in one UPDATE (see `mark_seen`).
+"""
+import hashlib
+import json
+import uuid
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from modeltranslation.utils import build_localized_fieldname, get_language
+
+from products.dimensions import DimensionCache, shared_dimensions
+from products.models import Product, ProductPrice, ProductShots
+
+DEFAULT_CATEGORY_PATH = 'Default Category'
+
+
+@dataclass
+class ParsedProductRow:
+    index: int
+    title: str
+    color: Optional[str]
+    weight: Optional[str]
+    guid: Optional[str]
+    amount: float
+    artikul: Optional[str]
+    external_code: Optional[str]
+    description: str
+    category_path: str
+    images: Dict[str, Any]
+
+
+@dataclass
+class PageImportResult:
+    results: List[bool] = field(default_factory=list)
+    # (Product, images) to download once the page's transaction is committed.
+    pending_images: List[tuple] = field(default_factory=list)
+    # Of the ok rows: prices written vs. skipped because nothing changed.
+    changed: int = 0
+    unchanged: int = 0
+    # (index, reason) of the rows that can't produce a ProductPrice (see classify_row).
+    issues: List[Tuple[int, str]] = field(default_factory=list)
+
+    @property
+    def ok(self) -> int:
+        return sum(1 for result in self.results if result)
+
+    @property
+    def err(self) -> int:
+        return len(self.results) - self.ok
+
+
+def extract_name_color_weight(product_name):
+    parts = product_name.split(', ')
+    name = parts[0] if len(parts) > 0 else ''
+    color = parts[1] if len(parts) > 1 else None
+    weight = parts[2] if len(parts) > 2 else None
+    return name, color, weight
+
+
+# Why a row gives no ProductPrice; the same texts go to the invalid products report.
+ISSUE_NAME_FORMAT = "Некорректный формат имени: ожидается 'Name, Color, Weight'"
+ISSUE_NO_PRICE = "Отсутствует цена (salePrices[0].value)"
+ISSUE_NO_GUID = "Отсутствует id (guid)"
+ISSUE_NO_COLOR_WEIGHT = "Нет color и/или weight в имени"
+
+_SKIP_MESSAGES = {
+    ISSUE_NAME_FORMAT: "is invalid or incomplete.",
+    ISSUE_NO_PRICE: "has no salePrices.",
+}
+
+
+def classify_row(index: int, item: Dict[str, Any]) -> Tuple[Optional[ParsedProductRow], Optional[str]]:
+    """
+    The import's validation rules, shared with the invalid products report.
+    Returns the parsed row (None when the row is skipped altogether) and the
+    reason it won't produce a ProductPrice (None for a fully importable row).
+    """
+    product_name = item.get('name') or ''
+    if len(product_name.split(",")) < 3:
+        return None, ISSUE_NAME_FORMAT
+
+    sale_prices = item.get('salePrices') or []
+    if not sale_prices or not sale_prices[0].get('value'):
+        return None, ISSUE_NO_PRICE
+
+    name, color, weight = extract_name_color_weight(product_name)
+    row = ParsedProductRow(
+        index=index,
+        title=name.strip(),
+        color=color.strip() if color else None,
+        weight=weight.strip() if weight else None,
+        guid=item.get('id'),
+        amount=sale_prices[0]['value'] / 100.0,
+        artikul=item.get('code'),
+        external_code=item.get('externalCode'),
+        description=item.get('description', ''),
+        category_path=item.get('pathName', DEFAULT_CATEGORY_PATH),
+        images=item.get('images') or {},
+    )
+    if not row.guid:
+        return row, ISSUE_NO_GUID
+    if not row.color or not row.weight:
+        return row, ISSUE_NO_COLOR_WEIGHT
+    return row, None
+
+
+def _upsert_products(rows: List[ParsedProductRow], categories, log=print) -> Tuple[Dict[str, Product], Set[str]]:
+    # Как и update_or_create: при повторе названия на странице побеждает последняя строка.
+    category_by_title = {row.title: categories[row.category_path] for row in rows}
+
+    existing: Dict[str, List[Product]] = {}
+    for product in Product.objects.filter(title__in=category_by_title.keys()):
+        existing.setdefault(product.title, []).append(product)
+
+    products: Dict[str, Product] = {}
+    to_update = []
+    for title, category in category_by_title.items():
+        matches = existing.get(title)
+        if not matches:
+            continue
+        if len(matches) > 1:
+            log(f"Several products titled '{title}' exist; rows skipped.")
+            continue
+        product = matches[0]
+        products[title] = product
+        if product.category_id == (category.pk if category else None) and product.public:
+            continue
+        product.category = category
+        product.public = True
+        to_update.append(product)
+    if to_update:
+        Product.objects.bulk_update(to_update, ['category', 'public'])
+
+    new_titles = [title for title in category_by_title if title not in existing]
+    if new_titles:
+        Product.objects.bulk_create([
+            Product(title=title, category=category_by_title[title], public=True)
+            for title in new_titles
+        ])
+        for product in Product.objects.filter(title__in=new_titles):
+            products.setdefault(product.title, product)
+    return products, set(new_titles)
+
+
+def _image_identity(images: Dict[str, Any]) -> List[Any]:
+    # Без expand=images есть только количество; с ним — id и время правки каждого снимка
+    identity: List[Any] = [(images.get('meta') or {}).get('size')]
+    for image in images.get('rows') or []:
+        href = (image.get('meta') or {}).get('href') or ''
+        identity.append([href.rsplit('/', 1)[-1], image.get('updated')])
+    return identity
+
+
+def row_fingerprint(row: ParsedProductRow) -> str:
+    """Hash of everything a row writes (the language too: only its translation is written)."""
+    payload = [
+        row.title, row.category_path, row.color, row.weight, row.amount,
+        row.artikul, row.external_code, row.description, get_language(),
+        _image_identity(row.images),
+    ]
+    return hashlib.sha1(json.dumps(payload, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def _price_update_fields() -> List[str]:
+    # update_or_create трогает только перевод текущего языка, остальные не затираем.
+    # Остаток ведёт импорт остатков: при обновлении цены его не сбрасываем.
+    return [
+        'weight', 'color', 'amount', 'artikul', 'external_code', 'description',
+        build_localized_fieldname('description', get_language()), 'content_hash',
+    ]
+
+
+def _upsert_prices(rows, weights, colors) -> Dict[str, int]:
+    prices: Dict[str, ProductPrice] = {}
+    for row in rows:
+        prices[row.guid] = ProductPrice(
+            guid=row.guid,
+            weight=weights[row.weight],
+            color=colors[row.color],
+            amount=row.amount,
+            stock=0,
+            artikul=row.artikul,
+            external_code=row.external_code,
+            description=row.description,
+            content_hash=row_fingerprint(row),
+        )
+    ProductPrice.objects.bulk_create(
+        prices.values(),
+        update_conflicts=True,
+        unique_fields=['guid'],
+        update_fields=_price_update_fields(),
+    )
+    return {
+        str(guid): pk
+        for guid, pk in ProductPrice.objects.filter(guid__in=prices.keys()).values_list('guid', 'pk')
+    }
+
+
+def _apply_rows(
+    rows: List[ParsedProductRow], dimensions: DimensionCache, log=print,
+) -> Tuple[Dict[int, Product], Set[int]]:
+    """
+    Writes the parsed rows; returns the Product of every row it could place
+    and the indexes of the priced rows skipped because their fingerprint
+    matched and their product already existed (nothing to sync for them).
+    """
+    categories = dimensions.categories(row.category_path for row in rows)
+    weights = dimensions.weights(row.weight for row in rows if row.weight)
+    colors = dimensions.colors(row.color for row in rows if row.color)
+    products, created = _upsert_products(rows, categories, log)
+
+    priced = []
+    for row in rows:
+        if row.title not in products:
+            continue
+        if row.weight and row.color and row.guid:
+            priced.append(row)
+        else:
+            log(f"Skip price: guid/weight/color missing for product '{row.title}'")
+
+    # Цена с тем же отпечатком уже записана — её не перезаписываем
+    price_ids: Dict[str, int] = {}
+    stored: Dict[str, Optional[str]] = {}
+    for guid, pk, content_hash in ProductPrice.objects.filter(
+        guid__in={row.guid for row in priced}
+    ).values_list('guid', 'pk', 'content_hash'):
+        price_ids[str(guid)] = pk
+        stored[str(guid)] = content_hash
+    changed = [row for row in priced if stored.get(str(uuid.UUID(str(row.guid)))) != row_fingerprint(row)]
+    if changed:
+        price_ids.update(_upsert_prices(changed, weights, colors))
+
+    # Связь же ставим всегда: товар могли удалить и создать заново (например, в админке)
+    through = Product.price.through
+    links = []
+    for row in priced:
+        price_id = price_ids.get(str(uuid.UUID(str(row.guid))))
+        if price_id:
+            links.append(through(product_id=products[row.title].pk, productprice_id=price_id))
+    through.objects.bulk_create(links, ignore_conflicts=True)
+    placed = {row.index: products[row.title] for row in rows if row.title in products}
+    written = {row.index for row in changed}
+    unchanged = {row.index for row in priced if row.index not in written and row.title not in created}
+    return placed, unchanged
+
+
+def mark_seen(items: List[Dict[str, Any]]) -> int:
+    """Stamps `last_seen_at` on the ProductPrices of these rows, valid or not."""
+    guids = []
+    for item in items:
+        try:
+            guids.append(uuid.UUID(str(item.get('id'))))
+        except ValueError:
+            continue
+    if not guids:
+        return 0
+    return ProductPrice.objects.filter(guid__in=guids).update(last_seen_at=timezone.now())
+
+
+def import_product_rows(
+    items: List[Dict[str, Any]],
+    *,
+    with_images: bool = True,
+    write_lock=None,
+    dimensions: Optional[DimensionCache] = None,
+    log: Callable[[str], None] = print,
+) -> PageImportResult:
+    """
+    Imports one page of Moysklad product rows in a single transaction.
+    `results[i]` is True when items[i] produced a ProductPrice.
+
+    If the page as a whole fails to write, rows are retried one by one so a
+    single bad row doesn't cost the rest of the page.
+
+    Parallel callers pass a shared `write_lock`: it serializes the short DB
+    write phase (so two pages never create the same title/color twice)
+    while network work such as image downloads stays concurrent.
+
+    Categories, colors and weights are resolved through `dimensions`
+    (the process-wide cache unless an import passes its own).
+
+    Per-row messages (invalid rows, skipped prices) go to `log`.
+    """
+    dimensions = dimensions or shared_dimensions
+    result = PageImportResult(results=[False] * len(items))
+    rows = []
+    for i, item in enumerate(items):
+        row, reason = classify_row(i, item)
+        if reason:
+            result.issues.append((i, reason))
+        if row is None:
+            log(f"Product: {item.get('name') or ''} {_SKIP_MESSAGES[reason]}")
+        else:
+            rows.append(row)
+
+    with write_lock or nullcontext():
+        # Строка есть в МоёмСкладе — цену не зачищаем, даже если строка пропущена
+        mark_seen(items)
+        if not rows:
+            return result
+        try:
+            with transaction.atomic():
+                placed, unchanged = _apply_rows(rows, dimensions, log)
+        except Exception as e:
+            # Возможно, в кэше запись, удалённая в обход импорта
+            dimensions.invalidate()
+            if len(rows) == 1:
+                log(f"Failed to import product '{rows[0].title}': {e}")
+                return result
+            log(f"Bulk import of page failed ({e}); retrying rows one by one.")
+            placed, unchanged = {}, set()
+            for row in rows:
+                try:
+                    with transaction.atomic():
+                        row_placed, row_unchanged = _apply_rows([row], dimensions, log)
+                    placed.update(row_placed)
+                    unchanged |= row_unchanged
+                except Exception as row_exc:
+                    log(f"Failed to import product '{row.title}': {row_exc}")
+
+    result.unchanged = len(unchanged)
+    for row in rows:
+        if row.index in placed:
+            result.results[row.index] = bool(row.weight and row.color and row.guid)
+            # Снимки входят в отпечаток: у неизменной строки синхронизировать нечего.
+            # И без картинок: снимки, удалённые в МоёмСкладе, тоже надо убрать.
+            if row.index not in unchanged and row.images.get('meta'):
+                result.pending_images.append((placed[row.index], row.images))
+
+    result.changed = result.ok - result.unchanged
+    if with_images:
+        dispatch_pending_images(result)
+    return result
+
+
+def queue_pending_images(result: PageImportResult) -> None:
+    """
+    With MOYSKLAD_IMAGE_QUEUE moves the page's images into the download queue.
+    Best called inside the page's transaction, so jobs commit with the rows.
+    """
+    if getattr(settings, 'MOYSKLAD_IMAGE_QUEUE', False):
+        from products.image_queue import enqueue_pending_images
+
+        enqueue_pending_images(result)
+
+
+def dispatch_pending_images(result: PageImportResult) -> None:
+    """Queues the page's images (MOYSKLAD_IMAGE_QUEUE) or syncs them right away."""
+    queue_pending_images(result)
+    save_pending_images(result)
+
+
+def save_pending_images(result: PageImportResult) -> None:
+    """
+    Syncs images of an imported page (only new/changed ones are downloaded).
+    Callers that wrap the import in their own transaction pass
+    `with_images=False` and call this (or `dispatch_pending_images`) after commit.
+    """
+    from products.utils import save_images
+
+    shots: Dict[int, List[ProductShots]] = {}
+    products = {product.pk for product, _ in result.pending_images}
+    for shot in ProductShots.objects.filter(product_id__in=products):
+        shots.setdefault(shot.product_id, []).append(shot)
+
+    for product, images in result.pending_images:
+        # Картинки не критичны — ошибки не должны валить импорт.
+        try:
+            save_images(product, images, shots=shots.setdefault(product.pk, []))
+        except Exception as e:
+            print(f"Failed to save images for product '{product.title}': {e}")
+    result.pending_images = []
@@ -0,0 +1,53 @@
+"""
+Process-wide "only one of us runs" locks for long management commands.
+"""
+import fcntl
+import os
+import tempfile
+import zlib
+
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+
+
+class InstanceLock:
+    """
+    Keeps a second instance of a long run from starting: a PostgreSQL session
+    advisory lock on a dedicated connection (released if the process dies), or
+    a file lock on other backends (single-host development setups).
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._connection = None
+        self._file = None
+
+    def acquire(self) -> bool:
+        if connection.vendor == 'postgresql':
+            # Отдельное соединение: close_old_connections() не должен снять блокировку
+            self._connection = connections.create_connection(DEFAULT_DB_ALIAS)
+            with self._connection.cursor() as cursor:
+                cursor.execute("SELECT pg_try_advisory_lock(%s)", [zlib.crc32(self.name.encode())])
+                acquired = cursor.fetchone()[0]
+            if not acquired:
+                self._connection.close()
+                self._connection = None
+            return acquired
+
+        path = os.path.join(tempfile.gettempdir(), f"{self.name.replace(':', '_')}.lock")
+        self._file = open(path, "w")
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._file.close()
+            self._file = None
+            return False
+        return True
+
+    def release(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
@@ -0,0 +1,151 @@
+"""
+Report of Moysklad products that can't be imported, for the content managers.
+
+Rows are judged by `importer.classify_row` — the rules the import itself
+applies — so `import_products --invalid-report` can build the report during
+its normal pass instead of a second crawl by `report_invalid_products`.
+
+Problem rows are written to the CSV as soon as their page is classified
+(gzip-compressed when the file name ends with .gz) and the e-mail attaches
+that file, so memory use doesn't grow with the catalog.
+"""
+import csv
+import gzip
+import os
+import threading
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.mail import EmailMessage
+
+from products.importer import classify_row, extract_name_color_weight
+
+REPORT_FIELDS = [
+    "page", "index", "reason",
+    "name_raw", "name", "color", "weight",
+    "guid", "code", "external_code",
+    "path_name", "price_value",
+]
+
+EMAIL_SUBJECT = "Проблемные товары (отчёт МоЙСклад)"
+EMAIL_BODY = (
+    "Добрый день!\n\n"
+    "Во вложении список товаров, требующих правок на стороне МоЙСклад.\n"
+    "Столбец 'reason' поясняет проблему по каждому товару.\n\n"
+    "С уважением,\nВаш автоматический отчёт"
+)
+
+
+def default_outfile(compress: bool = False) -> str:
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return f"/tmp/invalid_products_{stamp}.csv" + (".gz" if compress else "")
+
+
+def issue_fields(item: Dict[str, Any]) -> Dict[str, Any]:
+    name = (item.get("name") or "").strip()
+    parsed_name, color, weight = extract_name_color_weight(name)
+    sale_prices = item.get("salePrices") or []
+    return {
+        "name_raw": name,
+        "name": parsed_name.strip(),
+        "color": color.strip() if color else color,
+        "weight": weight.strip() if weight else weight,
+        "guid": item.get("id"),
+        "code": item.get("code"),
+        "external_code": item.get("externalCode"),
+        "path_name": item.get("pathName"),
+        "price_value": sale_prices[0].get("value") if sale_prices else None,
+    }
+
+
+class InvalidProductsReport:
+    """
+    Streams problem rows of one run into `path`; pages may be added from
+    several threads (rows keep their page/index columns, not page order).
+    The file is only created once there is a problem to report.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.compressed = path.endswith(".gz")
+        self.problems = 0
+        self.seen = 0
+        self._file = None
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def _open(self) -> None:
+        if self.compressed:
+            self._file = gzip.open(self.path, "wt", newline="", encoding="utf-8")
+        else:
+            self._file = open(self.path, "w", newline="", encoding="utf-8")
+        self._writer = csv.DictWriter(self._file, fieldnames=REPORT_FIELDS)
+        self._writer.writeheader()
+
+    def add_page(self, page: int, items: List[Dict[str, Any]], issues: Iterable[Tuple[int, str]],
+                 seen: Optional[int] = None) -> None:
+        """
+        Adds a page already classified by the import (`PageImportResult.issues`);
+        `seen` is how many of `items` were checked (all by default).
+        """
+        problems = [
+            {"page": page, "index": index, "reason": reason, **issue_fields(items[index])}
+            for index, reason in issues
+        ]
+        with self._lock:
+            self.seen += len(items) if seen is None else seen
+            if not problems:
+                return
+            if self._writer is None:
+                self._open()
+            self._writer.writerows(problems)
+            self.problems += len(problems)
+
+    def check_page(self, page: int, items: List[Dict[str, Any]]) -> None:
+        """Classifies a page that isn't being imported."""
+        issues = []
+        for index, item in enumerate(items):
+            _, reason = classify_row(index, item)
+            if reason:
+                issues.append((index, reason))
+        self.add_page(page, items, issues)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = self._writer = None
+
+    def send_email(self, to: str, subject: str = EMAIL_SUBJECT) -> None:
+        msg = EmailMessage(
+            subject=subject,
+            body=EMAIL_BODY,
+            from_email=getattr(settings, "DEFAULT_FROM_EMAIL", None),
+            to=[to],
+        )
+        msg.attach_file(self.path, mimetype="application/gzip" if self.compressed else "text/csv")
+        msg.send(fail_silently=False)
+
+
+def deliver_report(command, report: InvalidProductsReport, email_to=None,
+                   email_subject: str = EMAIL_SUBJECT) -> None:
+    """Closes the CSV (and e-mails it) with the management command's output."""
+    report.close()
+    if not report.problems:
+        command.stdout.write(command.style.SUCCESS(
+            f"Проблем не найдено среди {report.seen} товаров. CSV не создавался."
+        ))
+        return
+
+    size_kb = os.path.getsize(report.path) / 1024
+    command.stdout.write(command.style.SUCCESS(
+        f"Нашли проблемных товаров: {report.problems} из {report.seen} просмотренных. "
+        f"CSV сохранён: {report.path} ({size_kb:.0f} KB)"
+    ))
+    if email_to:
+        try:
+            report.send_email(email_to, email_subject)
+            command.stdout.write(command.style.SUCCESS(f"E-mail отправлен на {email_to}"))
+        except Exception as e:
+            command.stderr.write(command.style.ERROR(f"Не удалось отправить e-mail: {e}"))
@@ -0,0 +1,100 @@
+"""
+What the DB-backed queues (webhook_inbox, image_queue) have in common.
+
+A queue row is `pending` until a worker claims it (`running`, one attempt
+used), then is deleted when done or put back as `pending` with exponential
+backoff; after the last attempt it stays as `failed` (the dead letters).
+A `running` row whose worker died is claimed again after RUNNING_LEASE.
+
+Claims and enqueues of one queue run under `serialized(name)`: one thread
+of this process and, on PostgreSQL, one process at a time. So the `busy`
+set of a claim always sees what the other claimers marked running, and an
+enqueue never merges into a row that a claimer has already read.
+"""
+import threading
+import zlib
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import Dict, List, Optional, Sequence
+
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+# A `running` row whose worker died is picked up again after this long.
+RUNNING_LEASE = timedelta(minutes=10)
+RETRY_BASE_DELAY = timedelta(seconds=30)
+
+_process_locks: Dict[str, threading.Lock] = {}
+_process_locks_guard = threading.Lock()
+
+
+def _process_lock(name: str) -> threading.Lock:
+    with _process_locks_guard:
+        return _process_locks.setdefault(name, threading.Lock())
+
+
+@contextmanager
+def serialized(name: str):
+    """A transaction holding the queue lock `name` until it ends."""
+    with _process_lock(name), transaction.atomic():
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", [zlib.crc32(name.encode())])
+        yield
+
+
+def claim_due(model, key_fields: Sequence[str], limit: int, order_by: Sequence[str] = ('pk',)) -> List:
+    """
+    Marks up to `limit` due rows of `model` as running and returns them, at
+    most one per key (the first in `order_by`), skipping keys whose row is
+    still running. Call it inside `serialized()`.
+    """
+    now = timezone.now()
+    due = model.objects.filter(
+        Q(status=model.PENDING, available_at__lte=now)
+        | Q(status=model.RUNNING, updated_at__lt=now - RUNNING_LEASE)
+    ).order_by(*order_by)
+    busy = set(
+        model.objects.filter(status=model.RUNNING, updated_at__gte=now - RUNNING_LEASE)
+        .values_list(*key_fields)
+    )
+    claimed = []
+    for row in due[:limit * 2]:
+        key = tuple(getattr(row, field) for field in key_fields)
+        if key not in busy and len(claimed) < limit:
+            busy.add(key)
+            claimed.append(row)
+    model.objects.filter(pk__in=[row.pk for row in claimed]).update(
+        status=model.RUNNING, attempts=F('attempts') + 1, updated_at=now
+    )
+    for row in claimed:
+        row.status = model.RUNNING
+        row.attempts += 1
+        row.updated_at = now
+    return claimed
+
+
+def reschedule(row, last_error: str, max_attempts: int, retry_after: Optional[float] = None) -> str:
+    """
+    Puts a failed running row back as pending after exponential backoff, or
+    marks it failed after the last attempt. With `retry_after` (the remote
+    side is down) it waits that long and the attempt doesn't count.
+    Returns the new status.
+    """
+    model = type(row)
+    row.last_error = last_error
+    if retry_after is not None:
+        row.status = model.PENDING
+        row.attempts -= 1
+        row.available_at = timezone.now() + timedelta(seconds=retry_after)
+    elif row.attempts >= max_attempts:
+        row.status = model.FAILED
+    else:
+        row.status = model.PENDING
+        row.available_at = timezone.now() + RETRY_BASE_DELAY * 2 ** (row.attempts - 1)
+    model.objects.filter(pk=row.pk, status=model.RUNNING).update(
+        status=row.status, available_at=row.available_at, last_error=row.last_error,
+        attempts=row.attempts, updated_at=timezone.now(),
+    )
+    return row.status
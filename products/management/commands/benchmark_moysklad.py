@@ -0,0 +1,183 @@
+import contextlib
+import io
+import resource
+import tempfile
+import time
+import tracemalloc
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import override_settings
+from requests.adapters import HTTPAdapter
+from rest_framework.test import APIRequestFactory
+
+from products.models import ImageSyncJob, ProductPrice, ProductShots
+from products.moysklad_client import moysklad_client
+from products.moysklad_fake import FakeCatalog, FakeMoyskladAdapter
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the Moysklad integration offline against a synthetic catalog "
+        "(rate limits, latency and failures are simulated). "
+        "By default every DB change and saved file is discarded afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--products", type=int, default=1000, help="Размер синтетического каталога.")
+        parser.add_argument("--images", type=int, default=1, help="Картинок на товар.")
+        parser.add_argument("--image-bytes", type=int, default=50 * 1024, help="Размер одной картинки (байт).")
+        parser.add_argument("--latency", type=float, default=0.05, help="Задержка ответа фейкового API (сек).")
+        parser.add_argument("--error-rate-429", type=float, default=0.0, help="Доля ответов 429.")
+        parser.add_argument("--error-rate-5xx", type=float, default=0.0, help="Доля ответов 503.")
+        parser.add_argument("--workers", type=int, default=1, help="Передать --workers в import_products.")
+        parser.add_argument("--stocks", action="store_true", help="Также прогнать import_stocks.")
+        parser.add_argument(
+            "--webhook-events",
+            type=int,
+            default=0,
+            help="Отправить N событий UPDATE в вебхук товаров после импорта.",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--keep",
+            action="store_true",
+            help="Не откатывать изменения в БД (файлы картинок всё равно пишутся во временную папку).",
+        )
+
+    def handle(self, *args, **options):
+        if options["workers"] > 1 and not options["keep"]:
+            raise CommandError(
+                "--workers > 1 commits from worker threads and cannot be rolled back; "
+                "pass --keep and run against a scratch database."
+            )
+        catalog = FakeCatalog(
+            size=options["products"],
+            images_per_product=options["images"],
+            image_bytes=options["image_bytes"],
+        )
+        fake = FakeMoyskladAdapter(
+            catalog,
+            latency=options["latency"],
+            error_rate_429=options["error_rate_429"],
+            error_rate_5xx=options["error_rate_5xx"],
+            seed=options["seed"],
+        )
+        moysklad_client.mount(fake)
+        moysklad_client.metrics.reset()
+        budget_rps = fake.max_requests_per_window / fake.window_seconds
+
+        self.stdout.write(self.style.NOTICE(
+            f"Каталог: {catalog.size} товаров, {catalog.images_per_product} фото по {catalog.image_bytes} байт, "
+            f"latency={fake.latency}s, бюджет {budget_rps:.0f} req/s"
+        ))
+
+        tracemalloc.start()
+        try:
+            with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+                try:
+                    # С --keep потоки должны видеть (и писать) данные сразу — общей транзакции нет.
+                    with transaction.atomic() if not options["keep"] else contextlib.nullcontext():
+                        self._run_phases(options, catalog, fake, budget_rps)
+                        if not options["keep"]:
+                            raise _Rollback()
+                except _Rollback:
+                    self.stdout.write("Изменения в БД откатены.")
+        finally:
+            tracemalloc.stop()
+            moysklad_client.mount(HTTPAdapter())
+
+    def _run_phases(self, options, catalog, fake, budget_rps):
+        self._phase(
+            "import_products",
+            lambda: call_command(
+                "import_products", workers=options["workers"], restart=True,
+                stdout=io.StringIO(), stderr=io.StringIO(),
+            ),
+            catalog.size,
+            fake,
+            budget_rps,
+        )
+        if ImageSyncJob.objects.exists():
+            self._phase(
+                "process_image_queue",
+                lambda: call_command(
+                    # Потоки пишут через свои соединения — без --keep только в одном потоке.
+                    "process_image_queue", workers=4 if options["keep"] else 1,
+                    stdout=io.StringIO(), stderr=io.StringIO(),
+                ),
+                ImageSyncJob.objects.count(),
+                fake,
+                budget_rps,
+            )
+        self.stdout.write(
+            f"  в БД: prices={ProductPrice.objects.count()} shots={ProductShots.objects.count()}"
+        )
+
+        if options["stocks"]:
+            self._phase(
+                "import_stocks",
+                lambda: call_command("import_stocks", stdout=io.StringIO(), stderr=io.StringIO()),
+                catalog.size,
+                fake,
+                budget_rps,
+            )
+
+        events = options["webhook_events"]
+        if events:
+            self._phase("webhook", lambda: self._post_webhook(catalog, events), events, fake, budget_rps)
+
+    def _post_webhook(self, catalog, count):
+        from products.views import MoyskladProductAPIView
+
+        payload = {
+            "events": [
+                {
+                    "meta": {"type": "product", "href": catalog.product_href(i % catalog.size)},
+                    "action": "UPDATE",
+                }
+                for i in range(count)
+            ]
+        }
+        request = APIRequestFactory().post("/api/v1/moysklad/", payload, format="json")
+        # Без окна склейки: события должны быть готовы к обработке сразу
+        with override_settings(MOYSKLAD_WEBHOOK_COALESCE_SECONDS=0):
+            response = MoyskladProductAPIView.as_view()(request)
+        self.stdout.write(f"  webhook status={response.status_code} {dict(response.data)}")
+        if response.status_code == 202:
+            # События легли в inbox — применяем их, как это сделал бы воркер
+            call_command("process_webhook_events", workers=1, stdout=io.StringIO(), stderr=io.StringIO())
+
+    def _phase(self, name, run, rows, fake, budget_rps):
+        before = moysklad_client.metrics.totals()
+        fake_before = dict(fake.stats)
+        tracemalloc.reset_peak()
+        started = time.monotonic()
+        # Импорт печатает построчный прогресс через print() — глушим его.
+        with contextlib.redirect_stdout(io.StringIO()):
+            run()
+        elapsed = time.monotonic() - started
+        _, peak = tracemalloc.get_traced_memory()
+        after = moysklad_client.metrics.totals()
+        delta = {key: after[key] - before[key] for key in after}
+        served = fake.stats["requests"] - fake_before["requests"]
+        rps = served / elapsed if elapsed else 0.0
+        maxrss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+        self.stdout.write(self.style.SUCCESS(f"[{name}] {elapsed:.1f}s, {rows / elapsed if elapsed else 0:.1f} rows/s"))
+        self.stdout.write(
+            f"  requests={served} ({rps:.1f} req/s, {rps / budget_rps:.0%} of budget) "
+            f"429={fake.stats['rate_limited'] - fake_before['rate_limited']} "
+            f"5xx={fake.stats['injected_errors'] - fake_before['injected_errors']} "
+            f"retries={delta['retries']:.0f}"
+        )
+        self.stdout.write(
+            f"  throttle_wait={delta['throttle_wait']:.1f}s gate_wait={delta['gate_wait']:.1f}s "
+            f"network={delta['network_seconds']:.1f}s"
+        )
+        self.stdout.write(f"  memory: python_peak={peak / 1024 / 1024:.1f}MB maxrss={maxrss_mb:.1f}MB")
@@ -1,34 +1,75 @@
-import sys
+import math
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
 
-from products.moysklad_client import moysklad_client, MoyskladClientError
+from products.dimensions import DimensionCache
+from products.instance_lock import InstanceLock
+from products.models import ImportJob
+from products.moysklad_client import (
+    moysklad_client, MoyskladClientError, MoyskladCircuitOpenError, MAX_EXPAND_PAGE_SIZE,
+)
 
-from products.utils import create_or_update_product
+from products.importer import import_product_rows, queue_pending_images, save_pending_images
+from products.invalid_report import EMAIL_SUBJECT, InvalidProductsReport, default_outfile, deliver_report
+from products.utils import PRODUCT_EXPAND_PARAMS
+from products.sync import format_moment, sweep_unseen_prices, sync_products_delta
 
 API_URL = "https://api.moysklad.ru/api/remap/1.2/entity/product"
+LOCK_NAME = "products:import_products"
+
+# Сколько страниц подряд может не загрузиться, прежде чем импорт остановится
+MAX_CONSECUTIVE_FAILED_PAGES = 3
 
 
-def get_data(page: int, limit: int):
+def iter_pages(start_page: int, limit: int, prefetch: int = 1):
     """
-    Возвращает JSON с товарами.
+    Лениво отдаёт страницы товаров, подгружая следующие в фоне.
     """
-    params = {
-        "limit": limit,
-        "offset": page * limit,
-    }
-    return moysklad_client.get_json(API_URL, params=params)
+    return moysklad_client.iter_pages(
+        API_URL,
+        PRODUCT_EXPAND_PARAMS,
+        page_size=limit,
+        start_offset=start_page * limit,
+        prefetch=prefetch,
+    )
+
+
+def get_page(page: int, limit: int):
+    return moysklad_client.get_page(API_URL, PRODUCT_EXPAND_PARAMS, page_size=limit, offset=page * limit)
+
+
+def find_unfinished_job(limit, target_name):
+    """
+    Последний незавершённый запуск с теми же параметрами — его и продолжаем.
+    Вызывается под блокировкой LOCK_NAME, так что RUNNING здесь — оборванный процесс.
+    """
+    return (
+        ImportJob.objects
+        .filter(kind='products', status__in=[ImportJob.RUNNING, ImportJob.FAILED],
+                params={"limit": limit, "name": target_name})
+        .order_by('-started_at')
+        .first()
+    )
 
 
 class Command(BaseCommand):
-    help = "Import products with resume support via --start-page and --start-index"
+    help = (
+        "Import products from Moysklad. Every run is recorded as an ImportJob and checkpointed "
+        "after each page; an interrupted run is resumed automatically by starting the command again."
+    )
 
     def add_arguments(self, parser):
         parser.add_argument(
             "--start-page",
             type=int,
             default=0,
-            help="С какой страницы (offset/limit) начать. По умолчанию 0.",
+            help="С какой страницы (offset/limit) начать новый запуск. По умолчанию 0.",
         )
         parser.add_argument(
             "--start-index",
@@ -39,14 +80,51 @@ class Command(BaseCommand):
         parser.add_argument(
             "--limit",
             type=int,
-            default=1000,
-            help="Сколько записей запрашивать за страницу. По умолчанию 1000.",
+            default=MAX_EXPAND_PAGE_SIZE,
+            help=f"Сколько записей запрашивать за страницу (с expand=images не больше {MAX_EXPAND_PAGE_SIZE}). "
+                 f"По умолчанию {MAX_EXPAND_PAGE_SIZE}.",
         )
         parser.add_argument(
             "--sleep",
             type=float,
             default=0.0,
-            help="Пауза (сек) между элементами для снижения нагрузки/ограничений API.",
+            help="Пауза (сек) между страницами для снижения нагрузки/ограничений API.",
+        )
+        parser.add_argument(
+            "--prefetch",
+            type=int,
+            default=1,
+            help="Сколько следующих страниц подгружать в фоне, пока обрабатывается текущая. По умолчанию 1.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Сколько страниц загружать и обрабатывать параллельно (потоки делят общий лимит запросов МоЙСклад). "
+                 "По умолчанию 1.",
+        )
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="Не продолжать незавершённый запуск, а начать новый.",
+        )
+        parser.add_argument(
+            "--progress-interval",
+            type=float,
+            default=10.0,
+            help="Как часто (сек) печатать строку прогресса. По умолчанию 10.",
+        )
+        parser.add_argument(
+            "--no-sweep",
+            action="store_true",
+            help="После полного импорта не удалять цены, которых больше нет в МоёмСкладе "
+                 "(и не снимать с публикации товары без цен).",
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="Загрузить только товары, изменённые (или удалённые) после прошлой синхронизации. "
+                 "Первый запуск делает полный обход и запоминает отметку времени.",
         )
         parser.add_argument(
             "--name",
@@ -55,102 +133,359 @@ class Command(BaseCommand):
             help="Начало названия товара для импорта (если указано, импортируются все товары, названия которых начинаются с этой строки).",
         )
 
+        parser.add_argument(
+            "--invalid-report",
+            nargs="?",
+            const="",
+            default=None,
+            metavar="OUTFILE",
+            help="Попутно собрать CSV проблемных товаров (как report_invalid_products, но без второго обхода). "
+                 "Без пути файл создаётся во временной папке; имя на .gz — файл сжимается gzip. "
+                 "В отчёт попадают страницы этого запуска.",
+        )
+        parser.add_argument(
+            "--email-to",
+            type=str,
+            default=None,
+            help="Отправить CSV проблемных товаров на этот e-mail (вместе с --invalid-report).",
+        )
+        parser.add_argument(
+            "--email-subject",
+            type=str,
+            default=EMAIL_SUBJECT,
+            help="Тема письма с отчётом.",
+        )
+
     def handle(self, *args, **options):
+        # Один запуск за раз: иначе два процесса продолжат одну и ту же ImportJob
+        lock = InstanceLock(LOCK_NAME)
+        if not lock.acquire():
+            raise CommandError("import_products уже запущен в другом процессе — дождитесь его завершения.")
+        try:
+            self._handle(options)
+        finally:
+            lock.release()
+
+    def _handle(self, options):
         limit = options["limit"]
-        if limit > 1000:
-            raise CommandError("Moysklad API does not allow limit > 1000.")
+        if limit > MAX_EXPAND_PAGE_SIZE:
+            raise CommandError(f"Moysklad API does not allow limit > {MAX_EXPAND_PAGE_SIZE} with expand.")
         page = options["start_page"]
         index = options["start_index"]
         sleep_between = options["sleep"]
         target_name = options["name"]
+        prefetch = options["prefetch"]
+        workers = options["workers"]
+        self.verbosity = options["verbosity"]
+        self.progress_interval = options["progress_interval"]
 
-        total_ok = 0
-        total_err = 0
-        found_target = False
-
-        import_mode = "specific product" if target_name else "all products"
-        self.stdout.write(self.style.NOTICE(
-            f"Старт импорта ({import_mode}): page={page} index={index} limit={limit}"
-        ))
+        self.found_target = False
+        self.found_count = 0
 
-        while True:
-            # Загрузка страницы
-            try:
-                data = get_data(page, limit)
-            except MoyskladClientError as e:
-                self.stderr.write(self.style.ERROR(
-                    f"Ошибка загрузки данных со страницы {page}: {e}"
-                ))
-                self.stderr.write("Подсказка для продолжения:\n"
-                                  f"python manage.py import_products --start-page {page} --start-index {index} --limit {limit}")
-                # Прерываем — чтобы можно было продолжить с тех же параметров
-                sys.exit(2)
-
-            rows = data.get("rows", []) or []
-            if not rows:
-                # Данные закончились
-                break
-
-            # Перебор элементов внутри страницы (с учётом возможного резюма)
-            for i in range(index, len(rows)):
-                item = rows[i]
-                item_name = item.get('name', '')
-
-                # Если указано конкретное название, проверяем частичное совпадение (начинается с)
-                if target_name and not item_name.startswith(target_name):
-                    continue
+        if options["email_to"] and options["invalid_report"] is None:
+            raise CommandError("--email-to requires --invalid-report.")
+        self.report = None
+        if options["invalid_report"] is not None:
+            self.report = InvalidProductsReport(options["invalid_report"] or default_outfile())
 
-                try:
-                    ok = create_or_update_product(item)  # True/False
-                    if ok:
-                        total_ok += 1
-                        if target_name:
-                            found_target = True
-                            self.stdout.write(self.style.SUCCESS(
-                                f"Найден и импортирован товар: {item_name}"
-                            ))
-                    else:
-                        total_err += 1
-                except Exception as e:
-                    total_err += 1
-                    self.stderr.write(self.style.ERROR(
-                        f"[page={page} idx={i}] Ошибка обработки товара: {e}"
-                    ))
-
-                # Прогресс + точная подсказка, как продолжить
-                # (если оборвётся — возобновите со следующим индексом)
-                resume_cmd = f"RESUME: python manage.py import_products --start-page {page} --start-index {i+1} --limit {limit}"
-                if target_name:
-                    resume_cmd += f" --name '{target_name}'"
-
-                self.stdout.write(
-                    f"[page={page} idx={i}] ok={total_ok} err={total_err} | {resume_cmd}"
+        if options["incremental"]:
+            if target_name or page or index or workers > 1 or self.report:
+                raise CommandError(
+                    "--incremental cannot be combined with --name/--start-page/--start-index/--workers/--invalid-report."
                 )
+            self._run_incremental(limit)
+            return
 
-                if sleep_between > 0:
-                    time.sleep(sleep_between)
+        job = None
+        if not (options["restart"] or page or index):
+            job = find_unfinished_job(limit, target_name)
+        if job:
+            job.status = ImportJob.RUNNING
+            job.finished_at = None
+            job.save()
+            self.stdout.write(self.style.NOTICE(
+                f"Продолжаем импорт #{job.pk}: готово страниц {len(job.completed_pages)}, "
+                f"не загружено {len(job.failed_pages)}, ok={job.ok_count} err={job.err_count}"
+            ))
+        else:
+            job = ImportJob.objects.create(kind='products', params={"limit": limit, "name": target_name})
+        self.job = job
+        self.job_lock = threading.Lock()
+        # Категории/цвета/веса загружаются один раз на весь запуск
+        self.dimensions = DimensionCache()
+        self.run_started = time.monotonic()
+        self.run_rows = 0
+        self.last_progress = self.run_started
 
-            # Продолжаем поиск всех подходящих товаров
+        import_mode = "specific product" if target_name else "all products"
+        self.stdout.write(self.style.NOTICE(
+            f"Старт импорта #{job.pk} ({import_mode}): page={page} index={index} limit={limit} workers={workers}"
+        ))
 
-            # Следующая страница; внутри страницы начинаем с 0
-            page += 1
-            index = 0
+        try:
+            if workers > 1:
+                self._run_parallel(page, index, limit, target_name, sleep_between, workers)
+            else:
+                self._run_sequential(page, index, limit, target_name, sleep_between, prefetch)
+        except BaseException as e:
+            # Ctrl+C, недоступный МойСклад и т.п.: всё закоммиченное уже в чекпоинте
+            job.status = ImportJob.FAILED
+            if not isinstance(e, (KeyboardInterrupt, CommandError)):
+                job.add_errors([f"{type(e).__name__}: {e}"])
+            job.save()
+            raise
+        finally:
+            # Иначе при ошибке .csv.gz останется недописанным и нечитаемым
+            if self.report:
+                self.report.close()
 
-            # Если вернулась неполная страница — вероятно, дальше данных нет
-            if len(rows) < limit:
-                break
+        job.status = ImportJob.FAILED if job.failed_pages else ImportJob.COMPLETED
+        job.finished_at = timezone.now()
+        job.save()
+        self._progress(force=True)
+
+        if not options["no_sweep"] and not (target_name or page or index) and self._covered_all_pages():
+            sweep_unseen_prices(job.started_at, log=self.stdout.write)
 
         # Финальное сообщение
+        if job.failed_pages:
+            self.stderr.write(self.style.ERROR(
+                f"Не загружены страницы: {sorted(job.failed_pages)}. "
+                "Запустите команду ещё раз с теми же параметрами — догрузятся только они."
+            ))
         if target_name:
-            if found_target:
+            if self.found_target:
                 self.stdout.write(self.style.SUCCESS(
-                    f"Найдено и импортировано товаров серии '{target_name}': {total_ok}"
+                    f"Найдено и импортировано товаров серии '{target_name}': {self.found_count}"
                 ))
             else:
                 self.stdout.write(self.style.WARNING(
-                    f"Товары серии '{target_name}' не найдены среди {total_ok + total_err} просмотренных товаров."
+                    f"Товары серии '{target_name}' не найдены среди {job.rows_processed} просмотренных товаров."
                 ))
         else:
             self.stdout.write(self.style.SUCCESS(
-                f"Импорт завершён. Итог: ok={total_ok}, err={total_err}"
+                f"Импорт #{job.pk} завершён. Итог: ok={job.ok_count} "
+                f"(изменено={job.changed_count}, без изменений={job.unchanged_count}), err={job.err_count}"
             ))
+        if self.report:
+            deliver_report(self, self.report, options["email_to"], options["email_subject"])
+        stats = self.dimensions.stats
+        self.stdout.write(
+            f"Справочники (категории/цвета/веса): из кэша={stats['hits']} "
+            f"не найдено в кэше={stats['misses']} создано={stats['created']}"
+        )
+
+        self.stdout.write(moysklad_client.metrics_summary())
+
+    def _run_incremental(self, limit):
+        # Запуск виден в админке рядом с полными импортами (продолжать его нечего — это делает отметка времени)
+        job = ImportJob.objects.create(kind='products_incremental', params={"limit": limit})
+        try:
+            result = sync_products_delta(limit=limit, log=self.stdout.write)
+        except MoyskladClientError as e:
+            job.status = ImportJob.FAILED
+            job.add_errors([f"{type(e).__name__}: {e}"])
+            job.finished_at = timezone.now()
+            job.save()
+            # Отметка времени сдвигается вместе с каждой страницей — повторный запуск продолжит с места обрыва.
+            raise CommandError(f"Ошибка инкрементальной синхронизации: {e}")
+        job.status = ImportJob.COMPLETED
+        job.rows_processed = result.ok + result.err
+        job.ok_count = result.ok
+        job.err_count = result.err
+        job.changed_count = result.changed
+        job.unchanged_count = result.unchanged
+        job.finished_at = timezone.now()
+        job.save()
+        watermark = format_moment(result.watermark) if result.watermark else "-"
+        self.stdout.write(self.style.SUCCESS(
+            f"{'Полная' if result.full else 'Инкрементальная'} синхронизация завершена: "
+            f"pages={result.pages} ok={result.ok} (changed={result.changed} unchanged={result.unchanged}) "
+            f"err={result.err} "
+            f"archived={result.archived} deleted={result.deleted} watermark={watermark}"
+        ))
+        self.stdout.write(moysklad_client.metrics_summary())
+
+    def _import_page(self, page, rows, index, target_name, fetch_seconds=0.0, write_lock=None):
+        """
+        Импортирует одну страницу одним пакетом и в той же транзакции сохраняет чекпоинт.
+        """
+        # Элементы страницы (с учётом возможного резюма) и их позиции на странице
+        positions = [
+            i for i in range(index, len(rows))
+            # Если указано конкретное название, проверяем частичное совпадение (начинается с)
+            if not target_name or (rows[i].get('name') or '').startswith(target_name)
+        ]
+        batch = [rows[i] for i in positions]
+
+        # Построчные сообщения импорта — в ImportJob (и на экран при --verbosity 2)
+        messages = []
+
+        def log(message):
+            messages.append(message)
+            if self.verbosity > 1:
+                self.stdout.write(message)
+
+        started = time.monotonic()
+        try:
+            with write_lock or nullcontext(), transaction.atomic():
+                result = import_product_rows(batch, with_images=False, dimensions=self.dimensions, log=log)
+                queue_pending_images(result)
+                with self.job_lock:
+                    self.job.record_page(page, len(batch), result.ok, result.err,
+                                         fetch_seconds, time.monotonic() - started,
+                                         changed=result.changed, unchanged=result.unchanged)
+                    self.job.add_errors(messages)
+                    self.job.save()
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"[page={page}] Ошибка обработки страницы: {e}"))
+            with self.job_lock:
+                self.job.record_failed_page(page, f"[page={page}] {type(e).__name__}: {e}")
+                self.job.save()
+            return
+
+        if self.report:
+            self.report.add_page(page, rows, [(positions[i], reason) for i, reason in result.issues], len(batch))
+        # Без очереди картинки качаются сразу, уже после коммита страницы
+        save_pending_images(result)
+        for item, ok in zip(batch, result.results):
+            if target_name and ok:
+                self.found_target = True
+                self.found_count += 1
+                self.stdout.write(self.style.SUCCESS(f"Найден и импортирован товар: {item.get('name', '')}"))
+        self.run_rows += len(batch)
+        self._progress()
+
+    def _covered_all_pages(self):
+        """Зачистка безопасна, только если этот импорт прошёл все страницы каталога."""
+        job = self.job
+        if job.failed_pages or not job.total_rows:
+            return False
+        pages = math.ceil(job.total_rows / job.params['limit'])
+        return set(range(pages)) <= set(job.completed_pages)
+
+    def _page_failed(self, page, error):
+        self.stderr.write(self.style.ERROR(f"Ошибка загрузки данных со страницы {page}: {error}"))
+        with self.job_lock:
+            self.job.record_failed_page(page, f"[page={page}] {error}")
+            self.job.save()
+
+    def _progress(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_progress < self.progress_interval:
+            return
+        self.last_progress = now
+        job = self.job
+        elapsed = now - self.run_started
+        rate = self.run_rows / elapsed if elapsed else 0.0
+        line = f"[import #{job.pk}] pages={len(job.completed_pages)}"
+        if job.total_rows:
+            line += f"/{math.ceil(job.total_rows / job.params['limit'])}"
+        line += (f" rows={job.rows_processed} ok={job.ok_count} (changed={job.changed_count} "
+                 f"unchanged={job.unchanged_count}) err={job.err_count} "
+                 f"failed_pages={len(job.failed_pages)} | {rate:.1f} rows/s")
+        if job.total_rows and rate:
+            remaining = max(job.total_rows - job.rows_processed, 0)
+            line += f", осталось ~{remaining / rate:.0f}s"
+        self.stdout.write(line)
+
+    def _set_total(self, size):
+        if size is not None:
+            with self.job_lock:
+                self.job.total_rows = size
+
+    def _run_sequential(self, page, index, limit, target_name, sleep_between, prefetch):
+        completed = set(self.job.completed_pages)
+        if completed:
+            # Сначала добираем пропуски (упавшие страницы), потом продолжаем с конца
+            resume_page = max(completed) + 1
+            for gap in sorted(set(range(page, resume_page)) - completed):
+                try:
+                    started = time.monotonic()
+                    current = get_page(gap, limit)
+                except MoyskladClientError as e:
+                    self._page_failed(gap, e)
+                    continue
+                self._set_total(current.size)
+                self._import_page(gap, current.rows, 0, target_name, time.monotonic() - started)
+            page, index = resume_page, 0
+
+        consecutive_failures = 0
+        while True:
+            pages = iter_pages(page, limit, prefetch)
+            try:
+                while True:
+                    # Загрузка страницы (следующие уже грузятся в фоне)
+                    started = time.monotonic()
+                    current = next(pages, None)
+                    if current is None:
+                        # Данные закончились (неполная страница завершает итератор сама)
+                        return
+                    page = current.offset // limit
+                    self._set_total(current.size)
+                    self._import_page(page, current.rows, index, target_name, time.monotonic() - started)
+                    consecutive_failures = 0
+                    if sleep_between > 0:
+                        time.sleep(sleep_between)
+                    # Следующая страница; внутри страницы начинаем с 0
+                    page += 1
+                    index = 0
+            except MoyskladClientError as e:
+                self._page_failed(page, e)
+                consecutive_failures += 1
+                if isinstance(e, MoyskladCircuitOpenError) or consecutive_failures >= MAX_CONSECUTIVE_FAILED_PAGES:
+                    raise CommandError(
+                        f"МойСклад недоступен ({e}). Прогресс сохранён — повторный запуск продолжит импорт."
+                    )
+                # Пропускаем страницу (она догрузится при следующем запуске) и идём дальше
+                page += 1
+                index = 0
+
+    def _run_parallel(self, start_page, index, limit, target_name, sleep_between, workers):
+        completed = set(self.job.completed_pages)
+
+        # Первая страница заодно сообщает общий размер каталога (meta.size)
+        try:
+            started = time.monotonic()
+            first = get_page(start_page, limit)
+            first_fetch = time.monotonic() - started
+        except MoyskladClientError as e:
+            self._page_failed(start_page, e)
+            raise CommandError(f"Ошибка загрузки данных со страницы {start_page}: {e}")
+
+        total_rows = first.size if first.size is not None else first.offset + len(first.rows)
+        self._set_total(total_rows)
+        last_page = max(math.ceil(total_rows / limit) - 1, start_page)
+        pending_pages = [p for p in range(start_page, last_page + 1) if p not in completed]
+        self.stdout.write(
+            f"Всего товаров: {total_rows}, страниц к обработке: {len(pending_pages)} "
+            f"(уже готово: {len(completed)})"
+        )
+
+        # Запись в БД сериализуем, сеть (страницы, картинки) идёт параллельно
+        write_lock = threading.Lock()
+
+        def work(page):
+            try:
+                if page == start_page:
+                    rows, fetch_seconds = first.rows, first_fetch
+                else:
+                    started = time.monotonic()
+                    rows = get_page(page, limit).rows
+                    fetch_seconds = time.monotonic() - started
+                self._import_page(
+                    page, rows, index if page == start_page else 0, target_name, fetch_seconds, write_lock
+                )
+                if sleep_between > 0:
+                    time.sleep(sleep_between)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="import-products") as pool:
+            futures = {pool.submit(work, page): page for page in pending_pages}
+            for future in as_completed(futures):
+                page = futures[future]
+                try:
+                    future.result()
+                except MoyskladClientError as e:
+                    self._page_failed(page, e)
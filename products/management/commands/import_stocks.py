@@ -1,31 +1,44 @@
-from django.core.management.base import BaseCommand
-from products.utils import update_stock
-from products.moysklad_client import moysklad_client, MoyskladClientError
+from django.core.management.base import BaseCommand, CommandError
 
-API_URL = "https://api.moysklad.ru/api/remap/1.2/report/stock/all"
-
-
-def get_data(page):
-    params = {
-        "limit": 1000,
-        "offset": page * 1000,
-    }
-    return moysklad_client.get_json(API_URL, params=params)
-
-
-def parse_and_save_products(json_response):
-    for item in json_response['rows']:
-        update_stock(item)
+from products.moysklad_client import moysklad_client, MoyskladClientError, MAX_PAGE_SIZE
+from products.stocks import sync_stocks_delta, sync_stocks_full
 
 
 class Command(BaseCommand):
     help = 'Import product stocks'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit",
+            type=int,
+            default=MAX_PAGE_SIZE,
+            help=f"Строк отчёта на страницу (максимум {MAX_PAGE_SIZE}).",
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help=(
+                "Загрузить только остатки, изменившиеся с прошлого запуска "
+                "(report/stock/all/current?changedSince). Без сохранённой отметки — полный проход."
+            ),
+        )
+
     def handle(self, *args, **options):
-        for i in range(2):
-            try:
-            data = get_data(i)
-            except MoyskladClientError as exc:
-                self.stderr.write(self.style.ERROR(f"Не удалось загрузить остатки (страница {i}): {exc}"))
-                break
-            parse_and_save_products(data)
+        try:
+            if options["incremental"]:
+                result = sync_stocks_delta(log=self.stdout.write)
+            else:
+                result = sync_stocks_full(min(options["limit"], MAX_PAGE_SIZE), log=self.stdout.write)
+        except MoyskladClientError as exc:
+            # Обнулять «пропавшие» товары после неполного прохода нельзя — остатки не трогаем
+            self.stdout.write(moysklad_client.metrics_summary())
+            raise CommandError(f"Не удалось загрузить остатки: {exc}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Остатки: строк={result.rows} обновлено={result.updated} без изменений={result.unchanged} "
+            f"не найдено={result.missing} обнулено={result.zeroed}"
+        ))
+        self.stdout.write(
+            f"Время: загрузка {result.fetch_seconds:.2f}s, запись {result.write_seconds:.2f}s"
+        )
+        self.stdout.write(moysklad_client.metrics_summary())
@@ -0,0 +1,68 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from products.image_queue import drain_image_queue
+from products.models import ImageSyncJob
+from products.moysklad_client import moysklad_client
+
+
+class Command(BaseCommand):
+    help = "Download queued product images from Moysklad (see MOYSKLAD_IMAGE_QUEUE)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Сколько картинок качать параллельно (общий лимит запросов МоЙСклад соблюдается). По умолчанию 4.",
+        )
+        parser.add_argument(
+            "--batch",
+            type=int,
+            default=50,
+            help="Сколько задач забирать из очереди за раз. По умолчанию 50.",
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Не завершаться, когда очередь пуста, а проверять её каждые --poll-interval секунд.",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=5.0,
+            help="Пауза (сек) между проверками пустой очереди в режиме --loop. По умолчанию 5.",
+        )
+        parser.add_argument(
+            "--retry-failed",
+            action="store_true",
+            help="Вернуть в очередь задачи, исчерпавшие попытки (status=failed).",
+        )
+
+    def handle(self, *args, **options):
+        if options["retry_failed"]:
+            count = ImageSyncJob.objects.filter(status=ImageSyncJob.FAILED).update(
+                status=ImageSyncJob.PENDING, attempts=0, available_at=timezone.now()
+            )
+            self.stdout.write(f"Возвращено в очередь задач: {count}")
+
+        self.stdout.write(self.style.NOTICE(
+            f"Очередь картинок: pending={ImageSyncJob.objects.filter(status=ImageSyncJob.PENDING).count()} "
+            f"failed={ImageSyncJob.objects.filter(status=ImageSyncJob.FAILED).count()} workers={options['workers']}"
+        ))
+
+        done = failed = 0
+        while True:
+            stats = drain_image_queue(
+                workers=options["workers"], batch=options["batch"], log=self.stdout.write
+            )
+            done += stats["done"]
+            failed += stats["failed"]
+            if not options["loop"]:
+                break
+            time.sleep(options["poll_interval"])
+
+        self.stdout.write(self.style.SUCCESS(f"Готово: done={done} failed={failed}"))
+        self.stdout.write(moysklad_client.metrics_summary())
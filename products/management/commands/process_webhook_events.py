@@ -0,0 +1,70 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from products.models import WebhookEvent
+from products.moysklad_client import moysklad_client
+from products.webhook_inbox import DONE, FAILED, RETRY, drain_webhook_inbox
+
+
+class Command(BaseCommand):
+    help = "Apply Moysklad webhook events stored in the inbox (see MOYSKLAD_WEBHOOK_INBOX)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Сколько событий обрабатывать параллельно (общий лимит запросов МоЙСклад соблюдается). По умолчанию 4.",
+        )
+        parser.add_argument(
+            "--batch",
+            type=int,
+            default=400,
+            help="Сколько событий забирать из очереди за раз (товары загружаются пачками по 100). По умолчанию 400.",
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Не завершаться, когда очередь пуста, а проверять её каждые --poll-interval секунд.",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=2.0,
+            help="Пауза (сек) между проверками пустой очереди в режиме --loop. По умолчанию 2.",
+        )
+        parser.add_argument(
+            "--retry-failed",
+            action="store_true",
+            help="Вернуть в очередь события, исчерпавшие попытки (status=failed).",
+        )
+
+    def handle(self, *args, **options):
+        if options["retry_failed"]:
+            count = WebhookEvent.objects.filter(status=WebhookEvent.FAILED).update(
+                status=WebhookEvent.PENDING, attempts=0, available_at=timezone.now()
+            )
+            self.stdout.write(f"Возвращено в очередь событий: {count}")
+
+        self.stdout.write(self.style.NOTICE(
+            f"Очередь вебхуков: pending={WebhookEvent.objects.filter(status=WebhookEvent.PENDING).count()} "
+            f"failed={WebhookEvent.objects.filter(status=WebhookEvent.FAILED).count()} workers={options['workers']}"
+        ))
+
+        totals = {DONE: 0, RETRY: 0, FAILED: 0}
+        while True:
+            stats = drain_webhook_inbox(
+                workers=options["workers"], batch=options["batch"], log=self.stdout.write
+            )
+            for key, value in stats.items():
+                totals[key] += value
+            if not options["loop"]:
+                break
+            time.sleep(options["poll_interval"])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Готово: done={totals[DONE]} retry={totals[RETRY]} failed={totals[FAILED]}"
+        ))
+        self.stdout.write(moysklad_client.metrics_summary())
@@ -1,126 +1,33 @@
-import csv
-import io
-import sys
-from datetime import datetime
+import math
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-from django.core.mail import EmailMessage
 from django.core.management.base import BaseCommand, CommandError
-from django.conf import settings
 
+from products.invalid_report import EMAIL_SUBJECT, InvalidProductsReport, default_outfile, deliver_report
 from products.moysklad_client import moysklad_client, MoyskladClientError
 
 API_URL = "https://api.moysklad.ru/api/remap/1.2/entity/product"
 
 
-def fetch_page(page: int, limit: int):
-    params = {
-        "limit": limit,
-        "offset": page * limit,
-    }
-    return moysklad_client.get_json(API_URL, params=params)
-
-
-def classify_issue(item):
-    """
-    Возвращает (is_problem, reason, parsed_fields_dict)
-    Логика синхронизирована с create_or_update_product:
-      - имя должно иметь формат 'Name, Color, Weight'
-      - должны быть salePrices[0].value
-      - должен быть id (guid)
-      - нужны и color, и weight для цены
-    """
-    name = (item.get("name") or "").strip()
-    path_name = item.get("pathName")
-    code = item.get("code")
-    external_code = item.get("externalCode")
-    guid = item.get("id")
-
-    # sale price
-    sale_prices = item.get("salePrices") or []
-    price_value = None
-    if sale_prices:
-        price_value = sale_prices[0].get("value")
-
-    # parse name
-    parts = name.split(",")
-    parts = [p.strip() for p in parts if p is not None]
-
-    parsed_name = parts[0] if len(parts) > 0 else ""
-    parsed_color = parts[1] if len(parts) > 1 else None
-    parsed_weight = parts[2] if len(parts) > 2 else None
-
-    # выявление проблем
-    if len(parts) < 3:
-        return True, "Некорректный формат имени: ожидается 'Name, Color, Weight'", {
-            "name_raw": name,
-            "name": parsed_name,
-            "color": parsed_color,
-            "weight": parsed_weight,
-            "guid": guid,
-            "code": code,
-            "external_code": external_code,
-            "path_name": path_name,
-            "price_value": price_value,
-        }
-
-    if not price_value:
-        return True, "Отсутствует цена (salePrices[0].value)", {
-            "name_raw": name,
-            "name": parsed_name,
-            "color": parsed_color,
-            "weight": parsed_weight,
-            "guid": guid,
-            "code": code,
-            "external_code": external_code,
-            "path_name": path_name,
-            "price_value": price_value,
-        }
-
-    if not guid:
-        return True, "Отсутствует id (guid)", {
-            "name_raw": name,
-            "name": parsed_name,
-            "color": parsed_color,
-            "weight": parsed_weight,
-            "guid": guid,
-            "code": code,
-            "external_code": external_code,
-            "path_name": path_name,
-            "price_value": price_value,
-        }
+def iter_pages(start_page: int, limit: int, max_pages=None, prefetch: int = 1):
+    return moysklad_client.iter_pages(
+        API_URL,
+        page_size=limit,
+        start_offset=start_page * limit,
+        max_pages=max_pages,
+        prefetch=prefetch,
+    )
 
-    # Для создания цены в текущей логике нужны оба поля
-    if not parsed_color or not parsed_weight:
-        return True, "Нет color и/или weight в имени", {
-            "name_raw": name,
-            "name": parsed_name,
-            "color": parsed_color,
-            "weight": parsed_weight,
-            "guid": guid,
-            "code": code,
-            "external_code": external_code,
-            "path_name": path_name,
-            "price_value": price_value,
-        }
 
-    # Всё ок — проблем нет
-    return False, "", {
-        "name_raw": name,
-        "name": parsed_name,
-        "color": parsed_color,
-        "weight": parsed_weight,
-        "guid": guid,
-        "code": code,
-        "external_code": external_code,
-        "path_name": path_name,
-        "price_value": price_value,
-    }
+def get_page(page: int, limit: int):
+    return moysklad_client.get_page(API_URL, page_size=limit, offset=page * limit)
 
 
 class Command(BaseCommand):
     help = (
         "Собирает полный список проблемных товаров из МоЙСклад и сохраняет в CSV. "
-        "Опционально отправляет CSV на e-mail."
+        "Опционально отправляет CSV на e-mail. Тот же отчёт строит import_products --invalid-report "
+        "без отдельного обхода каталога."
     )
 
     def add_arguments(self, parser):
@@ -132,11 +39,29 @@ class Command(BaseCommand):
             default=None,
             help="Максимум страниц для обхода. По умолчанию идём до конца данных.",
         )
+        parser.add_argument(
+            "--prefetch",
+            type=int,
+            default=1,
+            help="Сколько следующих страниц подгружать в фоне (default: 1).",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Сколько страниц загружать параллельно (под общим лимитом запросов МоЙСклад). По умолчанию 1.",
+        )
         parser.add_argument(
             "--outfile",
             type=str,
             default=None,
-            help="Путь к CSV-файлу для сохранения. По умолчанию создаёт имя с датой во временной папке.",
+            help="Путь к CSV-файлу для сохранения (на .gz — сжимается gzip). "
+                 "По умолчанию создаёт имя с датой во временной папке.",
+        )
+        parser.add_argument(
+            "--gzip",
+            action="store_true",
+            help="Сжать CSV gzip (к имени файла добавится .gz).",
         )
         parser.add_argument(
             "--email-to",
@@ -147,7 +72,7 @@ class Command(BaseCommand):
         parser.add_argument(
             "--email-subject",
             type=str,
-            default="Проблемные товары (отчёт МоЙСклад)",
+            default=EMAIL_SUBJECT,
             help="Тема письма (если отправляем e-mail).",
         )
 
@@ -159,107 +84,64 @@ class Command(BaseCommand):
         max_pages = options["max_pages"]
         email_to = options["email_to"]
         email_subject = options["email_subject"]
+        prefetch = options["prefetch"]
 
-        # Имя файла по умолчанию
-        if options["outfile"]:
-            outfile = options["outfile"]
-        else:
-            stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            outfile = f"/tmp/invalid_products_{stamp}.csv"
+        outfile = options["outfile"] or default_outfile()
+        if options["gzip"] and not outfile.endswith(".gz"):
+            outfile += ".gz"
 
         self.stdout.write(self.style.NOTICE(
-            f"Формируем отчёт: start_page={page}, limit={limit}, outfile={outfile}"
+            f"Формируем отчёт: start_page={page}, limit={limit}, workers={options['workers']}, outfile={outfile}"
         ))
 
-        problems = []
-        pages_processed = 0
-        total_seen = 0
-
-        while True:
-            if max_pages is not None and pages_processed >= max_pages:
-                break
-
-            try:
-                data = fetch_page(page, limit)
-            except MoyskladClientError as e:
-                self.stderr.write(self.style.ERROR(f"Ошибка загрузки страницы {page}: {e}"))
-                break
-
-            rows = data.get("rows") or []
-            if not rows:
-                break
-
-            for idx, item in enumerate(rows):
-                total_seen += 1
-                is_problem, reason, fields = classify_issue(item)
-                if is_problem:
-                    problems.append({
-                        "page": page,
-                        "index": idx,
-                        "reason": reason,
-                        **fields,
-                    })
-
-            # Если последняя страница неполная — дальше данных нет
-            page += 1
-            pages_processed += 1
-            if len(rows) < limit:
-                break
-
-        # Пишем CSV
-        if problems:
-            fieldnames = [
-                "page", "index", "reason",
-                "name_raw", "name", "color", "weight",
-                "guid", "code", "external_code",
-                "path_name", "price_value",
-            ]
-            with open(outfile, "w", newline="", encoding="utf-8") as f:
-                writer = csv.DictWriter(f, fieldnames=fieldnames)
-                writer.writeheader()
-                for row in problems:
-                    writer.writerow(row)
-
-            self.stdout.write(self.style.SUCCESS(
-                f"Готово. Нашли проблемных товаров: {len(problems)} из {total_seen} просмотренных. "
-                f"CSV сохранён: {outfile}"
-            ))
-        else:
-            self.stdout.write(self.style.SUCCESS(
-                f"Проблем не найдено среди {total_seen} товаров. CSV не создавался."
-            ))
-
-        # Отправка e-mail (опционально)
-        if email_to and problems:
-            try:
-                # Формируем CSV в памяти для вложения
-                mem = io.StringIO()
-                fieldnames = [
-                    "page", "index", "reason",
-                    "name_raw", "name", "color", "weight",
-                    "guid", "code", "external_code",
-                    "path_name", "price_value",
-                ]
-                writer = csv.DictWriter(mem, fieldnames=fieldnames)
-                writer.writeheader()
-                for row in problems:
-                    writer.writerow(row)
-                mem.seek(0)
-
-                msg = EmailMessage(
-                    subject=email_subject,
-                    body=(
-                        "Добрый день!\n\n"
-                        "Во вложении список товаров, требующих правок на стороне МоЙСклад.\n"
-                        "Столбец 'reason' поясняет проблему по каждому товару.\n\n"
-                        "С уважением,\nВаш автоматический отчёт"
-                    ),
-                    from_email=getattr(settings, "DEFAULT_FROM_EMAIL", None),
-                    to=[email_to],
-                )
-                msg.attach(filename="invalid_products.csv", content=mem.getvalue(), mimetype="text/csv")
-                msg.send(fail_silently=False)
-
-                self.stdout.write(self.style.SUCCESS(f"E-mail отправлен на {email_to}"))
-            except Exception as e:
-                self.stderr.write(self.style.ERROR(f"Не удалось отправить e-mail: {e}"))
+        report = InvalidProductsReport(outfile)
+        try:
+            if options["workers"] > 1:
+                self._run_parallel(report, page, limit, max_pages, options["workers"])
+            else:
+                for current in iter_pages(page, limit, max_pages, prefetch):
+                    current_page = current.offset // limit
+                    report.check_page(current_page, current.rows)
+                    page = current_page + 1
+        except MoyskladClientError as e:
+            self.stderr.write(self.style.ERROR(f"Ошибка загрузки страницы {page}: {e}"))
+        finally:
+            report.close()
+
+        deliver_report(self, report, email_to, email_subject)
+        self.stdout.write(moysklad_client.metrics_summary())
+
+    def _run_parallel(self, report, start_page, limit, max_pages, workers):
+        """
+        Страницы грузятся параллельно, но в работе одновременно не больше 2 * workers —
+        обработанные страницы сразу уходят в файл, и память не растёт с каталогом.
+        """
+        first = get_page(start_page, limit)
+        report.check_page(start_page, first.rows)
+        total = first.size if first.size is not None else first.offset + len(first.rows)
+        last_page = max(math.ceil(total / limit) - 1, start_page)
+        if max_pages is not None:
+            last_page = min(last_page, start_page + max_pages - 1)
+        pages = iter(range(start_page + 1, last_page + 1))
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="invalid-report") as pool:
+            in_flight = {}
+            while True:
+                while len(in_flight) < workers * 2:
+                    page = next(pages, None)
+                    if page is None:
+                        break
+                    in_flight[pool.submit(get_page, page, limit)] = page
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    page = in_flight.pop(future)
+                    try:
+                        report.check_page(page, future.result().rows)
+                    except MoyskladClientError as e:
+                        failed.append(page)
+                        self.stderr.write(self.style.ERROR(f"Ошибка загрузки страницы {page}: {e}"))
+        if failed:
+            self.stderr.write(self.style.ERROR(f"Отчёт неполный, не загружены страницы: {sorted(failed)}"))
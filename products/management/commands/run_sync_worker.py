@@ -0,0 +1,143 @@
+import signal
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from products.image_queue import drain_image_queue
+from products.instance_lock import InstanceLock
+from products.moysklad_client import moysklad_client, MoyskladCircuitOpenError
+from products.stocks import sync_stocks_delta
+from products.sync import sync_products_delta
+from products.webhook_inbox import drain_webhook_inbox
+
+LOCK_NAME = "products:run_sync_worker"
+
+
+class Command(BaseCommand):
+    help = (
+        "Long-running Moysklad sync worker: periodic incremental product and stock syncs "
+        "plus the webhook and image queues, sharing one client and its rate limits"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Потоков для очередей вебхуков и картинок (общий лимит запросов МоЙСклад соблюдается). По умолчанию 4.",
+        )
+        parser.add_argument(
+            "--products-interval",
+            type=float,
+            default=300.0,
+            help="Интервал (сек) инкрементальной синхронизации товаров. 0 — не запускать. По умолчанию 300.",
+        )
+        parser.add_argument(
+            "--stocks-interval",
+            type=float,
+            default=60.0,
+            help="Интервал (сек) инкрементальной синхронизации остатков. 0 — не запускать. По умолчанию 60.",
+        )
+        parser.add_argument(
+            "--webhook-batch",
+            type=int,
+            default=400,
+            help="Сколько событий вебхуков забирать из очереди за раз. По умолчанию 400.",
+        )
+        parser.add_argument(
+            "--image-batch",
+            type=int,
+            default=50,
+            help="Сколько задач картинок забирать из очереди за раз. По умолчанию 50.",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=2.0,
+            help="Пауза (сек), когда делать нечего. По умолчанию 2.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Один проход (синхронизации и очереди до опустошения) и выход.",
+        )
+
+    def handle(self, *args, **options):
+        lock = InstanceLock(LOCK_NAME)
+        if not lock.acquire():
+            raise CommandError("run_sync_worker уже запущен (блокировка занята)")
+
+        self.stopping = threading.Event()
+        previous = {sig: signal.signal(sig, self._request_stop) for sig in (signal.SIGTERM, signal.SIGINT)}
+        # Задача -> (интервал, когда запускать в следующий раз)
+        self.schedule = {
+            "products": [options["products_interval"], 0.0],
+            "stocks": [options["stocks_interval"], 0.0],
+        }
+        self.stdout.write(self.style.NOTICE(
+            f"Sync worker started: products every {options['products_interval']:g}s, "
+            f"stocks every {options['stocks_interval']:g}s, workers={options['workers']}"
+        ))
+        try:
+            while not self.stopping.is_set():
+                close_old_connections()
+                busy = self._run_due_syncs()
+                busy = self._drain_queues(options) or busy
+                if not busy:
+                    if options["once"]:
+                        break
+                    self.stopping.wait(options["poll_interval"])
+        finally:
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+            lock.release()
+
+        self.stdout.write(self.style.SUCCESS("Sync worker stopped"))
+        self.stdout.write(moysklad_client.metrics_summary())
+
+    def _request_stop(self, signum, frame):
+        # Текущая пачка дорабатывает, новые не берём
+        self.stdout.write(f"Получен сигнал {signal.Signals(signum).name}, завершаемся после текущей пачки")
+        self.stopping.set()
+
+    def _run_due_syncs(self) -> bool:
+        # Полный проход может идти долго: по сигналу останавливаемся между страницами
+        jobs = {
+            "products": lambda: sync_products_delta(log=self.stdout.write, stop=self.stopping.is_set),
+            "stocks": lambda: sync_stocks_delta(log=self.stdout.write, stop=self.stopping.is_set),
+        }
+        ran = False
+        for name, run in jobs.items():
+            interval, due_at = self.schedule[name]
+            if interval <= 0 or time.monotonic() < due_at or self.stopping.is_set():
+                continue
+            ran = True
+            delay = interval
+            try:
+                run()
+            except MoyskladCircuitOpenError as exc:
+                delay = max(exc.retry_after, 1.0)
+                self.stderr.write(f"[{name}] МойСклад недоступен, повтор через {delay:.0f}s: {exc}")
+            except Exception as exc:
+                # Отметки времени не сдвинулись — следующий запуск повторит изменения
+                self.stderr.write(f"[{name}] ошибка синхронизации: {exc}")
+            self.schedule[name][1] = time.monotonic() + delay
+        return ran
+
+    def _drain_queues(self, options) -> bool:
+        """One batch of each queue per call, so a stop request waits for one batch at most."""
+        webhooks = drain_webhook_inbox(
+            workers=options["workers"], batch=options["webhook_batch"],
+            max_events=options["webhook_batch"], log=self.stdout.write,
+        )
+        images = drain_image_queue(
+            workers=options["workers"], batch=options["image_batch"],
+            max_jobs=options["image_batch"], log=self.stdout.write,
+        )
+        # Полная пачка — в очереди, скорее всего, есть ещё
+        return (
+            sum(webhooks.values()) >= options["webhook_batch"]
+            or sum(images.values()) >= options["image_batch"]
+        )
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.16 on 2026-10-19 10:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0112_alter_productcolor_name_alter_productprice_artikul_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=100, unique=True)),
+                ('watermark', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.16 on 2026-10-19 11:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0113_syncstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productshots',
+            name='moysklad_id',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='productshots',
+            name='moysklad_product_id',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='productshots',
+            name='moysklad_signature',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
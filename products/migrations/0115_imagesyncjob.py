@@ -0,0 +1,33 @@
+# Generated by Django 4.2.16 on 2026-10-19 11:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0114_productshots_moysklad_identity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageSyncJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_id', models.CharField(max_length=64)),
+                ('images', models.JSONField(default=dict)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='image_jobs', to='products.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'available_at'], name='products_im_status_c1b999_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.16 on 2026-10-19 11:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0115_imagesyncjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(default='products', max_length=50)),
+                ('params', models.JSONField(default=dict)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed')], default='running', max_length=10)),
+                ('total_rows', models.PositiveIntegerField(blank=True, null=True)),
+                ('current_page', models.IntegerField(blank=True, null=True)),
+                ('completed_pages', models.JSONField(default=list)),
+                ('failed_pages', models.JSONField(default=list)),
+                ('rows_processed', models.PositiveIntegerField(default=0)),
+                ('ok_count', models.PositiveIntegerField(default=0)),
+                ('err_count', models.PositiveIntegerField(default=0)),
+                ('error_count', models.PositiveIntegerField(default=0)),
+                ('errors', models.JSONField(blank=True, default=list)),
+                ('fetch_seconds', models.FloatField(default=0)),
+                ('write_seconds', models.FloatField(default=0)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-started_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.16 on 2026-10-19 11:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0116_importjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='changed_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='importjob',
+            name='unchanged_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='productprice',
+            name='content_hash',
+            field=models.CharField(blank=True, editable=False, max_length=40, null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.16 on 2026-10-19 11:24
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0117_change_detection'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entity_type', models.CharField(max_length=50)),
+                ('action', models.CharField(max_length=10)),
+                ('entity_id', models.CharField(db_index=True, max_length=64)),
+                ('href', models.URLField(max_length=500)),
+                ('moment', models.CharField(blank=True, default='', max_length=32)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'available_at'], name='products_we_status_e3b2fe_idx')],
+            },
+        ),
+    ]
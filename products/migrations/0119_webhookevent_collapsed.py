@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-19 11:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0118_webhookevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookevent',
+            name='collapsed',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.16 on 2026-10-19 11:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0119_webhookevent_collapsed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('moysklad_id', models.CharField(max_length=64, unique=True)),
+                ('entity_type', models.CharField(max_length=50)),
+                ('positions', models.JSONField(default=dict)),
+                ('deleted', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.16 on 2026-10-19 11:40
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0120_stockdocument'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productprice',
+            name='last_seen_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, editable=False),
+        ),
+    ]
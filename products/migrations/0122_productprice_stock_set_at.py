@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-19 11:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0121_productprice_last_seen_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productprice',
+            name='stock_set_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -5,6 +5,7 @@ import uuid
 from django.conf import settings
 from django.db import models
 from django.db.models import Q
+from django.utils import timezone
 
 User = settings.AUTH_USER_MODEL  # auth.user
 
@@ -104,6 +105,14 @@ class ProductPrice(models.Model):
     external_code = models.CharField(max_length=500, blank=True, null=True)
     description = models.TextField(blank=True, null=True)
     artikul = models.CharField(verbose_name="artikul",max_length=200, blank=True, null=True)
+    # Хэш полей строки МоегоСклада, из которой записана цена: неизменившиеся строки не перезаписываем
+    content_hash = models.CharField(max_length=40, blank=True, null=True, editable=False)
+    # Когда строка последний раз приходила из МоегоСклада: после полного импорта
+    # не увиденные им цены удаляются (products.sync.sweep_unseen_prices)
+    last_seen_at = models.DateTimeField(default=timezone.now, db_index=True, editable=False)
+    # Когда остаток последний раз записан абсолютным значением (отчёт или вебхук остатков):
+    # продажи/отгрузки, изменённые раньше, в нём уже учтены и повторно не списываются
+    stock_set_at = models.DateTimeField(null=True, blank=True, editable=False)
 
     def __str__(self):
         return f"{self.weight}, {self.color}, amount: {self.amount}, stock: {self.stock}"
@@ -164,6 +173,12 @@ class ProductShots(models.Model):
     product = models.ForeignKey(Product,on_delete=models.CASCADE,related_name='product_shots',null=True,blank=True)
     image = models.ImageField(upload_to=get_image_upload_path,null=True)
     created_at = models.DateTimeField(auto_now_add=True,null=True)
+    # Откуда снимок в МоёмСкладе (пусто — загружен вручную): товар-вариант и
+    # картинка, плюс её версия (filename|size|updated), чтобы не перекачивать
+    # неизменившиеся картинки.
+    moysklad_product_id = models.CharField(max_length=64, null=True, blank=True)
+    moysklad_id = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    moysklad_signature = models.CharField(max_length=255, null=True, blank=True)
 
     def __str__(self):
         return f"Shot for {self.product.title}"
@@ -191,3 +206,164 @@ class OrderItem(models.Model):
     quantity = models.IntegerField(default=0)
 
 
+
+class SyncState(models.Model):
+    """Watermarks of incremental Moysklad syncs (one row per sync kind)."""
+    key = models.CharField(max_length=100, unique=True)
+    watermark = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.key}: {self.watermark}"
+
+
+class ImageSyncJob(models.Model):
+    """Queued image sync of one Moysklad product variant (see products.image_queue)."""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (FAILED, 'Failed'),
+    ]
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='image_jobs')
+    source_id = models.CharField(max_length=64)
+    # `images` из строки товара МоегоСклада (meta + rows при expand=images)
+    images = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    available_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'available_at'])]
+
+    def __str__(self):
+        return f"Images of {self.product} ({self.status})"
+
+
+class ImportJob(models.Model):
+    """A run of `import_products`, checkpointed after every committed page."""
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (RUNNING, 'Running'),
+        (COMPLETED, 'Completed'),
+        (FAILED, 'Failed'),
+    ]
+    # Сколько последних сообщений об ошибках хранить
+    MAX_ERRORS = 100
+
+    kind = models.CharField(max_length=50, default='products')
+    # Параметры запуска (limit, name): продолжается только запуск с теми же параметрами
+    params = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=RUNNING)
+    total_rows = models.PositiveIntegerField(null=True, blank=True)
+    current_page = models.IntegerField(null=True, blank=True)
+    completed_pages = models.JSONField(default=list)
+    failed_pages = models.JSONField(default=list)
+    rows_processed = models.PositiveIntegerField(default=0)
+    ok_count = models.PositiveIntegerField(default=0)
+    err_count = models.PositiveIntegerField(default=0)
+    # Из ok: сколько цен записано заново и сколько пропущено без изменений
+    changed_count = models.PositiveIntegerField(default=0)
+    unchanged_count = models.PositiveIntegerField(default=0)
+    error_count = models.PositiveIntegerField(default=0)
+    errors = models.JSONField(default=list, blank=True)
+    fetch_seconds = models.FloatField(default=0)
+    write_seconds = models.FloatField(default=0)
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-started_at']
+
+    def __str__(self):
+        return f"{self.kind} #{self.pk} ({self.status})"
+
+    def add_errors(self, messages):
+        self.error_count += len(messages)
+        self.errors = (self.errors + list(messages))[-self.MAX_ERRORS:]
+
+    def record_page(self, page, rows, ok, err, fetch_seconds, write_seconds, changed=0, unchanged=0):
+        self.current_page = page
+        self.changed_count += changed
+        self.unchanged_count += unchanged
+        if page not in self.completed_pages:
+            self.completed_pages.append(page)
+        if page in self.failed_pages:
+            self.failed_pages.remove(page)
+        self.rows_processed += rows
+        self.ok_count += ok
+        self.err_count += err
+        self.fetch_seconds += fetch_seconds
+        self.write_seconds += write_seconds
+
+    def record_failed_page(self, page, message):
+        if page not in self.failed_pages:
+            self.failed_pages.append(page)
+        self.add_errors([message])
+
+
+class WebhookEvent(models.Model):
+    """Moysklad webhook event waiting in the inbox (see products.webhook_inbox)."""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (FAILED, 'Failed'),
+    ]
+
+    entity_type = models.CharField(max_length=50)
+    action = models.CharField(max_length=10)
+    entity_id = models.CharField(max_length=64, db_index=True)
+    href = models.URLField(max_length=500)
+    # auditContext.moment из запроса вебхука
+    moment = models.CharField(max_length=32, blank=True, default='')
+    # Сколько событий по той же сущности слито в это
+    collapsed = models.PositiveIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    available_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'available_at'])]
+
+    def __str__(self):
+        return f"{self.action} {self.entity_type} {self.entity_id} ({self.status})"
+
+    def absorb(self, other):
+        """
+        Merges a later event for the same entity into this one: DELETE wins over
+        CREATE/UPDATE and CREATE followed by UPDATE stays CREATE.
+        """
+        if self.action != 'DELETE' and not (self.action == 'CREATE' and other.action == 'UPDATE'):
+            self.action = other.action
+        self.href = other.href or self.href
+        self.moment = other.moment or self.moment
+        self.collapsed += 1 + other.collapsed
+
+
+class StockDocument(models.Model):
+    """Moysklad sale/shipment whose positions were subtracted from ProductPrice.stock."""
+    moysklad_id = models.CharField(max_length=64, unique=True)
+    entity_type = models.CharField(max_length=50)
+    # guid ProductPrice -> списанное количество (для пересчёта при изменении/удалении документа)
+    positions = models.JSONField(default=dict)
+    deleted = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.entity_type} {self.moysklad_id}"
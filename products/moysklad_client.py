@@ -1,15 +1,25 @@
 import json
+import re
 import threading
 import time
 from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from typing import Any, Dict, Optional
+from typing import Any, BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
 
 import requests
 from django.conf import settings
 from requests import Response
 from requests.auth import HTTPBasicAuth
 
+from .moysklad_metrics import MoyskladMetrics
+
+
+MAX_PAGE_SIZE = 1000
+# Moysklad only honours `expand` on collection requests with limit <= 100.
+MAX_EXPAND_PAGE_SIZE = 100
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
 
 class MoyskladClientError(Exception):
     """Base error for Moysklad client failures."""
@@ -20,7 +30,36 @@ class MoyskladRateLimitError(MoyskladClientError):
 
 
 class MoyskladCircuitOpenError(MoyskladClientError):
-    """Raised when we intentionally stop repeating identical failing requests."""
+    """Raised when requests to a failing endpoint are short-circuited."""
+
+    def __init__(self, message: str, endpoint: Optional[str] = None, retry_after: float = 0.0):
+        super().__init__(message)
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+class MoyskladDownloadError(MoyskladClientError):
+    """Raised when a downloaded file does not pass size/content-type checks."""
+
+
+class _IncompleteDownload(Exception):
+    """Internal marker: the body ended before the announced length."""
+
+
+class MoyskladPage(NamedTuple):
+    """Single page of a paginated collection together with its position."""
+
+    offset: int
+    rows: List[Dict[str, Any]]
+    size: Optional[int]
+
+
+class MoyskladDownload(NamedTuple):
+    """Outcome of a streamed download."""
+
+    size: int
+    content_type: str
+    resumed: bool
 
 
 class _SlidingWindowThrottle:
@@ -35,7 +74,9 @@ class _SlidingWindowThrottle:
         self._timestamps = deque()
         self._lock = threading.Lock()
 
-    def wait_for_slot(self) -> None:
+    def wait_for_slot(self) -> float:
+        """Blocks until a slot is free and returns how long it waited."""
+        started = time.monotonic()
         while True:
             with self._lock:
                 now = time.monotonic()
@@ -45,7 +86,7 @@ class _SlidingWindowThrottle:
 
                 if len(self._timestamps) < self.max_calls:
                     self._timestamps.append(now)
-                    return
+                    return now - started
 
                 sleep_for = self.window_seconds - (now - self._timestamps[0]) + 0.001
 
@@ -94,6 +135,129 @@ class _FailureTracker:
             self._failures.pop(signature, None)
 
 
+_ENTITY_ID_RE = re.compile(
+    r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$", re.IGNORECASE
+)
+_API_PREFIX = "/api/remap/1.2/"
+
+
+def endpoint_key(url: str) -> str:
+    """
+    Collapses a request URL to its endpoint, e.g.
+    `.../entity/product/7c44...dd58/images` -> `entity/product/{id}/images`,
+    so per-entity requests share circuit state and metrics.
+    """
+    path = requests.utils.urlparse(url).path
+    if path.startswith(_API_PREFIX):
+        path = path[len(_API_PREFIX):]
+    segments = [
+        "{id}" if _ENTITY_ID_RE.match(segment) else segment
+        for segment in path.strip("/").split("/")
+    ]
+    return "/".join(segments)
+
+
+class _CircuitBreaker:
+    """
+    Per-endpoint circuit breaker shared by all threads using the client.
+
+    closed    -> requests flow; `failure_threshold` consecutive failures open it.
+    open      -> requests fail fast with `MoyskladCircuitOpenError` until
+                 `cooldown_seconds` pass.
+    half_open -> up to `half_open_probes` requests go through; a success closes
+                 the circuit, a failure opens it for another cooldown.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, cooldown_seconds: float = 30.0, half_open_probes: int = 1):
+        self.failure_threshold = max(failure_threshold, 1)
+        self.cooldown_seconds = cooldown_seconds
+        self.half_open_probes = max(half_open_probes, 1)
+        self._circuits: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _circuit(self, endpoint: str) -> Dict[str, Any]:
+        circuit = self._circuits.get(endpoint)
+        if circuit is None:
+            circuit = {
+                "state": self.CLOSED,
+                "failures": 0,
+                "opened_at": 0.0,
+                "probes": 0,
+                "trips": 0,
+            }
+            self._circuits[endpoint] = circuit
+        return circuit
+
+    def before_request(self, endpoint: str) -> None:
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            if circuit["state"] == self.CLOSED:
+                return
+            if circuit["state"] == self.OPEN:
+                remaining = circuit["opened_at"] + self.cooldown_seconds - time.monotonic()
+                if remaining > 0:
+                    raise MoyskladCircuitOpenError(
+                        f"Circuit for '{endpoint}' is open; retry in {remaining:.1f}s.",
+                        endpoint=endpoint,
+                        retry_after=remaining,
+                    )
+                circuit["state"] = self.HALF_OPEN
+                circuit["probes"] = 0
+            if circuit["probes"] >= self.half_open_probes:
+                raise MoyskladCircuitOpenError(
+                    f"Circuit for '{endpoint}' is half-open and its probe is in flight.",
+                    endpoint=endpoint,
+                )
+            circuit["probes"] += 1
+
+    def record_success(self, endpoint: str) -> None:
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            circuit["state"] = self.CLOSED
+            circuit["failures"] = 0
+            circuit["probes"] = 0
+
+    def record_failure(self, endpoint: str) -> None:
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            circuit["failures"] += 1
+            if circuit["state"] == self.HALF_OPEN or circuit["failures"] >= self.failure_threshold:
+                self._open(circuit)
+
+    def release(self, endpoint: str) -> None:
+        """Finishes a request that neither proves nor disproves endpoint health (e.g. 429)."""
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            if circuit["state"] == self.HALF_OPEN and circuit["probes"]:
+                circuit["probes"] -= 1
+
+    def trip(self, endpoint: str) -> None:
+        with self._lock:
+            self._open(self._circuit(endpoint))
+
+    def _open(self, circuit: Dict[str, Any]) -> None:
+        if circuit["state"] != self.OPEN:
+            circuit["trips"] += 1
+        circuit["state"] = self.OPEN
+        circuit["opened_at"] = time.monotonic()
+        circuit["probes"] = 0
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {
+                endpoint: {
+                    "state": circuit["state"],
+                    "failures": circuit["failures"],
+                    "trips": circuit["trips"],
+                }
+                for endpoint, circuit in self._circuits.items()
+            }
+
+
 class MoyskladClient:
     """
     Centralized HTTP client for Moysklad JSON API with built-in enforcement
@@ -117,6 +281,9 @@ class MoyskladClient:
         max_request_body_bytes: int = 20 * 1024 * 1024,
         max_header_bytes: int = 8 * 1024,
         max_identical_failures_per_minute: int = 100,
+        circuit_failure_threshold: int = 5,
+        circuit_cooldown_seconds: float = 30.0,
+        circuit_half_open_probes: int = 1,
     ):
         self._auth = HTTPBasicAuth(login, password)
         self._session = requests.Session()
@@ -127,6 +294,7 @@ class MoyskladClient:
             getattr(settings, "MOYSKLAD_USER_AGENT", "derek-api/1.0"),
         )
 
+        self._max_parallel_user = max(max_parallel_user, 1)
         self._body_limit = max_request_body_bytes
         self._header_limit = max_header_bytes
         self._throttle = _SlidingWindowThrottle(max_requests_per_window, window_seconds)
@@ -135,14 +303,27 @@ class MoyskladClient:
         self._failures = _FailureTracker(
             threshold=max_identical_failures_per_minute, window_seconds=60
         )
+        self._breaker = _CircuitBreaker(
+            failure_threshold=circuit_failure_threshold,
+            cooldown_seconds=circuit_cooldown_seconds,
+            half_open_probes=circuit_half_open_probes,
+        )
+        self.metrics = MoyskladMetrics()
         self._retry_backoff_base = 0.5
         self._max_retries = 5
 
+    def mount(self, adapter, prefix: str = "https://api.moysklad.ru/") -> None:
+        """Routes requests under `prefix` through another transport adapter (e.g. the offline fake)."""
+        self._session.mount(prefix, adapter)
+
     @contextmanager
     def _reserve_slot(self):
+        gate_started = time.monotonic()
         with self._account_gate.checkout():
             with self._user_gate.checkout():
-                self._throttle.wait_for_slot()
+                gate_wait = time.monotonic() - gate_started
+                throttle_wait = self._throttle.wait_for_slot()
+                self.metrics.observe_waits(gate_wait, throttle_wait)
                 yield
 
     def _ensure_limits(self, headers: Optional[Dict[str, str]], data: Any, json_payload: Any):
@@ -194,16 +375,28 @@ class MoyskladClient:
         json: Any = None,
         timeout: int = 60,
         params: Optional[Dict[str, Any]] = None,
+        stream: bool = False,
     ) -> Response:
         self._ensure_limits(headers, data, json)
+        endpoint = endpoint_key(url)
 
         attempt = 0
         last_error: Optional[Exception] = None
 
         while attempt < self._max_retries:
             attempt += 1
+            if attempt > 1:
+                self.metrics.observe_retry(endpoint)
+            # Fails fast while the endpoint's circuit is open, before taking
+            # a rate-limit slot or a concurrency gate.
+            try:
+                self._breaker.before_request(endpoint)
+            except MoyskladCircuitOpenError:
+                self.metrics.observe_rejection(endpoint)
+                raise
             with self._reserve_slot():
                 response = None
+                started = time.monotonic()
                 try:
                     response = self._session.request(
                         method=method,
@@ -213,17 +406,25 @@ class MoyskladClient:
                         json=json,
                         timeout=timeout,
                         params=params,
+                        stream=stream,
+                    )
+                    self.metrics.observe_request(
+                        endpoint, method, response.status_code, time.monotonic() - started
                     )
                 except requests.RequestException as exc:
+                    self.metrics.observe_request(endpoint, method, None, time.monotonic() - started)
+                    self._breaker.record_failure(endpoint)
                     last_error = exc
                     sleep_for = self._retry_backoff_base * (2 ** (attempt - 1))
                     time.sleep(min(sleep_for, 5))
                     continue
 
             if response is None:
+                self._breaker.release(endpoint)
                 continue
 
             if response.status_code == 429:
+                self._breaker.release(endpoint)
                 last_error = MoyskladRateLimitError(
                     "Received HTTP 429 from Moysklad. Will retry with backoff."
                 )
@@ -232,9 +433,13 @@ class MoyskladClient:
 
             signature = self._signature(method, url, response.status_code)
             if response.status_code >= 500:
+                self._breaker.record_failure(endpoint)
                 if self._failures.register(signature):
+                    self._breaker.trip(endpoint)
                     raise MoyskladCircuitOpenError(
-                        "Circuit breaker opened due to repeating errors from Moysklad."
+                        "Circuit breaker opened due to repeating errors from Moysklad.",
+                        endpoint=endpoint,
+                        retry_after=self._breaker.cooldown_seconds,
                     )
                 last_error = MoyskladClientError(
                     f"Server error {response.status_code}: {response.text[:200]}"
@@ -242,6 +447,7 @@ class MoyskladClient:
                 time.sleep(min(2 ** attempt, 10))
                 continue
 
+            self._breaker.record_success(endpoint)
             try:
                 response.raise_for_status()
                 self._failures.reset(signature)
@@ -256,6 +462,16 @@ class MoyskladClient:
 
         raise last_error or MoyskladClientError("Unknown Moysklad client failure.")
 
+    def circuit_states(self) -> Dict[str, Dict[str, Any]]:
+        """Current circuit state per endpoint, e.g. for metrics or admin views."""
+        return self._breaker.snapshot()
+
+    def metrics_prometheus(self) -> str:
+        return self.metrics.to_prometheus(self.circuit_states())
+
+    def metrics_summary(self) -> str:
+        return self.metrics.summary(self.circuit_states())
+
     def get_json(self, url: str, **kwargs) -> Dict[str, Any]:
         response = self.request("GET", url, **kwargs)
         return response.json()
@@ -264,6 +480,229 @@ class MoyskladClient:
         response = self.request("GET", url, **kwargs)
         return response.content
 
+    def download(
+        self,
+        url: str,
+        fileobj: BinaryIO,
+        *,
+        max_bytes: Optional[int] = None,
+        content_types: Optional[Sequence[str]] = None,
+        chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+        timeout: int = 120,
+    ) -> MoyskladDownload:
+        """
+        Streams `url` into the writable binary `fileobj` chunk by chunk, so
+        memory use stays at `chunk_size` whatever the file size.
+
+        Size (`Content-Length`) and `Content-Type` (matched by prefix against
+        `content_types`) are checked before the body is read and the size
+        again while streaming; violations raise `MoyskladDownloadError`.
+        When the connection drops mid-body the download is resumed with a
+        `Range` request from the bytes already written, falling back to a
+        full restart if the server does not answer with 206.
+        """
+        start = fileobj.tell()
+        expected_total: Optional[int] = None
+        resumed = False
+        attempt = 0
+
+        while True:
+            attempt += 1
+            written = fileobj.tell() - start
+            headers = {"Accept-Encoding": "identity"}
+            if written and expected_total is not None:
+                headers["Range"] = f"bytes={written}-"
+            elif written:
+                fileobj.seek(start)
+                fileobj.truncate()
+                written = 0
+
+            response = self.request("GET", url, headers=headers, timeout=timeout, stream=True)
+            try:
+                if written and response.status_code != 206:
+                    fileobj.seek(start)
+                    fileobj.truncate()
+                    written = 0
+                elif written:
+                    resumed = True
+
+                content_type = response.headers.get("Content-Type", "")
+                if content_types and not content_type.startswith(tuple(content_types)):
+                    raise MoyskladDownloadError(
+                        f"Unexpected content type '{content_type}' for {url}."
+                    )
+
+                length = response.headers.get("Content-Length")
+                if length is not None and length.isdigit():
+                    expected_total = written + int(length)
+                if max_bytes is not None and expected_total is not None and expected_total > max_bytes:
+                    raise MoyskladDownloadError(
+                        f"File exceeds {max_bytes} bytes (announced {expected_total})."
+                    )
+
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if not chunk:
+                        continue
+                    written += len(chunk)
+                    if max_bytes is not None and written > max_bytes:
+                        raise MoyskladDownloadError(f"File exceeds {max_bytes} bytes.")
+                    fileobj.write(chunk)
+
+                if expected_total is not None and written < expected_total:
+                    raise _IncompleteDownload()
+                return MoyskladDownload(size=written, content_type=content_type, resumed=resumed)
+            except (requests.RequestException, _IncompleteDownload) as exc:
+                if attempt >= self._max_retries:
+                    raise MoyskladClientError(f"Download of {url} failed: {exc!r}") from exc
+                time.sleep(min(self._retry_backoff_base * (2 ** (attempt - 1)), 5))
+            finally:
+                response.close()
+
+    @staticmethod
+    def _check_page_size(params: Optional[Dict[str, Any]], page_size: int) -> None:
+        if page_size < 1 or page_size > MAX_PAGE_SIZE:
+            raise MoyskladClientError(
+                f"Page size must be between 1 and {MAX_PAGE_SIZE} (got {page_size})."
+            )
+        if (params or {}).get("expand") and page_size > MAX_EXPAND_PAGE_SIZE:
+            raise MoyskladClientError(
+                f"Page size with expand must not exceed {MAX_EXPAND_PAGE_SIZE} (got {page_size})."
+            )
+
+    def get_page(
+        self,
+        url: str,
+        params: Optional[Dict[str, Any]] = None,
+        *,
+        page_size: int = MAX_PAGE_SIZE,
+        offset: int = 0,
+        timeout: int = 60,
+    ) -> MoyskladPage:
+        """Fetches a single page of an offset/limit collection."""
+        self._check_page_size(params, page_size)
+        page_params = dict(params or {}, limit=page_size, offset=offset)
+        payload = self.get_json(url, params=page_params, timeout=timeout)
+        return MoyskladPage(
+            offset=offset,
+            rows=payload.get("rows") or [],
+            size=(payload.get("meta") or {}).get("size"),
+        )
+
+    def iter_pages(
+        self,
+        url: str,
+        params: Optional[Dict[str, Any]] = None,
+        *,
+        page_size: int = MAX_PAGE_SIZE,
+        start_offset: int = 0,
+        max_pages: Optional[int] = None,
+        prefetch: int = 1,
+        timeout: int = 60,
+    ) -> Iterator[MoyskladPage]:
+        """
+        Lazily walks an offset/limit collection page by page.
+
+        Up to `prefetch` following pages are requested in background threads
+        while the caller processes the current one. Every request still goes
+        through `request()`, so prefetching shares the throttle and concurrency
+        gates with all other callers; the depth is capped below the per-user
+        parallel limit to always leave a slot for foreground requests.
+
+        Iteration stops on an empty or short page, or once `meta.size` reported
+        by Moysklad is reached. `MoyskladPage.offset` is the absolute offset of
+        the page's first row, so callers can resume from any row.
+        """
+        self._check_page_size(params, page_size)
+        prefetch = max(0, min(prefetch, self._max_parallel_user - 1))
+
+        def fetch(offset: int) -> MoyskladPage:
+            return self.get_page(url, params, page_size=page_size, offset=offset, timeout=timeout)
+
+        def is_last(page: MoyskladPage) -> bool:
+            if len(page.rows) < page_size:
+                return True
+            return page.size is not None and page.offset + len(page.rows) >= page.size
+
+        pages_left = max_pages
+        offset = start_offset
+
+        if prefetch == 0:
+            while pages_left is None or pages_left > 0:
+                page = fetch(offset)
+                if not page.rows:
+                    return
+                yield page
+                if is_last(page):
+                    return
+                offset += page_size
+                if pages_left is not None:
+                    pages_left -= 1
+            return
+
+        executor = ThreadPoolExecutor(
+            max_workers=prefetch, thread_name_prefix="moysklad-prefetch"
+        )
+        pending = deque()
+        next_offset = offset
+        total: Optional[int] = None
+        scheduled = 0
+
+        def schedule(depth: int) -> None:
+            nonlocal next_offset, scheduled
+            while len(pending) < depth:
+                if max_pages is not None and scheduled >= max_pages:
+                    return
+                if total is not None and next_offset >= total:
+                    return
+                pending.append((next_offset, executor.submit(fetch, next_offset)))
+                next_offset += page_size
+                scheduled += 1
+
+        try:
+            # The first page is fetched alone: it tells us `meta.size`, so we
+            # never prefetch past the end of a small collection.
+            schedule(1)
+            while pending:
+                page_offset, future = pending.popleft()
+                page = future.result()
+                if page.size is not None:
+                    total = page.size
+                if not page.rows:
+                    return
+                if is_last(page):
+                    yield page
+                    return
+                schedule(prefetch if total is not None else 1)
+                yield page
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def iter_rows(
+        self,
+        url: str,
+        params: Optional[Dict[str, Any]] = None,
+        *,
+        page_size: int = MAX_PAGE_SIZE,
+        start_offset: int = 0,
+        **kwargs,
+    ) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """
+        Yields `(offset, row)` pairs for every row of a paginated collection.
+
+        `offset` is the absolute position of the row; restarting with
+        `start_offset=offset + 1` continues right after it.
+        """
+        page_start = start_offset - start_offset % page_size
+        skip = start_offset - page_start
+        for page in self.iter_pages(
+            url, params, page_size=page_size, start_offset=page_start, **kwargs
+        ):
+            for index, row in enumerate(page.rows):
+                if index < skip:
+                    continue
+                yield page.offset + index, row
+            skip = 0
+
 
 moysklad_client = MoyskladClient(
     login=settings.MOYSKLAD_LOGIN,
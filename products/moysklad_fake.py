@@ -0,0 +1,488 @@
+"""
+Offline stand-in for the Moysklad JSON API.
+
+`FakeMoyskladAdapter` is a `requests` transport adapter that answers the
+endpoints our integration uses from a synthetic catalog, with configurable
+latency, injected 429/5xx failures and Moysklad's documented limits
+(45 requests per 3 seconds, 5 parallel requests per user). Mount it on the
+shared client to run imports, webhooks and benchmarks without the network:
+
+    fake = FakeMoyskladAdapter(FakeCatalog(size=5000))
+    moysklad_client.mount(fake)
+"""
+import io
+import json
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+API_ROOT = "https://api.moysklad.ru/api/remap/1.2/"
+
+_NAMESPACE = uuid.UUID("6f1b8c2e-8a55-4a57-9d0c-9f3f3f5e1a01")
+_COLORS = [
+    "Белый", "Чёрный", "Серый", "Бежевый", "Красный", "Синий", "Зелёный", "Жёлтый",
+    "Коричневый", "Оранжевый", "Голубой", "Розовый", "Графит", "Слоновая кость",
+]
+_WEIGHTS = ["0.5 кг", "1 кг", "2.5 кг", "5 кг", "10 кг", "15 кг", "20 кг", "25 кг"]
+# Moment every synthetic row was last "edited" unless touched later.
+BASE_UPDATED = "2024-07-08 10:17:30.000"
+# Smallest valid JPEG header; the rest of a synthetic image is padding.
+_JPEG_HEADER = bytes.fromhex("ffd8ffe000104a46494600010100000100010000")
+
+
+class FakeCatalog:
+    """Deterministic synthetic product catalog addressed by row index."""
+
+    def __init__(
+        self,
+        size: int = 1000,
+        *,
+        images_per_product: int = 1,
+        image_bytes: int = 50 * 1024,
+        categories: int = 40,
+        invalid_ratio: float = 0.02,
+    ):
+        self.size = size
+        self.images_per_product = images_per_product
+        self.image_bytes = image_bytes
+        self.categories = max(categories, 1)
+        self.invalid_every = int(1 / invalid_ratio) if invalid_ratio > 0 else 0
+        self._index_by_id: Optional[Dict[str, int]] = None
+        self._lock = threading.Lock()
+        # Edits made after BASE_UPDATED: index -> moment ("YYYY-MM-DD HH:MM:SS.mmm").
+        self.updated: Dict[int, str] = {}
+        self.archived = set()
+        self.deleted: Dict[int, str] = {}
+        # Stock edits: index -> (stock, moment).
+        self.stock_changes: Dict[int, tuple] = {}
+        # Sale/shipment documents: id -> {"type", "positions": {index: quantity}, "applicable", "updated"}.
+        self.documents: Dict[str, Dict[str, Any]] = {}
+
+    @staticmethod
+    def now() -> str:
+        # Moysklad stamps moments in the account timezone.
+        return datetime.now(ZoneInfo("Europe/Moscow")).strftime("%Y-%m-%d %H:%M:%S.%f")[:23]
+
+    def touch(self, index: int, moment: Optional[str] = None) -> None:
+        """Marks a product as edited (at `moment`, now by default)."""
+        self.updated[index] = moment or self.now()
+
+    def archive(self, index: int, moment: Optional[str] = None) -> None:
+        self.archived.add(index)
+        self.touch(index, moment)
+
+    def delete(self, index: int, moment: Optional[str] = None) -> None:
+        self.deleted[index] = moment or self.now()
+
+    def set_stock(self, index: int, stock: int, moment: Optional[str] = None) -> None:
+        self.stock_changes[index] = (stock, moment or self.now())
+
+    def stock_value(self, index: int) -> int:
+        if index in self.stock_changes:
+            return self.stock_changes[index][0]
+        return (index * 7) % 50
+
+    def add_document(self, entity_type: str, positions: Dict[int, int], applicable: bool = True) -> str:
+        """Posts a retaildemand/demand, lowering stock like Moysklad would; returns its href."""
+        document_id = str(uuid.uuid4())
+        self.documents[document_id] = {"type": entity_type, "positions": {}, "applicable": applicable}
+        self.update_document(document_id, positions, applicable)
+        return f"{API_ROOT}entity/{entity_type}/{document_id}"
+
+    def update_document(self, document_id: str, positions: Dict[int, int], applicable: bool = True) -> None:
+        document = self.documents[document_id]
+        moment = self.now()
+        old = document["positions"] if document["applicable"] else {}
+        new = positions if applicable else {}
+        for index in set(old) | set(new):
+            moved = new.get(index, 0) - old.get(index, 0)
+            if moved:
+                self.set_stock(index, self.stock_value(index) - moved, moment)
+        document.update(positions=dict(positions), applicable=applicable, updated=moment)
+
+    def delete_document(self, document_id: str) -> None:
+        self.update_document(document_id, {}, applicable=False)
+        del self.documents[document_id]
+
+    def document(self, document_id: str, expand_positions: bool = False) -> Dict[str, Any]:
+        document = self.documents[document_id]
+        href = f"{API_ROOT}entity/{document['type']}/{document_id}"
+        rows = [
+            {
+                "quantity": quantity,
+                "assortment": {"meta": {"href": self.product_href(index), "type": "product"}},
+            }
+            for index, quantity in document["positions"].items()
+        ]
+        positions: Dict[str, Any] = {"meta": {"href": f"{href}/positions", "size": len(rows)}}
+        if expand_positions:
+            positions["rows"] = rows
+        return {
+            "meta": {"href": href, "type": document["type"]},
+            "id": document_id,
+            "updated": document["updated"],
+            "applicable": document["applicable"],
+            "positions": positions,
+            "_rows": rows,
+        }
+
+    def updated_at(self, index: int) -> str:
+        return self.updated.get(index, BASE_UPDATED)
+
+    def live_indexes(self) -> List[int]:
+        return [i for i in range(self.size) if i not in self.deleted]
+
+    def audit_contexts(self, since: str = "") -> List[Dict[str, Any]]:
+        """One audit context per deleted product, oldest first."""
+        contexts = []
+        for index, moment in sorted(self.deleted.items(), key=lambda item: (item[1], item[0])):
+            if moment[:19] < since[:19]:
+                continue
+            context_id = str(uuid.uuid5(_NAMESPACE, f"audit-{index}"))
+            contexts.append({
+                "meta": {"href": f"{API_ROOT}audit/{context_id}", "type": "audit"},
+                "id": context_id,
+                "moment": moment,
+                "entityType": "product",
+                "eventType": "delete",
+                "events": {"meta": {"href": f"{API_ROOT}audit/{context_id}/events", "size": 1}},
+                "_index": index,
+            })
+        return contexts
+
+    def audit_events(self, index: int) -> List[Dict[str, Any]]:
+        return [{
+            "eventType": "delete",
+            "entityType": "product",
+            "moment": self.deleted[index],
+            "entity": {"meta": {"href": self.product_href(index), "type": "product"}},
+        }]
+
+    @staticmethod
+    def product_id(index: int) -> str:
+        return str(uuid.uuid5(_NAMESPACE, f"product-{index}"))
+
+    @staticmethod
+    def image_id(index: int, position: int) -> str:
+        return str(uuid.uuid5(_NAMESPACE, f"image-{index}-{position}"))
+
+    def index_of(self, product_id: str) -> Optional[int]:
+        with self._lock:
+            if self._index_by_id is None:
+                self._index_by_id = {self.product_id(i): i for i in range(self.size)}
+        return self._index_by_id.get(product_id)
+
+    def product_href(self, index: int) -> str:
+        return f"{API_ROOT}entity/product/{self.product_id(index)}"
+
+    def images(self, index: int, expand: bool = False) -> Dict[str, Any]:
+        href = f"{self.product_href(index)}/images"
+        payload: Dict[str, Any] = {
+            "meta": {
+                "href": href,
+                "type": "image",
+                "mediaType": "application/json",
+                "size": self.images_per_product,
+                "limit": 1000,
+                "offset": 0,
+            }
+        }
+        if expand:
+            payload["rows"] = self.image_rows(index)
+        return payload
+
+    def image_rows(self, index: int) -> List[Dict[str, Any]]:
+        rows = []
+        for position in range(self.images_per_product):
+            image_id = self.image_id(index, position)
+            rows.append({
+                "meta": {
+                    "href": f"{self.product_href(index)}/images/{image_id}",
+                    "type": "image",
+                    "mediaType": "application/json",
+                    "downloadHref": f"{API_ROOT}download/{image_id}",
+                },
+                "title": f"photo-{index}-{position}",
+                "filename": f"photo-{index}-{position}.jpg",
+                "size": self.image_bytes,
+                "updated": "2024-07-08 10:17:30.000",
+            })
+        return rows
+
+    def product(self, index: int, expand_images: bool = False) -> Dict[str, Any]:
+        color = _COLORS[index % len(_COLORS)]
+        weight = _WEIGHTS[(index // len(_COLORS)) % len(_WEIGHTS)]
+        category = index % self.categories
+        name = f"Товар {index // 7}, {color}, {weight}"
+        if self.invalid_every and index % self.invalid_every == self.invalid_every - 1:
+            name = f"Товар без характеристик {index}"
+        return {
+            "meta": {
+                "href": self.product_href(index),
+                "type": "product",
+                "mediaType": "application/json",
+            },
+            "id": self.product_id(index),
+            "updated": self.updated_at(index),
+            "name": name,
+            "code": f"{100000 + index}",
+            "externalCode": f"ext-{index}",
+            "archived": index in self.archived,
+            "pathName": f"Каталог/Группа {category // 8}/Раздел {category}",
+            "description": f"Описание товара {index}",
+            "salePrices": [{"value": 1000 + (index % 500) * 100}],
+            "images": self.images(index, expand=expand_images),
+        }
+
+    def stock(self, index: int) -> Dict[str, Any]:
+        return {
+            "meta": {
+                "href": self.product_href(index),
+                "type": "product",
+                "mediaType": "application/json",
+            },
+            "name": self.product(index)["name"],
+            "code": f"{100000 + index}",
+            "stock": self.stock_value(index),
+        }
+
+    def current_stock(self, since: str = "", zero_lines: bool = False) -> List[Dict[str, Any]]:
+        """`report/stock/all/current` rows; `since` keeps only stocks changed after it."""
+        rows = []
+        for index in self.live_indexes():
+            if since and (index not in self.stock_changes or self.stock_changes[index][1][:19] < since[:19]):
+                continue
+            stock = self.stock_value(index)
+            if stock or zero_lines:
+                rows.append({"assortmentId": self.product_id(index), "stock": stock})
+        return rows
+
+    def image_bytes_for(self, image_id: str) -> bytes:
+        padding = self.image_bytes - len(_JPEG_HEADER)
+        return _JPEG_HEADER + (image_id.encode("ascii") * (padding // 36 + 1))[:max(padding, 0)]
+
+
+class FakeMoyskladAdapter(BaseAdapter):
+    """
+    `requests` adapter serving `FakeCatalog` over the Moysklad URL layout.
+
+    Supported endpoints: `entity/product` (list, `expand=images`,
+    `filter=id=...;updated>=...;archived=...`, `order=updated`),
+    `entity/product/{id}`, `entity/product/{id}/images`, `download/{id}`,
+    `report/stock/all`, `report/stock/all/current` (`changedSince`,
+    `include=zeroLines`), `entity/{retaildemand,demand}/{id}` (`expand=positions`)
+    with its `positions`, and `audit` (product deletions) with its `events`.
+    """
+
+    def __init__(
+        self,
+        catalog: FakeCatalog,
+        *,
+        latency: float = 0.05,
+        error_rate_429: float = 0.0,
+        error_rate_5xx: float = 0.0,
+        max_requests_per_window: int = 45,
+        window_seconds: float = 3.0,
+        max_parallel: int = 5,
+        seed: int = 0,
+        truncated_downloads: int = 0,
+    ):
+        super().__init__()
+        self.catalog = catalog
+        self.latency = latency
+        self.error_rate_429 = error_rate_429
+        self.error_rate_5xx = error_rate_5xx
+        self.max_requests_per_window = max_requests_per_window
+        self.window_seconds = window_seconds
+        self.max_parallel = max_parallel
+        self._random = random.Random(seed)
+        # The next N downloads break off halfway (Content-Length still announces the whole file).
+        self.truncated_downloads = truncated_downloads
+        self._timestamps = deque()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "rate_limited": 0, "injected_errors": 0, "bytes_sent": 0}
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        rejected = self._admit()
+        try:
+            if rejected:
+                return self._response(request, 429, {"errors": [{"error": rejected, "code": 1049}]})
+            if self.latency:
+                time.sleep(self.latency)
+            with self._lock:
+                roll = self._random.random()
+            if roll < self.error_rate_429:
+                self._count("rate_limited")
+                return self._response(request, 429, {"errors": [{"error": "Injected 429", "code": 1049}]})
+            if roll < self.error_rate_429 + self.error_rate_5xx:
+                self._count("injected_errors")
+                return self._response(request, 503, {"errors": [{"error": "Injected 503"}]})
+            return self._route(request)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def close(self):
+        pass
+
+    def _admit(self) -> Optional[str]:
+        with self._lock:
+            self._in_flight += 1
+            self.stats["requests"] += 1
+            now = time.monotonic()
+            while self._timestamps and self._timestamps[0] < now - self.window_seconds:
+                self._timestamps.popleft()
+            if self._in_flight > self.max_parallel:
+                self.stats["rate_limited"] += 1
+                return "Too many parallel requests"
+            if len(self._timestamps) >= self.max_requests_per_window:
+                self.stats["rate_limited"] += 1
+                return "Rate limit exceeded"
+            self._timestamps.append(now)
+            return None
+
+    def _count(self, key: str, amount: int = 1) -> None:
+        with self._lock:
+            self.stats[key] += amount
+
+    def _route(self, request) -> Response:
+        parsed = urlparse(request.url)
+        query = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+        path = parsed.path.split("/api/remap/1.2/", 1)[-1].strip("/")
+        parts = path.split("/")
+        expand_images = "images" in query.get("expand", "").split(",")
+
+        if request.method != "GET":
+            return self._response(request, 405, {"errors": [{"error": "Method not allowed"}]})
+
+        if parts == ["entity", "product"]:
+            indexes = self._filter_products(query)
+            return self._page(request, query, indexes, lambda i: self.catalog.product(i, expand_images))
+        if parts == ["report", "stock", "all"]:
+            return self._page(request, query, self.catalog.live_indexes(), self.catalog.stock)
+        if parts == ["report", "stock", "all", "current"]:
+            zero_lines = "zeroLines" in query.get("include", "").split(",")
+            return self._response(request, 200, self.catalog.current_stock(query.get("changedSince", ""), zero_lines))
+        if parts == ["audit"]:
+            since = ""
+            for condition in query.get("filter", "").split(";"):
+                if condition.startswith("moment>="):
+                    since = condition[len("moment>="):]
+            contexts = self.catalog.audit_contexts(since)
+            return self._page(request, query, range(len(contexts)), lambda i: contexts[i])
+        if len(parts) == 3 and parts[0] == "audit" and parts[2] == "events":
+            context = next((c for c in self.catalog.audit_contexts() if c["id"] == parts[1]), None)
+            if context is None:
+                return self._not_found(request)
+            events = self.catalog.audit_events(context["_index"])
+            return self._page(request, query, range(len(events)), lambda i: events[i])
+        if len(parts) >= 3 and parts[:2] == ["entity", "product"]:
+            index = self.catalog.index_of(parts[2])
+            if index is None or index in self.catalog.deleted:
+                return self._not_found(request)
+            if len(parts) == 3:
+                return self._response(request, 200, self.catalog.product(index, expand_images))
+            if parts[3:] == ["images"]:
+                rows = self.catalog.image_rows(index)
+                payload = self.catalog.images(index)
+                payload["rows"] = rows
+                return self._response(request, 200, payload)
+        if len(parts) >= 3 and parts[0] == "entity" and parts[1] in ("retaildemand", "demand"):
+            if parts[2] not in self.catalog.documents:
+                return self._not_found(request)
+            expand_positions = "positions" in query.get("expand", "").split(",")
+            document = self.catalog.document(parts[2], expand_positions)
+            rows = document.pop("_rows")
+            if parts[3:] == ["positions"]:
+                return self._page(request, query, list(range(len(rows))), lambda i: rows[i])
+            return self._response(request, 200, document)
+        if len(parts) == 2 and parts[0] == "download":
+            return self._download(request, parts[1])
+        return self._not_found(request)
+
+    def _filter_products(self, query) -> List[int]:
+        since = None
+        archived = set()
+        ids = set()
+        for condition in filter(None, query.get("filter", "").split(";")):
+            if condition.startswith("id="):
+                ids.add(condition[len("id="):])
+            elif condition.startswith("updated>="):
+                since = condition[len("updated>="):][:19]
+            elif condition.startswith("archived="):
+                archived.add(condition[len("archived="):] == "true")
+        # Like Moysklad: archived products are hidden unless asked for.
+        archived = archived or {False}
+        indexes = [
+            i for i in self.catalog.live_indexes()
+            if (i in self.catalog.archived) in archived
+            and (since is None or self.catalog.updated_at(i)[:19] >= since)
+            # Несколько id= в фильтре — любое из значений
+            and (not ids or self.catalog.product_id(i) in ids)
+        ]
+        if query.get("order", "").startswith("updated"):
+            indexes.sort(key=lambda i: self.catalog.updated_at(i))
+        return indexes
+
+    def _page(self, request, query, indexes, build_row) -> Response:
+        limit = int(query.get("limit", 1000))
+        offset = int(query.get("offset", 0))
+        if limit > 1000 or ("expand" in query and limit > 100):
+            return self._response(request, 412, {"errors": [{"error": "Limit too large"}]})
+        indexes = list(indexes)
+        rows = [build_row(i) for i in indexes[offset:offset + limit]]
+        for row in rows:
+            row.pop("_index", None)
+        payload = {
+            "meta": {"size": len(indexes), "limit": limit, "offset": offset},
+            "rows": rows,
+        }
+        return self._response(request, 200, payload)
+
+    def _download(self, request, image_id: str) -> Response:
+        body = self.catalog.image_bytes_for(image_id)
+        start = 0
+        range_header = request.headers.get("Range")
+        if range_header and range_header.startswith("bytes="):
+            start = int(range_header[len("bytes="):].split("-")[0] or 0)
+        status = 206 if start else 200
+        headers = {"Content-Type": "image/jpeg", "Content-Length": str(len(body) - start)}
+        if start:
+            headers["Content-Range"] = f"bytes {start}-{len(body) - 1}/{len(body)}"
+        body = body[start:]
+        with self._lock:
+            if self.truncated_downloads > 0:
+                self.truncated_downloads -= 1
+                body = body[:len(body) // 2]
+        return self._raw_response(request, status, body, headers)
+
+    def _not_found(self, request) -> Response:
+        return self._response(request, 404, {"errors": [{"error": "Not found", "code": 1021}]})
+
+    def _response(self, request, status: int, payload: Dict[str, Any]) -> Response:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        headers = {"Content-Type": "application/json;charset=utf-8", "Content-Length": str(len(body))}
+        return self._raw_response(request, status, body, headers)
+
+    def _raw_response(self, request, status: int, body: bytes, headers: Dict[str, str]) -> Response:
+        self._count("bytes_sent", len(body))
+        response = Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response.raw = io.BytesIO(body)
+        response.url = request.url
+        response.request = request
+        response.encoding = "utf-8"
+        response.reason = "OK" if status < 400 else "Error"
+        return response
@@ -0,0 +1,194 @@
+import threading
+from collections import defaultdict
+from typing import Any, Dict, Optional, Tuple
+
+# Upper bounds (seconds) of request latency histogram buckets.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CIRCUIT_STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(**labels) -> str:
+    if not labels:
+        return ""
+    inner = ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+    return "{" + inner + "}"
+
+
+class MoyskladMetrics:
+    """
+    Thread-safe in-process counters for `MoyskladClient`.
+
+    Everything is keyed by endpoint (see `endpoint_key`), so numbers stay
+    comparable between the import commands, webhooks and workers sharing
+    one client.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._requests: Dict[Tuple[str, str], int] = defaultdict(int)
+            self._statuses: Dict[Tuple[str, int], int] = defaultdict(int)
+            self._errors: Dict[str, int] = defaultdict(int)
+            self._retries: Dict[str, int] = defaultdict(int)
+            self._rejections: Dict[str, int] = defaultdict(int)
+            self._latency_buckets: Dict[str, list] = defaultdict(lambda: [0] * len(LATENCY_BUCKETS))
+            self._latency_sum: Dict[str, float] = defaultdict(float)
+            self._latency_count: Dict[str, int] = defaultdict(int)
+            self._throttle_wait = 0.0
+            self._gate_wait = 0.0
+            self._webhook_events: Dict[str, int] = defaultdict(int)
+
+    def observe_request(self, endpoint: str, method: str, status: Optional[int], duration: float) -> None:
+        with self._lock:
+            self._requests[(endpoint, method.upper())] += 1
+            if status is None:
+                self._errors[endpoint] += 1
+            else:
+                self._statuses[(endpoint, status)] += 1
+            buckets = self._latency_buckets[endpoint]
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if duration <= bound:
+                    buckets[index] += 1
+            self._latency_sum[endpoint] += duration
+            self._latency_count[endpoint] += 1
+
+    def observe_retry(self, endpoint: str) -> None:
+        with self._lock:
+            self._retries[endpoint] += 1
+
+    def observe_rejection(self, endpoint: str) -> None:
+        with self._lock:
+            self._rejections[endpoint] += 1
+
+    def observe_waits(self, gate_seconds: float, throttle_seconds: float) -> None:
+        with self._lock:
+            self._gate_wait += gate_seconds
+            self._throttle_wait += throttle_seconds
+
+    def observe_webhook_events(self, **counts: int) -> None:
+        """Webhook inbox counters, e.g. received=, queued=, collapsed=."""
+        with self._lock:
+            for outcome, value in counts.items():
+                self._webhook_events[outcome] += value
+
+    def to_prometheus(self, circuits: Optional[Dict[str, Dict[str, Any]]] = None) -> str:
+        """Renders all metrics in the Prometheus text exposition format."""
+        circuits = circuits or {}
+        lines = []
+
+        def family(name: str, kind: str, help_text: str) -> None:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            family("moysklad_requests_total", "counter", "HTTP requests sent to Moysklad.")
+            for (endpoint, method), value in sorted(self._requests.items()):
+                lines.append(f"moysklad_requests_total{_labels(endpoint=endpoint, method=method)} {value}")
+
+            family("moysklad_responses_total", "counter", "Moysklad responses by status code.")
+            for (endpoint, status), value in sorted(self._statuses.items()):
+                lines.append(f"moysklad_responses_total{_labels(endpoint=endpoint, status=status)} {value}")
+
+            family("moysklad_request_errors_total", "counter", "Requests that failed without a response.")
+            for endpoint, value in sorted(self._errors.items()):
+                lines.append(f"moysklad_request_errors_total{_labels(endpoint=endpoint)} {value}")
+
+            family("moysklad_retries_total", "counter", "Request attempts repeated after 429/5xx/network errors.")
+            for endpoint, value in sorted(self._retries.items()):
+                lines.append(f"moysklad_retries_total{_labels(endpoint=endpoint)} {value}")
+
+            family("moysklad_request_duration_seconds", "histogram", "Moysklad request latency.")
+            for endpoint in sorted(self._latency_count):
+                buckets = self._latency_buckets[endpoint]
+                for bound, value in zip(LATENCY_BUCKETS, buckets):
+                    lines.append(
+                        f"moysklad_request_duration_seconds_bucket{_labels(endpoint=endpoint, le=bound)} {value}"
+                    )
+                count = self._latency_count[endpoint]
+                lines.append(
+                    f"moysklad_request_duration_seconds_bucket{_labels(endpoint=endpoint, le='+Inf')} {count}"
+                )
+                lines.append(
+                    f"moysklad_request_duration_seconds_sum{_labels(endpoint=endpoint)} "
+                    f"{self._latency_sum[endpoint]:.6f}"
+                )
+                lines.append(f"moysklad_request_duration_seconds_count{_labels(endpoint=endpoint)} {count}")
+
+            family("moysklad_throttle_wait_seconds_total", "counter", "Time spent waiting for a rate-limit slot.")
+            lines.append(f"moysklad_throttle_wait_seconds_total {self._throttle_wait:.6f}")
+
+            family("moysklad_gate_wait_seconds_total", "counter", "Time spent waiting on concurrency gates.")
+            lines.append(f"moysklad_gate_wait_seconds_total {self._gate_wait:.6f}")
+
+            family("moysklad_circuit_rejections_total", "counter", "Requests short-circuited by an open circuit.")
+            for endpoint, value in sorted(self._rejections.items()):
+                lines.append(f"moysklad_circuit_rejections_total{_labels(endpoint=endpoint)} {value}")
+
+            family("moysklad_webhook_events_total", "counter",
+                   "Webhook events by outcome (collapsed = merged into another event for the same entity).")
+            for outcome, value in sorted(self._webhook_events.items()):
+                lines.append(f"moysklad_webhook_events_total{_labels(outcome=outcome)} {value}")
+
+        family("moysklad_circuit_trips_total", "counter", "Times the endpoint circuit opened.")
+        for endpoint, circuit in sorted(circuits.items()):
+            lines.append(f"moysklad_circuit_trips_total{_labels(endpoint=endpoint)} {circuit['trips']}")
+
+        family("moysklad_circuit_state", "gauge", "Circuit state: 0=closed, 1=half_open, 2=open.")
+        for endpoint, circuit in sorted(circuits.items()):
+            value = CIRCUIT_STATE_VALUES.get(circuit["state"], 0)
+            lines.append(f"moysklad_circuit_state{_labels(endpoint=endpoint)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def totals(self) -> Dict[str, float]:
+        """Aggregates over all endpoints, e.g. to diff before/after a benchmark phase."""
+        with self._lock:
+            return {
+                "requests": sum(self._requests.values()),
+                "retries": sum(self._retries.values()),
+                "network_errors": sum(self._errors.values()),
+                "rate_limited": sum(
+                    value for (_, status), value in self._statuses.items() if status == 429
+                ),
+                "circuit_rejections": sum(self._rejections.values()),
+                "network_seconds": sum(self._latency_sum.values()),
+                "throttle_wait": self._throttle_wait,
+                "gate_wait": self._gate_wait,
+            }
+
+    def summary(self, circuits: Optional[Dict[str, Dict[str, Any]]] = None) -> str:
+        """Short human-readable digest, printed at the end of management commands."""
+        circuits = circuits or {}
+        totals = self.totals()
+        with self._lock:
+            lines = [
+                f"Moysklad: requests={totals['requests']} retries={totals['retries']} "
+                f"network_errors={totals['network_errors']} circuit_rejections={totals['circuit_rejections']}",
+                f"  time: network={totals['network_seconds']:.1f}s throttle_wait={totals['throttle_wait']:.1f}s "
+                f"gate_wait={totals['gate_wait']:.1f}s",
+            ]
+            for endpoint in sorted(self._latency_count):
+                count = self._latency_count[endpoint]
+                average = self._latency_sum[endpoint] / count if count else 0.0
+                statuses = ", ".join(
+                    f"{status}={value}"
+                    for (key, status), value in sorted(self._statuses.items())
+                    if key == endpoint
+                )
+                lines.append(f"  {endpoint}: {count} req, avg {average:.2f}s [{statuses}]")
+            if self._webhook_events:
+                lines.append("  webhook events: " + " ".join(
+                    f"{outcome}={value}" for outcome, value in sorted(self._webhook_events.items())
+                ))
+        tripped = [endpoint for endpoint, circuit in sorted(circuits.items()) if circuit["trips"]]
+        if tripped:
+            lines.append(f"  circuits tripped: {', '.join(tripped)}")
+        return "\n".join(lines)
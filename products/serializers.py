@@ -24,7 +24,7 @@ class ProductInlineSerializer(serializers.Serializer):
 class ProductShotsSerializer(serializers.ModelSerializer):
     class Meta:
         model = ProductShots
-        fields = "__all__"
+        exclude = ("moysklad_product_id", "moysklad_id", "moysklad_signature")
 
 
 class ProductColorSerializer(serializers.ModelSerializer):
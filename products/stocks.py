@@ -0,0 +1,303 @@
+"""
+Set-based application of Moysklad stock levels to ProductPrice.stock.
+
+Rows are resolved by guid in one query per batch and only prices whose
+stock actually changed are written, with a single `bulk_update`.
+
+Two sources are supported:
+
+  - `report/stock/all` — the full report, paged; after a complete pass the
+    variants that did not appear in it are set to 0;
+  - `report/stock/all/current?changedSince=...` — totals of just the
+    assortment changed since the stored watermark (one small request).
+
+Between those runs retail sales and shipments (`retaildemand`, `demand`
+webhook events) move stock directly: the document's positions are fetched
+in one request and the difference to what was already applied for it
+(`StockDocument`) is subtracted with atomic `F()` updates, so updated,
+deleted or repeated documents are accounted exactly once. Absolute writes
+stamp `ProductPrice.stock_set_at`; a document change older than that stamp
+is already part of the stored stock, so only its positions are recorded.
+Customer orders only reserve goods — their stock moves with the shipment —
+so they are ignored. Documents first seen through UPDATE/DELETE (created
+before tracking began) are left to the stock report.
+"""
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from products.models import ProductPrice, StockDocument
+from products.moysklad_client import moysklad_client, MAX_PAGE_SIZE
+from products.sync import format_moment, get_watermark, parse_moment, set_watermark
+
+API_ROOT = "https://api.moysklad.ru/api/remap/1.2/"
+STOCK_REPORT_URL = f"{API_ROOT}report/stock/all"
+CURRENT_STOCK_URL = f"{API_ROOT}report/stock/all/current"
+
+STOCKS_SYNC_KEY = "stocks"
+# Документы, списывающие остаток (розничная продажа и отгрузка)
+STOCK_DOCUMENT_TYPES = ("retaildemand", "demand")
+# Сколько цен обновлять одним запросом
+BULK_BATCH_SIZE = 500
+# Запас на расхождение часов с МоимСкладом при сдвиге отметки времени
+CLOCK_SKEW = timedelta(minutes=1)
+
+
+@dataclass
+class StockSyncResult:
+    rows: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    missing: int = 0
+    zeroed: int = 0
+    fetch_seconds: float = 0.0
+    write_seconds: float = 0.0
+    # Полный проход остановлен по `stop` между страницами (обнуления не было)
+    stopped: bool = False
+    # guid строк, которых нет в БД (для отчёта вебхука)
+    missing_guids: List[str] = field(default_factory=list)
+
+
+def _guid_from_href(href: str) -> str:
+    return urlparse(href).path.rstrip('/').split('/')[-1]
+
+
+def _to_stock(value) -> int:
+    try:
+        return int(float(value or 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+def parse_report_rows(rows: Iterable[Dict[str, Any]]) -> Dict[str, int]:
+    """guid -> stock for `report/stock/all` (and stock webhook) rows."""
+    stocks: Dict[str, int] = {}
+    for row in rows:
+        href = ((row or {}).get('meta') or {}).get('href')
+        if href:
+            stocks[_guid_from_href(href)] = _to_stock(row.get('stock'))
+    return stocks
+
+
+def apply_stocks(stocks: Dict[str, int], result: StockSyncResult, seen: Optional[Set[int]] = None,
+                 as_of: Optional[datetime] = None) -> None:
+    """
+    Writes changed stocks with one bulk_update and stamps `stock_set_at` with
+    `as_of` (when the values were read, now by default) on every price found;
+    records the pks it saw in `seen`.
+    """
+    started = time.monotonic()
+    as_of = as_of or timezone.now()
+    result.rows += len(stocks)
+    prices = list(ProductPrice.objects.filter(guid__in=stocks.keys()).only('pk', 'guid', 'stock'))
+    found = set()
+    changed = []
+    for price in prices:
+        guid = str(price.guid)
+        found.add(guid)
+        if seen is not None:
+            seen.add(price.pk)
+        if price.stock != stocks[guid]:
+            price.stock = stocks[guid]
+            changed.append(price)
+    if changed:
+        ProductPrice.objects.bulk_update(changed, ['stock'], batch_size=BULK_BATCH_SIZE)
+    if prices:
+        # И неизменившимся: значение подтверждено на момент as_of
+        ProductPrice.objects.filter(pk__in=[price.pk for price in prices]).update(stock_set_at=as_of)
+    result.updated += len(changed)
+    result.unchanged += len(prices) - len(changed)
+    missing = [guid for guid in stocks if guid not in found]
+    result.missing += len(missing)
+    result.missing_guids.extend(missing)
+    result.write_seconds += time.monotonic() - started
+
+
+def apply_stocks_in_chunks(stocks: Dict[str, int], result: StockSyncResult,
+                           chunk_size: int = BULK_BATCH_SIZE,
+                           as_of: Optional[datetime] = None) -> List[Tuple[str, Exception]]:
+    """
+    `apply_stocks` with a transaction per `chunk_size` rows, so row locks are
+    held briefly; a failed chunk is rolled back alone and its guids are
+    returned with the error.
+    """
+    failed = []
+    as_of = as_of or timezone.now()
+    items = list(stocks.items())
+    for start in range(0, len(items), chunk_size):
+        chunk = dict(items[start:start + chunk_size])
+        try:
+            with transaction.atomic():
+                apply_stocks(chunk, result, as_of=as_of)
+        except Exception as e:
+            failed.extend((guid, e) for guid in chunk)
+    return failed
+
+
+def zero_unseen(seen: Set[int], result: StockSyncResult) -> None:
+    """Sets stock to 0 for every variant the full report didn't mention."""
+    started = time.monotonic()
+    stale = [
+        pk for pk in ProductPrice.objects.exclude(stock=0).values_list('pk', flat=True)
+        if pk not in seen
+    ]
+    for start in range(0, len(stale), BULK_BATCH_SIZE):
+        result.zeroed += ProductPrice.objects.filter(pk__in=stale[start:start + BULK_BATCH_SIZE]).update(stock=0)
+    result.write_seconds += time.monotonic() - started
+
+
+def sync_stocks_full(
+    limit: int = MAX_PAGE_SIZE, log=print, stop: Optional[Callable[[], bool]] = None,
+) -> StockSyncResult:
+    """
+    Pages through the whole stock report. Variants missing from it are zeroed
+    only after every page was applied, so a failed run never zeroes stock.
+    `stop` is checked between pages: a stopped pass keeps the applied pages
+    but zeroes nothing and leaves the watermark alone.
+    """
+    result = StockSyncResult()
+    seen: Set[int] = set()
+    started_at = timezone.now()
+    pages = moysklad_client.iter_pages(STOCK_REPORT_URL, page_size=limit)
+    while True:
+        if stop and stop():
+            pages.close()
+            log("Stop requested; stock pass left unfinished, nothing zeroed.")
+            result.stopped = True
+            return result
+        fetch_started = time.monotonic()
+        fetched_at = timezone.now()
+        page = next(pages, None)
+        result.fetch_seconds += time.monotonic() - fetch_started
+        if page is None:
+            break
+        with transaction.atomic():
+            apply_stocks(parse_report_rows(page.rows), result, seen, as_of=fetched_at)
+        log(f"[stocks page {page.offset // limit}] rows={result.rows} updated={result.updated} "
+            f"missing={result.missing}")
+
+    with transaction.atomic():
+        zero_unseen(seen, result)
+        # Полный проход заодно задаёт отметку для инкрементальных запусков
+        set_watermark(STOCKS_SYNC_KEY, started_at - CLOCK_SKEW)
+    return result
+
+
+def sync_stocks_delta(log=print, stop: Optional[Callable[[], bool]] = None) -> StockSyncResult:
+    """
+    Applies stocks changed since the last run; a full pass when there is no
+    watermark (`stop` is passed on to it).
+    """
+    since = get_watermark(STOCKS_SYNC_KEY)
+    if since is None:
+        log("No stock watermark yet, running a full pass.")
+        return sync_stocks_full(log=log, stop=stop)
+
+    result = StockSyncResult()
+    started_at = timezone.now()
+    fetch_started = time.monotonic()
+    rows = moysklad_client.get_json(
+        CURRENT_STOCK_URL,
+        # zeroLines: товары, остаток которых стал нулевым, тоже нужны
+        params={"changedSince": format_moment(since), "include": "zeroLines"},
+    ) or []
+    result.fetch_seconds += time.monotonic() - fetch_started
+
+    stocks = {row['assortmentId']: _to_stock(row.get('stock')) for row in rows if row.get('assortmentId')}
+    failed = apply_stocks_in_chunks(stocks, result, as_of=started_at)
+    if failed:
+        # Отметку не двигаем — следующий запуск повторит эти изменения
+        raise failed[0][1]
+    set_watermark(STOCKS_SYNC_KEY, started_at - CLOCK_SKEW)
+    log(f"[stocks delta since {format_moment(since)}] rows={result.rows} updated={result.updated}")
+    return result
+
+
+def parse_document_moment(value: Optional[str]) -> Optional[datetime]:
+    """Like `parse_moment`, keeping the milliseconds Moysklad sends."""
+    if not value:
+        return None
+    moment = parse_moment(value)
+    if len(value) > 20 and value[20:23].isdigit():
+        moment += timedelta(milliseconds=int(value[20:23].ljust(3, "0")))
+    return moment
+
+
+def fetch_document_positions(href: str) -> Tuple[Dict[str, int], Optional[datetime]]:
+    """
+    (guid -> quantity of a document's positions, when it was last changed);
+    positions are {} while it isn't posted (applicable).
+    """
+    document = moysklad_client.get_json(href, params={"expand": "positions"})
+    changed_at = parse_document_moment(document.get("updated") or document.get("moment"))
+    if not document.get("applicable", True):
+        return {}, changed_at
+    positions = document.get("positions") or {}
+    rows = positions.get("rows")
+    meta = positions.get("meta") or {}
+    if rows is None or len(rows) < meta.get("size", 0):
+        # Позиций больше, чем пришло в expand — дочитываем постранично
+        rows = [row for _, row in moysklad_client.iter_rows(meta["href"])]
+
+    quantities: Dict[str, float] = defaultdict(float)
+    for row in rows:
+        assortment_href = ((row.get("assortment") or {}).get("meta") or {}).get("href")
+        if assortment_href:
+            quantities[_guid_from_href(assortment_href)] += float(row.get("quantity") or 0)
+    return {guid: _to_stock(quantity) for guid, quantity in quantities.items()}, changed_at
+
+
+def apply_stock_document(entity_type: str, document_id: str, positions: Optional[Dict[str, int]],
+                         changed_at: Optional[datetime] = None) -> int:
+    """
+    Subtracts `positions` (None — the document was deleted) minus what was
+    already applied for the document; returns the number of prices changed.
+    Prices whose stock was set from an absolute source at or after
+    `changed_at` (when the document changed, now by default) already include
+    the change and are left alone.
+    """
+    changed_at = changed_at or timezone.now()
+    with transaction.atomic():
+        document, _ = StockDocument.objects.select_for_update().get_or_create(
+            moysklad_id=document_id, defaults={"entity_type": entity_type},
+        )
+        if document.deleted:
+            return 0
+        new = positions or {}
+        by_amount: Dict[int, List[str]] = defaultdict(list)
+        for guid in set(new) | set(document.positions):
+            amount = new.get(guid, 0) - document.positions.get(guid, 0)
+            if amount:
+                by_amount[amount].append(guid)
+        changed = 0
+        for amount, guids in by_amount.items():
+            changed += ProductPrice.objects.filter(guid__in=guids).filter(
+                Q(stock_set_at__isnull=True) | Q(stock_set_at__lt=changed_at)
+            ).update(stock=F("stock") - amount)
+        document.positions = new
+        document.deleted = positions is None
+        document.save()
+    return changed
+
+
+def sync_stock_document(event, write_lock=None) -> int:
+    """Applies a retaildemand/demand webhook event (a `WebhookEvent`, saved or not)."""
+    known = StockDocument.objects.filter(moysklad_id=event.entity_id).exists()
+    if not known and event.action != "CREATE":
+        # Документ старше учёта — его уже учитывает отчёт об остатках
+        return 0
+    if event.action == "DELETE":
+        # Удалённый документ уже не прочитать — время берём из события
+        positions, changed_at = None, parse_document_moment(event.moment)
+    else:
+        positions, changed_at = fetch_document_positions(event.href)
+    with write_lock or nullcontext():
+        return apply_stock_document(event.entity_type, event.entity_id, positions, changed_at)
@@ -0,0 +1,241 @@
+"""
+Incremental (delta) synchronisation of products with Moysklad.
+
+Only entities changed since the stored watermark are requested:
+
+  - `entity/product?filter=updated>=<watermark>` (archived included, they are
+    removed locally), walked in `updated` order with a keyset cursor rather
+    than offsets; rows of the cursor second already had are read again, not
+    skipped by offset, so products edited while we sync cannot shift rows
+    past us (see iter_changed_products for the one exception);
+  - deletions come from the audit log (`eventType=delete`), which has its own
+    watermark.
+
+Every page is applied through the bulk importer and the watermark is moved
+in the same transaction, so an interrupted sync resumes exactly where the
+last committed page ended.
+
+A complete full import is finalized by `sweep_unseen_prices`: every import
+stamps `ProductPrice.last_seen_at`, so prices not stamped since the run began
+are gone from Moysklad (deleted or archived while a webhook was missed).
+They are removed and their Products unpublished with a few set-based queries.
+"""
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+from zoneinfo import ZoneInfo
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from products.dimensions import DimensionCache
+from products.importer import import_product_rows, queue_pending_images, save_pending_images
+from products.models import Product, ProductPrice, SyncState
+from products.moysklad_client import moysklad_client, MAX_EXPAND_PAGE_SIZE
+from products.utils import PRODUCT_EXPAND_PARAMS, delete_product
+
+API_ROOT = "https://api.moysklad.ru/api/remap/1.2/"
+PRODUCTS_URL = f"{API_ROOT}entity/product"
+AUDIT_URL = f"{API_ROOT}audit"
+# Moysklad caps audit pages at 100 rows.
+AUDIT_PAGE_SIZE = 100
+
+PRODUCTS_SYNC_KEY = "products"
+PRODUCTS_DELETED_SYNC_KEY = "products_deleted"
+
+# Moysklad filters accept second precision; values carry milliseconds.
+_MOMENT_FORMAT = "%Y-%m-%d %H:%M:%S"
+# A watermark second older than this can't receive new edits any more
+# (allowing for clock skew), so a finished pass may step past it.
+SETTLE_MARGIN = timedelta(minutes=5)
+# Rows of the cursor second re-read on the next page once a single second
+# holds more rows than that page can (see iter_changed_products).
+CURSOR_OVERLAP = MAX_EXPAND_PAGE_SIZE // 2
+
+
+def _moysklad_tz() -> ZoneInfo:
+    return ZoneInfo(getattr(settings, "MOYSKLAD_TIMEZONE", "Europe/Moscow"))
+
+
+def parse_moment(value: str) -> datetime:
+    """'2024-07-08 10:17:30.123' in the account timezone -> aware datetime."""
+    return datetime.strptime(value[:19], _MOMENT_FORMAT).replace(tzinfo=_moysklad_tz())
+
+
+def format_moment(value: datetime) -> str:
+    return value.astimezone(_moysklad_tz()).strftime(_MOMENT_FORMAT)
+
+
+def get_watermark(key: str) -> Optional[datetime]:
+    return SyncState.objects.filter(key=key).values_list("watermark", flat=True).first()
+
+
+def set_watermark(key: str, watermark: datetime) -> None:
+    SyncState.objects.update_or_create(key=key, defaults={"watermark": watermark})
+
+
+def settled(watermark: datetime) -> datetime:
+    """
+    `updated>=` re-reads the rows of the watermark second on every run; once
+    that second is safely in the past the next run can start after it.
+    """
+    if watermark + SETTLE_MARGIN < timezone.now():
+        return watermark + timedelta(seconds=1)
+    return watermark
+
+
+def iter_changed_products(
+    since: Optional[datetime], limit: int = MAX_EXPAND_PAGE_SIZE
+) -> Iterator[Tuple[List[Dict[str, Any]], Optional[datetime]]]:
+    """
+    Yields `(rows, cursor)` for products changed at or after `since` (all
+    products when None). Every row updated strictly before `cursor` has been
+    yielded by then, so `cursor` is safe to store as the new watermark.
+
+    The next page starts at the cursor second again and the rows of it we've
+    had are dropped, so an edit that moves one of them on can't shift an
+    unread row past us. Only a second holding more than CURSOR_OVERLAP rows
+    (a bulk edit) is walked with an offset, re-reading CURSOR_OVERLAP of its
+    rows: that stays safe while fewer of them are edited during the sync.
+    """
+    cursor = format_moment(since) if since else None
+    seen_at_cursor = set()
+
+    while True:
+        filters = ["archived=true", "archived=false"]
+        if cursor:
+            filters.insert(0, f"updated>={cursor}")
+        params = dict(PRODUCT_EXPAND_PARAMS, order="updated,asc", filter=";".join(filters))
+        # Rows sharing the cursor second come first; the ones we've had are read again and dropped.
+        offset = max(len(seen_at_cursor) - CURSOR_OVERLAP, 0)
+        page_size = min(limit + len(seen_at_cursor) - offset, MAX_EXPAND_PAGE_SIZE)
+        page = moysklad_client.get_page(PRODUCTS_URL, params, page_size=page_size, offset=offset)
+        rows = [row for row in page.rows if row.get("id") not in seen_at_cursor]
+
+        last_moment = None
+        if page.rows:
+            last_moment = (page.rows[-1].get("updated") or "")[:19] or None
+        if last_moment and last_moment != cursor:
+            cursor = last_moment
+            seen_at_cursor = set()
+        seen_at_cursor.update(
+            row.get("id") for row in page.rows if (row.get("updated") or "")[:19] == cursor
+        )
+
+        if rows:
+            yield rows, parse_moment(cursor) if cursor else None
+        if len(page.rows) < page_size:
+            return
+
+
+def iter_deleted_product_ids(since: datetime) -> Iterator[Tuple[str, datetime]]:
+    """Yields `(guid, moment)` of products deleted at or after `since`, from the audit log."""
+    params = {"filter": f"moment>={format_moment(since)};entityType=product;eventType=delete"}
+    for _, context in moysklad_client.iter_rows(AUDIT_URL, params, page_size=AUDIT_PAGE_SIZE, prefetch=0):
+        moment = parse_moment(context["moment"])
+        events_href = ((context.get("events") or {}).get("meta") or {}).get("href")
+        if not events_href:
+            continue
+        for _, event in moysklad_client.iter_rows(events_href, page_size=AUDIT_PAGE_SIZE, prefetch=0):
+            entity_meta = (event.get("entity") or {}).get("meta") or {}
+            if event.get("eventType") == "delete" and entity_meta.get("type") == "product":
+                yield urlparse(entity_meta["href"]).path.rstrip('/').split('/')[-1], moment
+
+
+@dataclass
+class DeltaSyncResult:
+    full: bool = False
+    pages: int = 0
+    ok: int = 0
+    err: int = 0
+    changed: int = 0
+    unchanged: int = 0
+    archived: int = 0
+    deleted: int = 0
+    watermark: Optional[datetime] = None
+    # Остановлено по `stop` между страницами
+    stopped: bool = False
+
+
+def sync_products_delta(
+    limit: int = MAX_EXPAND_PAGE_SIZE, log=print, stop: Optional[Callable[[], bool]] = None,
+) -> DeltaSyncResult:
+    """
+    Applies everything changed in Moysklad since the last run. Without a
+    stored watermark this is a full crawl that establishes one.
+
+    `stop` is checked after every page; once it returns True the sync ends
+    there (deletions included) and the next run resumes from the watermark
+    of the last committed page.
+    """
+    since = get_watermark(PRODUCTS_SYNC_KEY)
+    deleted_since = get_watermark(PRODUCTS_DELETED_SYNC_KEY)
+    result = DeltaSyncResult(full=since is None, watermark=since)
+    dimensions = DimensionCache()
+    log(f"Delta sync of products since {format_moment(since) if since else 'the beginning (full crawl)'}")
+
+    for rows, cursor in iter_changed_products(since, limit):
+        active = [row for row in rows if not row.get("archived")]
+        archived = [row["id"] for row in rows if row.get("archived") and row.get("id")]
+        with transaction.atomic():
+            page = import_product_rows(active, with_images=False, dimensions=dimensions)
+            queue_pending_images(page)
+            for guid in archived:
+                delete_product(guid)
+            if cursor and (result.watermark is None or cursor > result.watermark):
+                result.watermark = cursor
+                set_watermark(PRODUCTS_SYNC_KEY, cursor)
+        save_pending_images(page)
+        result.pages += 1
+        result.ok += page.ok
+        result.err += page.err
+        result.changed += page.changed
+        result.unchanged += page.unchanged
+        result.archived += len(archived)
+        log(f"[page {result.pages}] rows={len(rows)} ok={result.ok} (changed={result.changed}) err={result.err} "
+            f"archived={result.archived} watermark={format_moment(result.watermark) if result.watermark else '-'}")
+        if stop and stop():
+            log("Stop requested; the next run resumes from the stored watermark.")
+            result.stopped = True
+            return result
+    if result.pages and settled(result.watermark) != result.watermark:
+        result.watermark = settled(result.watermark)
+        set_watermark(PRODUCTS_SYNC_KEY, result.watermark)
+
+    # Deletions are only needed relative to an earlier state we actually hold.
+    deleted_from = deleted_since or since
+    if deleted_from:
+        deleted = list(iter_deleted_product_ids(deleted_from))
+        if deleted:
+            with transaction.atomic():
+                for guid, _ in deleted:
+                    delete_product(guid)
+                set_watermark(PRODUCTS_DELETED_SYNC_KEY, settled(max(moment for _, moment in deleted)))
+        elif not deleted_since:
+            set_watermark(PRODUCTS_DELETED_SYNC_KEY, deleted_from)
+        result.deleted = len(deleted)
+    elif result.watermark:
+        set_watermark(PRODUCTS_DELETED_SYNC_KEY, result.watermark)
+
+    return result
+
+
+def sweep_unseen_prices(seen_since: datetime, log=print) -> Tuple[int, int]:
+    """
+    Deletes ProductPrices not seen since `seen_since` and unpublishes the
+    Products this leaves without prices; returns (deleted prices, unpublished
+    products). Only call it after a full import that covered every page.
+    """
+    with transaction.atomic():
+        stale = ProductPrice.objects.filter(last_seen_at__lt=seen_since)
+        # Снимаем с публикации только товары, потерявшие цены сейчас, а не любые товары без цен
+        affected = list(Product.objects.filter(price__in=stale).values_list('pk', flat=True).distinct())
+        # Связи M2M удаляются каскадом пачками, без запросов на каждую цену
+        deleted = stale.delete()[1].get(ProductPrice._meta.label, 0)
+        unpublished = Product.objects.filter(
+            pk__in=affected, public=True, price__isnull=True,
+        ).update(public=False)
+    log(f"Sweep: deleted prices={deleted} unpublished products={unpublished}")
+    return deleted, unpublished
@@ -1,3 +1,485 @@
-from django.test import TestCase
+import gzip
+import io
+import os
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
+
+from products.image_queue import claim_jobs, drain_image_queue, enqueue_images
+from products.instance_lock import InstanceLock
+from products.job_queue import RETRY_BASE_DELAY
+from products.management.commands.import_products import LOCK_NAME as IMPORT_LOCK_NAME
+from products.management.commands.import_products import Command as ImportProductsCommand
+from products.moysklad_client import MoyskladClient, MoyskladCircuitOpenError, MoyskladClientError, endpoint_key, moysklad_client
+from products.moysklad_fake import API_ROOT, FakeCatalog, FakeMoyskladAdapter
+from products.models import ImageSyncJob, ImportJob, Product, ProductPrice, StockDocument, WebhookEvent
+from products.stocks import STOCKS_SYNC_KEY, sync_stocks_delta, sync_stocks_full
+from products.sync import PRODUCTS_SYNC_KEY, get_watermark, iter_changed_products, sync_products_delta
+from products.webhook_inbox import (
+    apply_events, claim_events, coalesce, drain_webhook_inbox, enqueue_events, parse_events,
+)
+
+
+class FakeMoyskladMixin:
+    """Routes the shared client to an offline FakeCatalog for the test."""
+    catalog_size = 21
+
+    def setUp(self):
+        super().setUp()
+        self.catalog = FakeCatalog(size=self.catalog_size, invalid_ratio=0, image_bytes=100)
+        self.fake = FakeMoyskladAdapter(self.catalog)
+        moysklad_client.mount(self.fake)
+
+    def tearDown(self):
+        moysklad_client.mount(HTTPAdapter())
+        super().tearDown()
+
+    def import_products(self, **options):
+        out = io.StringIO()
+        call_command("import_products", stdout=out, stderr=out, restart=True, **options)
+        return out.getvalue()
+
+
+class MoyskladClientTests(FakeMoyskladMixin, TestCase):
+    products_url = f"{API_ROOT}entity/product"
+
+    def test_circuit_opens_fails_fast_and_closes_after_a_probe(self):
+        client = MoyskladClient("login", "password", circuit_failure_threshold=2, circuit_cooldown_seconds=0.05)
+        client.mount(FakeMoyskladAdapter(self.catalog, latency=0, error_rate_5xx=1.0))
+        fake = client._session.get_adapter(self.products_url)
+        endpoint = endpoint_key(self.products_url)
+
+        def state():
+            return client.circuit_states()[endpoint]["state"]
+
+        with mock.patch("products.moysklad_client.time.sleep"):
+            with self.assertRaises(MoyskladCircuitOpenError):
+                client.get_json(self.products_url)
+            self.assertEqual(state(), "open")
+
+            # Пока цепь открыта, запросы до МоегоСклада не доходят
+            requests_before = fake.stats["requests"]
+            with self.assertRaises(MoyskladCircuitOpenError):
+                client.get_json(self.products_url)
+            self.assertEqual(fake.stats["requests"], requests_before)
+
+        time.sleep(0.1)
+        fake.error_rate_5xx = 0.0
+        states = []
+        route = fake._route
+
+        def probe(request):
+            states.append(state())
+            return route(request)
+
+        with mock.patch.object(fake, "_route", side_effect=probe):
+            client.get_json(self.products_url)
+
+        self.assertEqual(states, ["half_open"])
+        self.assertEqual(state(), "closed")
+
+    def test_iter_rows_resumes_from_start_offset(self):
+        rows = list(moysklad_client.iter_rows(self.products_url, page_size=5, start_offset=7, prefetch=2))
+
+        self.assertEqual([offset for offset, _ in rows], list(range(7, 21)))
+        self.assertEqual([row["id"] for _, row in rows], [self.catalog.product_id(i) for i in range(7, 21)])
+
+    def test_iter_rows_stops_on_a_short_page_or_at_meta_size(self):
+        # 21 строка: последняя страница короткая
+        requests_before = self.fake.stats["requests"]
+        self.assertEqual(len(list(moysklad_client.iter_rows(self.products_url, page_size=5, prefetch=2))), 21)
+        self.assertEqual(self.fake.stats["requests"] - requests_before, 5)
+
+        # 20 строк: последняя страница полная, дальше не идём по meta.size
+        self.catalog.delete(20)
+        requests_before = self.fake.stats["requests"]
+        self.assertEqual(len(list(moysklad_client.iter_rows(self.products_url, page_size=5, prefetch=2))), 20)
+        self.assertEqual(self.fake.stats["requests"] - requests_before, 4)
+
+    def test_truncated_download_is_resumed_with_range(self):
+        image_id = self.catalog.image_id(0, 0)
+        self.fake.truncated_downloads = 1
+        requests_before = self.fake.stats["requests"]
+        buffer = io.BytesIO()
+
+        with mock.patch("products.moysklad_client.time.sleep"):
+            download = moysklad_client.download(f"{API_ROOT}download/{image_id}", buffer)
+
+        self.assertTrue(download.resumed)
+        self.assertEqual(self.fake.stats["requests"] - requests_before, 2)
+        self.assertEqual(buffer.getvalue(), self.catalog.image_bytes_for(image_id))
+
+
+class SweepUnseenPricesTests(FakeMoyskladMixin, TestCase):
+    def test_full_import_removes_prices_missing_from_moysklad(self):
+        self.import_products()
+        self.assertEqual(ProductPrice.objects.count(), 21)
+
+        # «Товар 0» — строки 0..6: удалены в МоёмСкладе целиком
+        for index in range(7):
+            self.catalog.delete(index)
+        self.catalog.delete(10)
+        self.import_products()
+
+        self.assertEqual(ProductPrice.objects.count(), 13)
+        self.assertFalse(Product.objects.get(title="Товар 0").public)
+        self.assertTrue(Product.objects.get(title="Товар 1").public)
+
+    def test_sweep_leaves_products_it_did_not_touch(self):
+        self.import_products()
+        Product.objects.create(title="Из админки")
+        self.catalog.delete(0)
+
+        self.import_products()
+
+        self.assertTrue(Product.objects.get(title="Из админки").public)
+
+    def test_no_sweep(self):
+        self.import_products()
+        self.catalog.delete(0)
+
+        self.import_products(no_sweep=True)
+
+        self.assertEqual(ProductPrice.objects.count(), 21)
+
+
+class ImportProductRowsTests(FakeMoyskladMixin, TestCase):
+    def test_unchanged_prices_are_linked_to_a_recreated_product(self):
+        self.import_products()
+        Product.objects.filter(title="Товар 0").delete()
+
+        self.import_products()
+
+        product = Product.objects.get(title="Товар 0")
+        self.assertEqual(product.price.count(), 7)
+        self.assertTrue(product.public)
+
+    def test_gzip_report_is_readable_after_a_failed_run(self):
+        path = os.path.join(tempfile.mkdtemp(), "invalid.csv.gz")
+
+        def fail(command, *args):
+            command.report.check_page(0, [{"id": self.catalog.product_id(0), "name": "Без характеристик"}])
+            raise CommandError("МойСклад недоступен")
+
+        with mock.patch.object(ImportProductsCommand, "_run_sequential", autospec=True, side_effect=fail):
+            with self.assertRaises(CommandError):
+                self.import_products(invalid_report=path)
+
+        with gzip.open(path, "rt", encoding="utf-8") as report:
+            self.assertIn("Без характеристик", report.read())
+
+    @override_settings(MOYSKLAD_IMAGE_QUEUE=True)
+    def test_unchanged_rows_queue_no_images(self):
+        self.import_products()
+        self.assertEqual(ImageSyncJob.objects.count(), 21)
+        ImageSyncJob.objects.all().delete()
+
+        self.import_products()
+        self.assertFalse(ImageSyncJob.objects.exists())
+
+        # Новый снимок меняет отпечаток строки
+        self.catalog.images_per_product = 2
+        self.import_products()
+        self.assertEqual(ImageSyncJob.objects.count(), 21)
+
+
+class ImportProductsCommandTests(FakeMoyskladMixin, TestCase):
+    def test_refuses_to_start_while_another_run_holds_the_lock(self):
+        lock = InstanceLock(IMPORT_LOCK_NAME)
+        self.assertTrue(lock.acquire())
+        try:
+            with self.assertRaises(CommandError):
+                self.import_products()
+        finally:
+            lock.release()
+        self.assertFalse(ImportJob.objects.exists())
+
+    def test_dead_running_job_is_resumed(self):
+        job = ImportJob.objects.create(kind='products', params={"limit": 100, "name": None})
+
+        out = io.StringIO()
+        call_command("import_products", stdout=out, stderr=out)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.COMPLETED)
+        self.assertEqual(ImportJob.objects.count(), 1)
+
+    def test_incremental_run_is_recorded(self):
+        self.import_products(incremental=True)
+
+        job = ImportJob.objects.get(kind='products_incremental')
+        self.assertEqual((job.status, job.ok_count), (ImportJob.COMPLETED, 21))
+
+    def test_incremental_failure_raises_command_error(self):
+        error = MoyskladCircuitOpenError("circuit open", retry_after=60)
+        with mock.patch("products.management.commands.import_products.sync_products_delta", side_effect=error):
+            with self.assertRaises(CommandError):
+                self.import_products(incremental=True)
+
+        job = ImportJob.objects.get(kind='products_incremental')
+        self.assertEqual(job.status, ImportJob.FAILED)
+
+
+class DeltaSyncTests(FakeMoyskladMixin, TestCase):
+    def test_rows_edited_during_the_sync_do_not_shift_others_past_the_cursor(self):
+        seen = set()
+        # У всех строк каталога одна и та же секунда `updated`
+        for page, (rows, cursor) in enumerate(iter_changed_products(None, limit=5)):
+            seen.update(row["id"] for row in rows)
+            if page == 0:
+                for index in range(3):
+                    self.catalog.touch(index)
+
+        self.assertEqual(seen, {self.catalog.product_id(index) for index in range(21)})
+
+    def test_stop_ends_a_full_crawl_after_the_committed_page(self):
+        result = sync_products_delta(limit=5, log=lambda message: None, stop=lambda: True)
+
+        self.assertEqual((result.pages, result.stopped), (1, True))
+        self.assertEqual(ProductPrice.objects.count(), 5)
+        self.assertEqual(get_watermark(PRODUCTS_SYNC_KEY), result.watermark)
+
+
+class StockSyncTests(FakeMoyskladMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.import_products()
+
+    def stock(self, index):
+        return ProductPrice.objects.get(guid=self.catalog.product_id(index)).stock
+
+    def test_full_pass_zeroes_variants_missing_from_the_report(self):
+        ProductPrice.objects.update(stock=99)
+        self.catalog.delete(20)
+
+        result = sync_stocks_full(limit=5, log=lambda message: None)
+
+        self.assertEqual(result.zeroed, 1)
+        self.assertEqual((self.stock(3), self.stock(20)), (self.catalog.stock_value(3), 0))
+        self.assertIsNotNone(get_watermark(STOCKS_SYNC_KEY))
+
+    def test_failed_page_zeroes_nothing(self):
+        ProductPrice.objects.update(stock=99)
+        self.catalog.delete(20)
+        get_page = moysklad_client.get_page
+
+        def fail_third_page(url, params=None, *, offset=0, **kwargs):
+            if offset == 10:
+                raise MoyskladClientError("boom")
+            return get_page(url, params, offset=offset, **kwargs)
+
+        with mock.patch.object(moysklad_client, "get_page", side_effect=fail_third_page):
+            with self.assertRaises(MoyskladClientError):
+                sync_stocks_full(limit=5, log=lambda message: None)
+
+        self.assertEqual((self.stock(3), self.stock(20)), (self.catalog.stock_value(3), 99))
+        self.assertIsNone(get_watermark(STOCKS_SYNC_KEY))
+
+    def test_stopped_full_pass_zeroes_nothing(self):
+        ProductPrice.objects.update(stock=99)
+        self.catalog.delete(20)
+        pages = []
+
+        result = sync_stocks_full(limit=5, log=pages.append, stop=lambda: len(pages) == 1)
+
+        self.assertTrue(result.stopped)
+        self.assertEqual((self.stock(0), self.stock(20)), (self.catalog.stock_value(0), 99))
+        self.assertIsNone(get_watermark(STOCKS_SYNC_KEY))
+
+
+class StockDocumentTests(FakeMoyskladMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.import_products()
+        sync_stocks_full(log=lambda message: None)
+        # Отчёт об остатках — заведомо раньше документов теста
+        ProductPrice.objects.update(stock_set_at=timezone.now() - timedelta(minutes=1))
+
+    def stock(self, index):
+        return ProductPrice.objects.get(guid=self.catalog.product_id(index)).stock
+
+    def send(self, href, action, entity_type="retaildemand"):
+        payload = {
+            "auditContext": {"moment": self.catalog.now()},
+            "events": [{"meta": {"href": href, "type": entity_type}, "action": action}],
+        }
+        errors = apply_events(coalesce(parse_events(payload)), log=lambda message: None)
+        self.assertEqual(errors, [None])
+
+    def test_create_is_applied_once(self):
+        before = self.stock(3), self.stock(4)
+        href = self.catalog.add_document("retaildemand", {3: 2, 4: 1})
+        requests_before = self.fake.stats["requests"]
+
+        self.send(href, "CREATE")
+        self.assertEqual(self.fake.stats["requests"] - requests_before, 1)
+        self.send(href, "CREATE")
+
+        self.assertEqual((self.stock(3), self.stock(4)), (before[0] - 2, before[1] - 1))
+        self.assertEqual((self.stock(3), self.stock(4)), (self.catalog.stock_value(3), self.catalog.stock_value(4)))
+
+    def test_update_applies_the_difference_and_delete_restores(self):
+        before = self.stock(3), self.stock(4)
+        href = self.catalog.add_document("demand", {3: 2, 4: 1})
+        document_id = href.rsplit("/", 1)[-1]
+        self.send(href, "CREATE", "demand")
+
+        self.catalog.update_document(document_id, {3: 5})
+        self.send(href, "UPDATE", "demand")
+        self.send(href, "UPDATE", "demand")
+        self.assertEqual((self.stock(3), self.stock(4)), (before[0] - 5, before[1]))
+
+        self.catalog.delete_document(document_id)
+        self.send(href, "DELETE", "demand")
+        self.send(href, "DELETE", "demand")
+        self.assertEqual((self.stock(3), self.stock(4)), before)
+        self.assertTrue(StockDocument.objects.get(moysklad_id=document_id).deleted)
+
+    def test_update_of_unknown_document_is_ignored(self):
+        before = self.stock(5)
+        href = self.catalog.add_document("demand", {5: 1})
+
+        self.send(href, "UPDATE", "demand")
+
+        self.assertEqual(self.stock(5), before)
+        self.assertFalse(StockDocument.objects.exists())
+
+    def test_sale_already_in_absolute_stock_is_not_subtracted_again(self):
+        href = self.catalog.add_document("retaildemand", {3: 2})
+        document_id = href.rsplit("/", 1)[-1]
+        # Остаток после продажи пришёл раньше, чем воркер разобрал событие
+        sync_stocks_delta(log=lambda message: None)
+        self.assertEqual(self.stock(3), self.catalog.stock_value(3))
+
+        self.send(href, "CREATE")
+        self.assertEqual(self.stock(3), self.catalog.stock_value(3))
+
+        # Позиции всё равно запомнены: правка документа списывает только разницу
+        self.catalog.update_document(document_id, {3: 3})
+        self.send(href, "UPDATE")
+        self.assertEqual(self.stock(3), self.catalog.stock_value(3))
+
+
+class ImageQueueTests(FakeMoyskladMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = Product.objects.create(title="Товар")
+
+    def test_one_pending_job_per_variant(self):
+        self.assertEqual(enqueue_images([(self.product, self.catalog.images(0))]), 1)
+        newer = self.catalog.images(0, expand=True)
+
+        self.assertEqual(enqueue_images([(self.product, newer), (self.product, self.catalog.images(1))]), 1)
+
+        self.assertEqual(ImageSyncJob.objects.count(), 2)
+        self.assertEqual(ImageSyncJob.objects.get(source_id=self.catalog.product_id(0)).images, newer)
+
+    def test_running_variant_is_not_claimed_again(self):
+        enqueue_images([(self.product, self.catalog.images(0))])
+        jobs = claim_jobs(10)
+        self.assertEqual([(job.status, job.attempts) for job in jobs], [(ImageSyncJob.RUNNING, 1)])
+
+        # Новое обновление ждёт, пока текущая задача варианта не закончится
+        self.assertEqual(enqueue_images([(self.product, self.catalog.images(0))]), 1)
+        self.assertEqual(claim_jobs(10), [])
+
+    def test_failed_job_is_retried_with_backoff(self):
+        enqueue_images([(self.product, self.catalog.images(0))])
+        started = timezone.now()
+
+        with mock.patch("products.utils.save_images", return_value=["boom"]):
+            self.assertEqual(drain_image_queue(workers=1, log=lambda message: None), {"done": 0, "failed": 1})
+
+        job = ImageSyncJob.objects.get()
+        self.assertEqual((job.status, job.attempts, job.last_error), (ImageSyncJob.PENDING, 1, "boom"))
+        self.assertGreaterEqual(job.available_at, started + RETRY_BASE_DELAY)
+
+
+@override_settings(MOYSKLAD_WEBHOOK_COALESCE_SECONDS=0)
+class WebhookInboxTests(FakeMoyskladMixin, TestCase):
+    def enqueue(self, index, action="UPDATE"):
+        payload = {"events": [{"meta": {"href": self.catalog.product_href(index), "type": "product"}, "action": action}]}
+        return enqueue_events(parse_events(payload))
+
+    def drain(self):
+        return drain_webhook_inbox(workers=1, log=lambda message: None)
+
+    def test_events_are_applied_and_removed(self):
+        self.enqueue(0)
+        self.enqueue(8)
+
+        self.assertEqual(self.drain(), {"done": 2, "retry": 0, "failed": 0})
+
+        self.assertFalse(WebhookEvent.objects.exists())
+        self.assertTrue(ProductPrice.objects.filter(guid=self.catalog.product_id(8)).exists())
+
+    def test_claim_takes_one_event_per_product(self):
+        self.enqueue(0)
+        WebhookEvent.objects.create(
+            entity_type="product", action="DELETE", entity_id=self.catalog.product_id(0),
+            href=self.catalog.product_href(0),
+        )
+
+        events = claim_events(10)
+
+        self.assertEqual(len(events), 1)
+        self.assertEqual((events[0].action, events[0].collapsed), ("DELETE", 1))
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+
+        # Пока событие товара в работе, следующее для него не выдаётся
+        self.enqueue(0)
+        self.assertEqual(claim_events(10), [])
+
+    def test_failed_event_is_retried_with_backoff(self):
+        self.enqueue(0)
+        started = timezone.now()
+
+        with mock.patch("products.utils.fetch_products", side_effect=RuntimeError("boom")):
+            self.assertEqual(self.drain(), {"done": 0, "retry": 1, "failed": 0})
+
+        event = WebhookEvent.objects.get()
+        self.assertEqual((event.status, event.attempts), (WebhookEvent.PENDING, 1))
+        self.assertGreaterEqual(event.available_at, started + RETRY_BASE_DELAY)
+        self.assertIn("boom", event.last_error)
+
+    @override_settings(MOYSKLAD_WEBHOOK_EVENT_MAX_ATTEMPTS=2)
+    def test_event_is_dead_lettered_after_the_last_attempt(self):
+        self.enqueue(0)
+
+        with mock.patch("products.utils.fetch_products", side_effect=RuntimeError("boom")):
+            self.drain()
+            WebhookEvent.objects.update(available_at=timezone.now())
+            self.assertEqual(self.drain(), {"done": 0, "retry": 0, "failed": 1})
+
+        event = WebhookEvent.objects.get()
+        self.assertEqual((event.status, event.attempts), (WebhookEvent.FAILED, 2))
+
+    def test_new_event_does_not_join_a_retry_in_backoff(self):
+        self.enqueue(0)
+        with mock.patch("products.utils.fetch_products", side_effect=RuntimeError("boom")):
+            self.drain()
+
+        self.assertEqual(self.enqueue(0), (1, 0))
+
+        fresh = WebhookEvent.objects.get(attempts=0)
+        self.assertLessEqual(fresh.available_at, timezone.now())
+        self.assertEqual(self.drain()["done"], 1)
+
+    def test_open_circuit_reschedules_without_using_an_attempt(self):
+        self.enqueue(0)
+        started = timezone.now()
+        error = MoyskladCircuitOpenError("circuit open", retry_after=60)
+
+        with mock.patch("products.utils.fetch_products", side_effect=error):
+            self.assertEqual(self.drain(), {"done": 0, "retry": 1, "failed": 0})
+
+        event = WebhookEvent.objects.get()
+        self.assertEqual((event.status, event.attempts), (WebhookEvent.PENDING, 0))
+        self.assertGreaterEqual(event.available_at, started + timedelta(seconds=60))
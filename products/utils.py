@@ -1,8 +1,38 @@
-import time
+import os
+import re
+import tempfile
 from urllib.parse import urlparse
-from django.core.files.base import ContentFile
-from products.models import Category, ProductWeight, Product, ProductColor, ProductPrice
-from .moysklad_client import moysklad_client, MoyskladClientError
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from .moysklad_client import moysklad_client, MoyskladClientError, MAX_EXPAND_PAGE_SIZE
+
+IMAGE_CONTENT_TYPES = ("image/", "application/octet-stream")
+
+# Разворачиваем картинки прямо в ответе по товару, чтобы не делать
+# отдельный запрос за списком изображений на каждый товар.
+PRODUCT_EXPAND_PARAMS = {"expand": "images"}
+
+PRODUCTS_URL = "https://api.moysklad.ru/api/remap/1.2/entity/product"
+
+# photo_AbC1234.jpg -> photo.jpg (storage дописывает 7 символов к занятому имени)
+STORAGE_SUFFIX_RE = re.compile(r'_[a-zA-Z0-9]{7}(?=\.[^.]*$|$)')
+
+
+def fetch_products(product_ids):
+    """
+    Строки нескольких товаров одним запросом (filter=id=...;id=..., архивные тоже).
+    Удалённых в МоёмСкладе товаров в ответе просто нет.
+    """
+    product_ids = list(product_ids)
+    if len(product_ids) > MAX_EXPAND_PAGE_SIZE:
+        raise ValueError(f"Не больше {MAX_EXPAND_PAGE_SIZE} товаров за запрос.")
+    if not product_ids:
+        return []
+    conditions = [f"id={product_id}" for product_id in product_ids] + ["archived=true", "archived=false"]
+    params = dict(PRODUCT_EXPAND_PARAMS, filter=";".join(conditions))
+    return moysklad_client.get_page(PRODUCTS_URL, params, page_size=len(product_ids)).rows
+
 
 def get_images_data(url):
     try:
@@ -11,129 +41,130 @@ def get_images_data(url):
         print(f"Error fetching images data: {e}")
         return None
 
-def save_images(product, images_request_url):
-    images_data = get_images_data(images_request_url)
-    if images_data and images_data.get('rows'):
-        for i, image_meta in enumerate(images_data['rows']):
-            download_href = image_meta['meta'].get('downloadHref')
-            if not download_href:
-                print(f"Image meta without downloadHref at index {i}")
-                continue
-            try:
-                image_bytes = moysklad_client.get_binary(download_href, timeout=120)
-                image_content = ContentFile(image_bytes)
-                # Желательно дать имя файлу (если ваша модель ожидает):
-                # product.product_shots.create(image=ImageFile(image_content, name=f"{product.pk}_{i}.jpg"))
-                product.product_shots.create(image=image_content)
-                print(f"Image {i + 1} saved successfully for product {product.title}!")
-            except MoyskladClientError as e:
-                print(f"Error downloading image {i + 1}: {e}")
-                continue
-    else:
-        print("No images found.")
-
-def extract_name_color_weight(product_name):
-    parts = product_name.split(', ')
-    name = parts[0] if len(parts) > 0 else ''
-    color = parts[1] if len(parts) > 1 else None
-    weight = parts[2] if len(parts) > 2 else None
-    return name, color, weight
-
-def create_or_update_product(item) -> bool:
+def get_image_rows(images):
     """
-    Возвращает True, если товар/цена успешно обработаны (создана/обновлена ProductPrice),
-    False — если некорректные данные/пропуски и т.п.
-    Исключения наружу не бросаем — команда их перехватит и посчитает как ошибки.
+    Возвращает метаданные изображений товара. Если товар пришёл с expand=images
+    и список полный — используем его, иначе догружаем список по meta.href.
+    None — список получить не удалось (тогда ничего не удаляем).
     """
-    try:
-        product_name = item.get('name') or ''
-        if len(product_name.split(",")) < 3:
-            print(f"Product: {product_name} is invalid or incomplete.")
-            return False
-
-        product_code = item.get('code')
-        product_guid = item.get('id')
-        external_code = item.get('externalCode')
-        sale_prices = item.get('salePrices') or []
-        if not sale_prices or not sale_prices[0].get('value'):
-            print(f"Product: {product_name} has no salePrices.")
-            return False
-
-        product_price = sale_prices[0]['value'] / 100.0
-        product_description = item.get('description', '')
-
-        images = item.get('images', {}).get('meta')
-
-        # Category
-        category_name_path = item.get('pathName', 'Default Category')
-        category = create_or_get_category_hierarchy(category_name_path)
-
-        # Parse name/color/weight
-        name, color, weight_value = extract_name_color_weight(product_name)
-        # print(f"Extracted Name: {name}, Color: {color}, Weight: {weight_value}")
-
-        # Product
-        product, _ = Product.objects.update_or_create(
-            title=name.strip(),
-            defaults={
-                'category': category,
-                'public': True,
-            }
-        )
-
-        # Weight
-        product_weight = None
-        if weight_value:
-            product_weight, _ = ProductWeight.objects.get_or_create(mass=weight_value.strip())
-
-        # Color
-        product_color = None
-        if color:
-            product_color, _ = ProductColor.objects.get_or_create(name=color.strip())
-
-        # Price
-        created_or_updated_price = False
-        if product_weight and product_color and product_guid:
-            product_price_obj, _ = ProductPrice.objects.update_or_create(
-                guid=product_guid,
-                defaults={
-                    'weight': product_weight,
-                    'color': product_color,
-                    'amount': product_price,
-                    'stock': 0,
-                    'artikul': product_code,
-                    'external_code': external_code,
-                    'description': product_description,
-                }
-            )
-            product.price.add(product_price_obj)
-            created_or_updated_price = True
-        else:
-            print(f"Skip price: guid/weight/color missing for product '{name}'")
-
-        # Images (не критично — ошибки не должны валить импорт)
-        if images and images.get('size', 0) > 0:
-            time.sleep(2)
-            save_images(product, images['href'])
-
-        print(f"Product '{name}' processed.")
-        return bool(created_or_updated_price)
-
-    except Exception as e:
-        # Не пробрасываем — пусть команда решит, как считать
-        print(f"Unexpected error in create_or_update_product: {e}")
-        return False
-
-def create_or_get_category_hierarchy(category_path):
-    category_names = category_path.split('/')
-    parent = None
-    for name in category_names:
-        name = name.strip()
-        if not name:
+    meta = images.get('meta') or {}
+    rows = images.get('rows')
+    if meta.get('size', 0) == 0:
+        return []
+    if rows is not None and len(rows) >= meta['size']:
+        return rows
+    images_data = get_images_data(meta['href'])
+    if images_data:
+        return images_data.get('rows') or []
+    return None
+
+def image_identity(image_meta):
+    """(id, signature) картинки МоегоСклада; signature меняется, если картинку заменили."""
+    href = image_meta['meta'].get('href') or image_meta['meta'].get('downloadHref') or ''
+    image_id = urlparse(href).path.rstrip('/').split('/')[-1]
+    signature = f"{image_meta.get('filename') or ''}|{image_meta.get('size') or ''}|{image_meta.get('updated') or ''}"
+    return image_id, signature[:255]
+
+def _stored_name(shot):
+    """Имя файла снимка без суффикса, который storage добавляет при совпадении имён."""
+    name = os.path.basename(shot.image.name or '')
+    return STORAGE_SUFFIX_RE.sub('', name)
+
+def _delete_shot(shot, shots):
+    if shot.image:
+        shot.image.delete(save=False)
+    shot.delete()
+    shots.remove(shot)
+
+def save_images(product, images, shots=None):
+    """
+    Синхронизирует снимки товара с картинками МоегоСклада: качаются только новые
+    и изменившиеся, удалённые в МоёмСкладе удаляются вместе с файлами.
+    Снимки, загруженные вручную (без moysklad_id), не трогаем. Снимки, скачанные
+    раньше без отметки, узнаём по имени файла — их не перекачиваем, а дубли удаляем.
+    `shots` — уже загруженные снимки товара (чтобы не делать запрос на каждый товар);
+    список обновляется на месте, его можно передавать для следующего варианта.
+    Возвращает список ошибок (пустой — всё синхронизировано).
+    """
+    image_rows = get_image_rows(images)
+    if image_rows is None:
+        print(f"Images of product {product.title} are unavailable; shots left as they are.")
+        return [f"Image list of product {product.title} is unavailable"]
+    if shots is None:
+        shots = list(product.product_shots.all())
+
+    # У Product несколько вариантов со своими картинками — сверяем только снимки этого варианта.
+    source_id = urlparse((images.get('meta') or {}).get('href', '')).path.rstrip('/').split('/')[-2]
+    tracked = {shot.moysklad_id: shot for shot in shots if shot.moysklad_id and shot.moysklad_product_id == source_id}
+    untracked = {}
+    for shot in shots:
+        if not shot.moysklad_id and shot.image:
+            untracked.setdefault(_stored_name(shot), []).append(shot)
+
+    downloaded = unchanged = 0
+    errors = []
+    for i, image_meta in enumerate(image_rows):
+        image_id, signature = image_identity(image_meta)
+        filename = image_meta.get('filename') or f"{product.pk}_{i}.jpg"
+        shot = tracked.pop(image_id, None)
+        if shot and shot.moysklad_signature == signature:
+            unchanged += 1
+            continue
+
+        legacy = None
+        if shot is None:
+            legacy = untracked.pop(STORAGE_SUFFIX_RE.sub('', default_storage.get_valid_name(filename)), None)
+        if legacy:
+            # Картинка уже скачана старым импортом: помечаем первую копию, дубли удаляем.
+            adopted, *duplicates = legacy
+            adopted.moysklad_product_id = source_id
+            adopted.moysklad_id = image_id
+            adopted.moysklad_signature = signature
+            adopted.save(update_fields=['moysklad_product_id', 'moysklad_id', 'moysklad_signature'])
+            for duplicate in duplicates:
+                _delete_shot(duplicate, shots)
+            unchanged += 1
+            continue
+
+        download_href = image_meta['meta'].get('downloadHref')
+        if not download_href:
+            print(f"Image meta without downloadHref at index {i}")
+            errors.append(f"Image {i + 1} has no downloadHref")
             continue
-        category, _ = Category.objects.get_or_create(name=name, parent=parent)
-        parent = category
-    return parent
+        try:
+            # Качаем потоково во временный файл, а не в память целиком;
+            # storage потом копирует его кусками.
+            with tempfile.TemporaryFile() as tmp:
+                moysklad_client.download(
+                    download_href,
+                    tmp,
+                    max_bytes=getattr(settings, "MOYSKLAD_MAX_IMAGE_BYTES", None),
+                    content_types=IMAGE_CONTENT_TYPES,
+                    timeout=120,
+                )
+                tmp.seek(0)
+                shots.append(product.product_shots.create(
+                    image=File(tmp, name=filename),
+                    moysklad_product_id=source_id,
+                    moysklad_id=image_id,
+                    moysklad_signature=signature,
+                ))
+            downloaded += 1
+            print(f"Image {i + 1} saved successfully for product {product.title}!")
+        except MoyskladClientError as e:
+            print(f"Error downloading image {i + 1}: {e}")
+            errors.append(f"Error downloading image {i + 1}: {e}")
+            # Старую версию оставляем, пока новая не скачается.
+            continue
+        if shot:
+            _delete_shot(shot, shots)
+
+    # Остались только картинки, которых в МоёмСкладе больше нет
+    for shot in tracked.values():
+        _delete_shot(shot, shots)
+    if downloaded or tracked:
+        print(f"Images of product {product.title}: downloaded={downloaded} unchanged={unchanged} removed={len(tracked)}")
+    return errors
 
 def delete_product(product_id):
     """
@@ -155,19 +186,3 @@ def delete_product(product_id):
             product.public = False
             product.save(update_fields=["public"])
             print(f"Product '{product.title}' marked as deleted (no active prices).")
-
-def update_stock(data):
-    from products.models import ProductPrice  # локальный импорт на всякий
-    product_url = data['meta']['href']
-    product_name = data['name']
-    stock = data.get('stock', 0)
-    parsed_url = urlparse(product_url)
-    product_id = parsed_url.path.split('/')[-1]
-    product_price_obj = ProductPrice.objects.filter(guid=product_id).first()
-    if product_price_obj:
-        product_price_obj.stock = int(stock)
-        product_price_obj.save()
-        print(f"Stock for product {product_name} updated to {stock}.")
-    else:
-        print(f"No product price found for guid {product_id}.")
-
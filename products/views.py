@@ -1,10 +1,15 @@
 import traceback
+import uuid
 from urllib.parse import urlparse
 
 from dataclasses import dataclass
 
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.utils.decorators import method_decorator
+from django.http import HttpResponse
 from rest_framework import generics, mixins, viewsets
+from rest_framework.permissions import IsAdminUser
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.views import APIView, Response
@@ -19,9 +24,9 @@ from .filters import ProductFilter
 from .moysklad_client import (
     moysklad_client,
     MoyskladClientError,
-    MoyskladCircuitOpenError,
 )
-from .utils import create_or_update_product, delete_product
+from .stocks import StockSyncResult, apply_stocks_in_chunks
+from .webhook_inbox import apply_events, coalesce, enqueue_events, parse_events
 
 
 class ProductShotsViewSet(viewsets.ModelViewSet):
@@ -180,6 +185,9 @@ def _extract_guid_from_href(url: str) -> str:
     return parsed_url.path.rstrip('/').split('/')[-1]
 
 
+# Синхронизация коммитит сама, короткими пачками (см. apply_events / apply_stocks_in_chunks):
+# общая транзакция запроса (ATOMIC_REQUESTS) держала бы блокировки до конца запроса.
+@method_decorator(transaction.non_atomic_requests, name='dispatch')
 class MoyskladProductAPIView(APIView):
     def post(self, request):
         request_data = request.data
@@ -199,36 +207,31 @@ class MoyskladProductAPIView(APIView):
                     status=413,
                 )
 
+            if getattr(settings, "MOYSKLAD_WEBHOOK_INBOX", False):
+                # Только сохраняем события — применит их process_webhook_events
+                queued, collapsed = enqueue_events(parse_events(request_data))
+                return Response(
+                    {"success": True, "message": "Accepted", "queued_events": queued, "collapsed_events": collapsed},
+                    status=202,
+                )
+
             processed = 0
             errors = []
 
-            for event_payload in events:
-                meta = (event_payload or {}).get("meta") or {}
-                action = event_payload.get("action")
-                event_type = meta.get("type")
-                href = meta.get("href")
-
-                if event_type != EventMapper.PRODUCT or not href or not action:
-                    continue
-
-                try:
-                    if action in (ActionMapper.CREATE, ActionMapper.UPDATE):
-                        product_data = moysklad_client.get_json(href)
-                        create_or_update_product(product_data)
-                    elif action == ActionMapper.DELETE:
-                        product_id = _extract_guid_from_href(href)
-                        delete_product(product_id)
+            # Повторы одного товара в запросе склеиваем — товар загружается один раз
+            parsed = parse_events(request_data)
+            unique = coalesce(parsed)
+            moysklad_client.metrics.observe_webhook_events(
+                received=len(parsed), collapsed=len(parsed) - len(unique)
+            )
+            # Товары загружаются пачками (filter=id=...) и пишутся одним пакетом
+            for event, error in zip(unique, apply_events(unique)):
+                if error is None:
                     processed += 1
-                except MoyskladClientError as client_exc:
-                    errors.append(
-                        f"Moysklad client error for href '{href}': {client_exc}"
-                    )
-                    if isinstance(client_exc, MoyskladCircuitOpenError):
-                        break
-                except Exception as inner_exc:
-                    errors.append(
-                        f"Failed to process product event for href '{href}': {inner_exc}"
-                    )
+                elif isinstance(error, MoyskladClientError):
+                    errors.append(f"Moysklad client error for href '{event.href}': {error}")
+                else:
+                    errors.append(f"Failed to process product event for href '{event.href}': {error}")
 
             response_payload = {
                 "success": not errors,
@@ -248,6 +251,7 @@ class MoyskladProductAPIView(APIView):
                 }, status=400)
 
 
+@method_decorator(transaction.non_atomic_requests, name='dispatch')
 class MoyskladProductStockAPIView(APIView):
     def post(self, request):
         request_data = request.data
@@ -260,8 +264,8 @@ class MoyskladProductStockAPIView(APIView):
             else:
                 raise ValueError("Unsupported payload format for stocks.")
 
-            updated = 0
             missing = []
+            stocks = {}
 
             for stock in stock_rows:
                 product_id = stock.get("assortmentId")
@@ -286,21 +290,23 @@ class MoyskladProductStockAPIView(APIView):
                     continue
 
                 try:
-                    product_price = ProductPrice.objects.filter(guid=product_id).first()
-                    if not product_price:
-                        missing.append(product_id)
-                        continue
-
-                    product_price.stock = normalized_stock
-                    product_price.save(update_fields=["stock"])
-                    updated += 1
-                except Exception as inner_exc:
+                    # guid в БД — UUID: один кривой id не должен ломать общий запрос
+                    stocks[str(uuid.UUID(str(product_id)))] = normalized_stock
+                except ValueError as inner_exc:
                     missing.append(f"{product_id}: {inner_exc}")
 
+            # Один запрос на пачку строк, пишем только изменившиеся остатки
+            result = StockSyncResult()
+            for product_id, error in apply_stocks_in_chunks(stocks, result):
+                missing.append(f"{product_id}: {error}")
+            missing.extend(result.missing_guids)
+            updated = result.updated + result.unchanged
+
             data = {
                 "success": True,
                 "message": "Success" if not missing else "Completed with missing records",
                 "updated": updated,
+                "changed": result.updated,
                 "missing": missing,
             }
             status_code = 200 if not missing else 207
@@ -313,3 +319,14 @@ class MoyskladProductStockAPIView(APIView):
                                f"Error repr: {repr(e)}\n"
                                f"Traceback: {traceback.format_exc()}"
                 }, status=400)
+
+
+class MoyskladMetricsView(APIView):
+    """Moysklad client metrics in Prometheus text format (staff only)."""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return HttpResponse(
+            moysklad_client.metrics_prometheus(),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
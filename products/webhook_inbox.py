@@ -0,0 +1,295 @@
+"""
+Durable inbox for Moysklad product webhooks.
+
+The webhook view only validates the payload and bulk-inserts one
+`WebhookEvent` per product event, so Moysklad gets its answer in
+milliseconds instead of waiting for a GET, DB writes and image downloads
+per event. `process_webhook_events` drains the inbox with a bounded thread
+pool; every request goes through the shared Moysklad client and its limits.
+
+Events of one product are applied one at a time in arrival order. Failed
+events are retried with exponential backoff and stay in the table as
+`failed` (the dead letters) after the last attempt (see products.job_queue).
+
+Moysklad often reports the same product several times in a row, so events
+are coalesced per entity (DELETE wins over CREATE/UPDATE): within a
+payload, into an event still waiting in the inbox — a new event waits
+MOYSKLAD_WEBHOOK_COALESCE_SECONDS before it is processed — and, when a
+worker claims an event, with everything queued behind it. The product is
+then fetched once; `WebhookEvent.collapsed` and the client metrics count
+the merged events.
+
+Created/updated products are fetched FETCH_CHUNK at a time with a single
+filtered `entity/product` request and written through the bulk importer,
+so a burst of 1000 events costs ten requests rather than a thousand.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from products.job_queue import claim_due, reschedule, serialized
+from products.models import WebhookEvent
+from products.moysklad_client import moysklad_client, MoyskladCircuitOpenError, MAX_EXPAND_PAGE_SIZE
+from products.stocks import STOCK_DOCUMENT_TYPES, sync_stock_document
+
+PRODUCT = "product"
+ACTIONS = ("CREATE", "UPDATE", "DELETE")
+
+# Products fetched with one `entity/product?filter=id=...;id=...` request.
+FETCH_CHUNK = MAX_EXPAND_PAGE_SIZE
+
+# Workers fetch from Moysklad in parallel but write one at a time (see import_product_rows).
+_write_lock = threading.Lock()
+QUEUE_LOCK_NAME = "products:webhook_inbox"
+
+DONE = "done"
+RETRY = "retry"
+FAILED = "failed"
+
+
+def _entity_id(href: str) -> str:
+    return urlparse(href).path.rstrip('/').split('/')[-1]
+
+
+def parse_events(payload: Dict[str, Any]) -> List[WebhookEvent]:
+    """Unsaved inbox rows for the product and sale/shipment events of a webhook payload."""
+    events = payload.get("events")
+    if not isinstance(events, list):
+        raise ValueError("Payload must contain 'events' list.")
+    moment = str((payload.get("auditContext") or {}).get("moment") or "")
+
+    parsed = []
+    for event_payload in events:
+        if not isinstance(event_payload, dict):
+            continue
+        meta = event_payload.get("meta") or {}
+        action = event_payload.get("action")
+        href = meta.get("href")
+        entity_type = meta.get("type")
+        if entity_type not in (PRODUCT,) + STOCK_DOCUMENT_TYPES or not href or action not in ACTIONS:
+            continue
+        parsed.append(WebhookEvent(
+            entity_type=entity_type, action=action, entity_id=_entity_id(href), href=href, moment=moment,
+        ))
+    return parsed
+
+
+def coalesce(events: List[WebhookEvent]) -> List[WebhookEvent]:
+    """One event per entity, in order of first appearance."""
+    by_entity: Dict[Tuple[str, str], WebhookEvent] = {}
+    for event in events:
+        key = (event.entity_type, event.entity_id)
+        if key in by_entity:
+            by_entity[key].absorb(event)
+        else:
+            by_entity[key] = event
+    return list(by_entity.values())
+
+
+def enqueue_events(events: List[WebhookEvent]) -> Tuple[int, int]:
+    """
+    Stores the events of a payload; returns (queued, collapsed). Events for
+    an entity that already waits in the inbox are merged into that row,
+    unless the row is a retry waiting out its backoff: then the new event
+    gets its own row and the usual coalescing delay. Runs under the queue
+    lock, so nothing is merged into a row a worker has just claimed.
+    """
+    received = len(events)
+    events = coalesce(events)
+    delay = timedelta(seconds=getattr(settings, "MOYSKLAD_WEBHOOK_COALESCE_SECONDS", 0))
+    with serialized(QUEUE_LOCK_NAME):
+        waiting = {
+            (event.entity_type, event.entity_id): event
+            for event in WebhookEvent.objects.filter(
+                status=WebhookEvent.PENDING, attempts=0, entity_id__in={event.entity_id for event in events},
+            ).order_by('-pk')
+        }
+        merged, new = [], []
+        for event in events:
+            target = waiting.get((event.entity_type, event.entity_id))
+            if target:
+                target.absorb(event)
+                merged.append(target)
+            else:
+                event.available_at = timezone.now() + delay
+                new.append(event)
+        WebhookEvent.objects.bulk_update(merged, ['action', 'href', 'moment', 'collapsed'])
+        WebhookEvent.objects.bulk_create(new)
+    collapsed = received - len(new)
+    moysklad_client.metrics.observe_webhook_events(received=received, queued=len(new), collapsed=collapsed)
+    return len(new), collapsed
+
+
+def claim_events(limit: int) -> List[WebhookEvent]:
+    """
+    Marks up to `limit` due events as running and returns them, at most one
+    per product (the oldest), skipping products whose event is still running.
+    Later pending events of a claimed product are merged into its event.
+    Claims are serialized (one claimer at a time across processes), so two
+    workers never take events of the same product.
+    """
+    with serialized(QUEUE_LOCK_NAME):
+        events = claim_due(WebhookEvent, ('entity_type', 'entity_id'), limit)
+        _absorb_queued(events)
+    return events
+
+
+def _absorb_queued(events: List[WebhookEvent]) -> None:
+    """Merges pending events queued behind the claimed ones (any due time) into them."""
+    claimed = {(event.entity_type, event.entity_id): event for event in events}
+    queued = WebhookEvent.objects.filter(
+        status=WebhookEvent.PENDING, entity_id__in={event.entity_id for event in events},
+    ).exclude(pk__in=[event.pk for event in events]).order_by('pk')
+    absorbed, collapsed = [], 0
+    for event in queued:
+        target = claimed.get((event.entity_type, event.entity_id))
+        if target and event.pk > target.pk:
+            target.absorb(event)
+            absorbed.append(event.pk)
+            collapsed += 1 + event.collapsed
+    if absorbed:
+        WebhookEvent.objects.bulk_update(list(claimed.values()), ['action', 'href', 'moment', 'collapsed'])
+        WebhookEvent.objects.filter(pk__in=absorbed).delete()
+        moysklad_client.metrics.observe_webhook_events(collapsed=collapsed)
+
+
+def apply_events(events: List[WebhookEvent], log=print) -> List[Optional[Exception]]:
+    """
+    Applies product events: deletions locally, creates/updates by fetching the
+    products FETCH_CHUNK at a time and importing each chunk as one page.
+    Sale/shipment events move stock (see stocks.sync_stock_document).
+    Returns, per event, None or the error that kept it from being applied
+    (then the event should be retried). Works on unsaved events too.
+
+    Commits on its own — per deletion and per chunk, with a savepoint per row
+    when a chunk has to be retried row by row — so callers shouldn't wrap it
+    in one long transaction (the webhook view opts out of ATOMIC_REQUESTS).
+    """
+    from products.importer import import_product_rows, queue_pending_images, save_pending_images  # локальный импорт на всякий
+    from products.utils import delete_product, fetch_products
+
+    errors: List[Optional[Exception]] = [None] * len(events)
+    updates = []
+    for i, event in enumerate(events):
+        if event.entity_type in STOCK_DOCUMENT_TYPES:
+            # Продажа/отгрузка: позиции документа одним запросом, остатки — через F()
+            try:
+                sync_stock_document(event, write_lock=_write_lock)
+            except Exception as e:
+                errors[i] = e
+            continue
+        if event.action != "DELETE":
+            updates.append(i)
+            continue
+        try:
+            # Каждое удаление — своя транзакция: ошибка не откатывает соседние события
+            with _write_lock, transaction.atomic():
+                delete_product(event.entity_id)
+        except Exception as e:
+            errors[i] = e
+
+    for start in range(0, len(updates), FETCH_CHUNK):
+        chunk = updates[start:start + FETCH_CHUNK]
+        try:
+            rows = fetch_products(events[i].entity_id for i in chunk)
+        except Exception as e:
+            # МойСклад недоступен — остальные пачки не пытаемся
+            failed = updates[start:] if isinstance(e, MoyskladCircuitOpenError) else chunk
+            for i in failed:
+                errors[i] = e
+            if failed is not chunk:
+                break
+            continue
+
+        by_id = {row.get('id'): row for row in rows}
+        found = [i for i in chunk if events[i].entity_id in by_id]
+        for i in chunk:
+            if events[i].entity_id not in by_id:
+                # Товар успели удалить — придёт отдельное событие DELETE
+                log(f"Product {events[i].entity_id} not found in Moysklad; event skipped.")
+        if not found:
+            continue
+
+        messages = []
+        try:
+            with _write_lock, transaction.atomic():
+                result = import_product_rows(
+                    [by_id[events[i].entity_id] for i in found], with_images=False, log=messages.append
+                )
+                queue_pending_images(result)
+        except Exception as e:
+            for i in found:
+                errors[i] = e
+            continue
+        for message in messages:
+            log(message)
+        # Невалидная строка (см. classify_row) — не ошибка: повтор ничего не изменит
+        invalid = {index for index, _ in result.issues}
+        for position, i in enumerate(found):
+            if not result.results[position] and position not in invalid:
+                errors[i] = RuntimeError("; ".join(messages)[:1000] or "product was not written")
+        save_pending_images(result)
+    return errors
+
+
+def process_events(events: List[WebhookEvent], log=print) -> List[str]:
+    """Runs claimed events; returns DONE, RETRY or FAILED for each."""
+    max_attempts = getattr(settings, "MOYSKLAD_WEBHOOK_EVENT_MAX_ATTEMPTS", 5)
+    outcomes = []
+    for event, error in zip(events, apply_events(events, log=log)):
+        if error is None:
+            outcomes.append(DONE)
+        elif isinstance(error, MoyskladCircuitOpenError):
+            # МойСклад недоступен — попытку не засчитываем, ждём закрытия цепи
+            with _write_lock:
+                reschedule(event, str(error), max_attempts, retry_after=max(error.retry_after, 5))
+            outcomes.append(RETRY)
+        else:
+            with _write_lock:
+                status = reschedule(event, f"{type(error).__name__}: {error}", max_attempts)
+            outcomes.append(FAILED if status == WebhookEvent.FAILED else RETRY)
+
+    with _write_lock:
+        WebhookEvent.objects.filter(
+            pk__in=[event.pk for event, outcome in zip(events, outcomes) if outcome == DONE]
+        ).delete()
+    return outcomes
+
+
+def drain_webhook_inbox(workers: int = 4, batch: int = 400, max_events: Optional[int] = None,
+                        log=print) -> Dict[str, int]:
+    """
+    Processes due events until none are left (or `max_events` are handled).
+    Each claimed batch is split into FETCH_CHUNK-sized parts run by the pool;
+    with `workers=1` they run in the calling thread and its DB connection.
+    """
+    stats = {DONE: 0, RETRY: 0, FAILED: 0}
+
+    def run(chunk):
+        try:
+            return process_events(chunk, log=log)
+        finally:
+            connection.close()
+
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="webhook-inbox") if workers > 1 else None
+    try:
+        while max_events is None or sum(stats.values()) < max_events:
+            limit = batch if max_events is None else min(batch, max_events - sum(stats.values()))
+            events = claim_events(limit)
+            if not events:
+                break
+            chunks = [events[start:start + FETCH_CHUNK] for start in range(0, len(events), FETCH_CHUNK)]
+            for outcomes in (pool.map(run, chunks) if pool else (process_events(c, log=log) for c in chunks)):
+                for outcome in outcomes:
+                    stats[outcome] += 1
+            log(f"Webhook events: done={stats[DONE]} retry={stats[RETRY]} failed={stats[FAILED]}")
+    finally:
+        if pool:
+            pool.shutdown()
+    return stats